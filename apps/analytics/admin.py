@@ -1,3 +1,19 @@
 from django.contrib import admin
+from .models import ActivityRollup, RoomRollup, RollupCursor
 
-# Register your models here.
+@admin.register(ActivityRollup)
+class ActivityRollupAdmin(admin.ModelAdmin):
+    list_display = ('granularity', 'bucket', 'messages', 'self_destruct_messages', 'active_users', 'peak_connections')
+    list_filter = ('granularity',)
+    date_hierarchy = 'bucket'
+
+@admin.register(RoomRollup)
+class RoomRollupAdmin(admin.ModelAdmin):
+    list_display = ('room', 'granularity', 'bucket', 'messages', 'self_destruct_messages', 'active_users')
+    list_filter = ('granularity',)
+    search_fields = ('room__name',)
+    date_hierarchy = 'bucket'
+
+@admin.register(RollupCursor)
+class RollupCursorAdmin(admin.ModelAdmin):
+    list_display = ('name', 'last_id', 'updated_at')
@@ -3,4 +3,5 @@ from django.apps import AppConfig
 
 class AnalyticsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'analytics'
+    name = 'apps.analytics'
+    verbose_name = 'Analytics'
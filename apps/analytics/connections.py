@@ -0,0 +1,40 @@
+"""
+Concurrent WebSocket connection counting for the rollups.
+
+Consumers call ``connection_opened`` and ``connection_closed``; the open
+count lives in the shared cache so every server process adds to the same
+number, and each hour keeps the highest count it saw under its own key
+until ``update_rollups`` stores it. With a per-process cache (locmem) the
+peaks are per process.
+"""
+from django.core.cache import cache
+from django.utils import timezone
+
+OPEN_KEY = 'analytics:connections'
+PEAK_TIMEOUT = 2 * 24 * 3600
+
+
+def hour_start(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def peak_key(hour):
+    return f'analytics:peak:{hour:%Y%m%d%H}'
+
+
+async def connection_opened():
+    await cache.aadd(OPEN_KEY, 0, timeout=None)
+    current = await cache.aincr(OPEN_KEY)
+    key = peak_key(hour_start(timezone.now()))
+    # Not atomic, but a lost race only understates a peak by a connection or two
+    if current > (await cache.aget(key) or 0):
+        await cache.aset(key, current, timeout=PEAK_TIMEOUT)
+
+
+async def connection_closed():
+    try:
+        if await cache.adecr(OPEN_KEY) < 0:
+            await cache.aset(OPEN_KEY, 0, timeout=None)
+    except ValueError:
+        # The counter expired or the cache was cleared
+        pass
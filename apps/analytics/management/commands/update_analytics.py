@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from apps.analytics.rollups import update_rollups
+
+
+class Command(BaseCommand):
+    help = 'Fold messages added since the last run into the hourly and daily analytics rollups'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, help='Message ids per transaction')
+
+    def handle(self, *args, **options):
+        count = update_rollups(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Rolled up {count} messages'))
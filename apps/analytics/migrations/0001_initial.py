@@ -0,0 +1,85 @@
+# Generated by Django 5.2.7 on 2026-10-19 01:35
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('chat', '0012_activity_summary_run'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('last_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'analytics_rollup_cursors',
+            },
+        ),
+        migrations.CreateModel(
+            name='ActivityRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('hour', 'Hourly'), ('day', 'Daily')], max_length=4)),
+                ('bucket', models.DateTimeField()),
+                ('messages', models.PositiveIntegerField(default=0)),
+                ('self_destruct_messages', models.PositiveIntegerField(default=0)),
+                ('active_users', models.PositiveIntegerField(default=0)),
+                ('peak_connections', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Activity Rollup',
+                'verbose_name_plural': 'Activity Rollups',
+                'db_table': 'analytics_activity_rollups',
+                'ordering': ['granularity', 'bucket'],
+                'constraints': [models.UniqueConstraint(fields=('granularity', 'bucket'), name='unique_activity_rollup')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ActiveUser',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('hour', 'Hourly'), ('day', 'Daily')], max_length=4)),
+                ('bucket', models.DateTimeField()),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Active User',
+                'verbose_name_plural': 'Active Users',
+                'db_table': 'analytics_active_users',
+                'constraints': [models.UniqueConstraint(fields=('granularity', 'bucket', 'room', 'user'), name='unique_active_user')],
+            },
+        ),
+        migrations.CreateModel(
+            name='RoomRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('hour', 'Hourly'), ('day', 'Daily')], max_length=4)),
+                ('bucket', models.DateTimeField()),
+                ('messages', models.PositiveIntegerField(default=0)),
+                ('self_destruct_messages', models.PositiveIntegerField(default=0)),
+                ('active_users', models.PositiveIntegerField(default=0)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.chatroom')),
+            ],
+            options={
+                'verbose_name': 'Room Rollup',
+                'verbose_name_plural': 'Room Rollups',
+                'db_table': 'analytics_room_rollups',
+                'ordering': ['granularity', 'bucket'],
+                'indexes': [models.Index(fields=['granularity', 'bucket', 'messages'], name='analytics_r_granula_efd2b6_idx')],
+                'constraints': [models.UniqueConstraint(fields=('room', 'granularity', 'bucket'), name='unique_room_rollup')],
+            },
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.7 on 2026-10-19 01:38
+
+from django.conf import settings
+from django.db import migrations, models
+
+from apps.analytics.hll import HyperLogLog
+
+
+def sketch_active_users(apps, schema_editor):
+    """Turn the exact active-user rows into sketches on their rollups"""
+    ActiveUser = apps.get_model('analytics', 'ActiveUser')
+    ActivityRollup = apps.get_model('analytics', 'ActivityRollup')
+    RoomRollup = apps.get_model('analytics', 'RoomRollup')
+    precision = getattr(settings, 'ANALYTICS_HLL_PRECISION', 12)
+    rooms, sites = {}, {}
+    for granularity, bucket, room_id, user_id in ActiveUser.objects.values_list(
+        'granularity', 'bucket', 'room_id', 'user_id'
+    ).iterator():
+        rooms.setdefault((granularity, bucket, room_id), HyperLogLog(precision)).add(user_id)
+        sites.setdefault((granularity, bucket), HyperLogLog(precision)).add(user_id)
+    for (granularity, bucket, room_id), sketch in rooms.items():
+        RoomRollup.objects.filter(granularity=granularity, bucket=bucket, room_id=room_id).update(
+            users_sketch=sketch.to_bytes()
+        )
+    for (granularity, bucket), sketch in sites.items():
+        ActivityRollup.objects.filter(granularity=granularity, bucket=bucket).update(users_sketch=sketch.to_bytes())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activityrollup',
+            name='users_sketch',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.AddField(
+            model_name='roomrollup',
+            name='users_sketch',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.RunPython(sketch_active_users, migrations.RunPython.noop),
+        migrations.DeleteModel(
+            name='ActiveUser',
+        ),
+    ]
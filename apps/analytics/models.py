@@ -1,3 +1,70 @@
 from django.db import models
 
-# Create your models here.
+GRANULARITY_CHOICES = [
+    ('hour', 'Hourly'),
+    ('day', 'Daily'),
+]
+
+
+class ActivityRollup(models.Model):
+    """Site-wide activity for one hour or day"""
+    granularity = models.CharField(max_length=4, choices=GRANULARITY_CHOICES)
+    bucket = models.DateTimeField()
+    messages = models.PositiveIntegerField(default=0)
+    self_destruct_messages = models.PositiveIntegerField(default=0)
+    active_users = models.PositiveIntegerField(default=0)
+    # HyperLogLog sketch of the active users (see apps/analytics/hll.py)
+    users_sketch = models.BinaryField(default=b'', editable=False)
+    peak_connections = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        db_table = 'analytics_activity_rollups'
+        verbose_name = 'Activity Rollup'
+        verbose_name_plural = 'Activity Rollups'
+        ordering = ['granularity', 'bucket']
+        constraints = [
+            models.UniqueConstraint(fields=['granularity', 'bucket'], name='unique_activity_rollup'),
+        ]
+
+    def __str__(self):
+        return f"{self.granularity} {self.bucket:%Y-%m-%d %H:%M}: {self.messages} messages"
+
+
+class RoomRollup(models.Model):
+    """Activity of one room for one hour or day"""
+    granularity = models.CharField(max_length=4, choices=GRANULARITY_CHOICES)
+    bucket = models.DateTimeField()
+    room = models.ForeignKey('chat.ChatRoom', on_delete=models.CASCADE, related_name='+')
+    messages = models.PositiveIntegerField(default=0)
+    self_destruct_messages = models.PositiveIntegerField(default=0)
+    active_users = models.PositiveIntegerField(default=0)
+    users_sketch = models.BinaryField(default=b'', editable=False)
+
+    class Meta:
+        db_table = 'analytics_room_rollups'
+        verbose_name = 'Room Rollup'
+        verbose_name_plural = 'Room Rollups'
+        ordering = ['granularity', 'bucket']
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'granularity', 'bucket'], name='unique_room_rollup'),
+        ]
+        indexes = [
+            # Busiest rooms of a period
+            models.Index(fields=['granularity', 'bucket', 'messages']),
+        ]
+
+    def __str__(self):
+        return f"{self.room_id} {self.granularity} {self.bucket:%Y-%m-%d %H:%M}: {self.messages} messages"
+
+
+class RollupCursor(models.Model):
+    """How far a rollup job has read its source table"""
+    name = models.CharField(max_length=50, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'analytics_rollup_cursors'
+
+    def __str__(self):
+        return f"{self.name} @ {self.last_id}"
@@ -0,0 +1,76 @@
+"""
+Read side of the analytics: every query here reads rollup rows only, so a
+report costs one row per bucket (or per room) however many messages the
+period holds.
+"""
+from datetime import timedelta
+
+from django.db.models import Max, Q, Sum
+
+from .hll import merged
+from .models import ActivityRollup, RoomRollup
+from .rollups import day_start
+
+ACTIVITY_FIELDS = ('bucket', 'messages', 'self_destruct_messages', 'active_users', 'peak_connections')
+ROOM_FIELDS = ('bucket', 'messages', 'self_destruct_messages', 'active_users')
+
+
+def site_activity(granularity, start, end):
+    """Site-wide activity per bucket in [start, end)"""
+    return list(
+        ActivityRollup.objects.filter(granularity=granularity, bucket__gte=start, bucket__lt=end)
+        .order_by('bucket').values(*ACTIVITY_FIELDS)
+    )
+
+
+def room_activity(room_id, granularity, start, end):
+    """One room's activity per bucket in [start, end)"""
+    return list(
+        RoomRollup.objects.filter(room_id=room_id, granularity=granularity, bucket__gte=start, bucket__lt=end)
+        .order_by('bucket').values(*ROOM_FIELDS)
+    )
+
+
+def busiest_rooms(start, end, limit=10):
+    """The rooms with the most messages over the days in [start, end)"""
+    return list(
+        RoomRollup.objects.filter(granularity='day', bucket__gte=start, bucket__lt=end)
+        .values('room_id', 'room__name')
+        .annotate(
+            messages=Sum('messages'),
+            self_destruct_messages=Sum('self_destruct_messages'),
+            peak_active_users=Max('active_users'),
+        )
+        .order_by('-messages', 'room_id')[:limit]
+    )
+
+
+def active_users(start, end, room_ids=None):
+    """
+    Approximate distinct senders in [start, end), site-wide or across
+    ``room_ids``: the union of daily sketches for the whole days in the
+    window and hourly sketches for the hours at either end. Returns
+    ``{'estimate', 'relative_error'}``.
+    """
+    model = ActivityRollup if room_ids is None else RoomRollup
+    rollups = model.objects.all() if room_ids is None else model.objects.filter(room_id__in=room_ids)
+
+    first_day = day_start(start)
+    if first_day < start:
+        first_day += timedelta(days=1)
+    last_day = day_start(end)
+    if first_day < last_day:
+        sketches = list(
+            rollups.filter(granularity='day', bucket__gte=first_day, bucket__lt=last_day)
+            .values_list('users_sketch', flat=True)
+        )
+        hours = rollups.filter(granularity='hour').filter(
+            Q(bucket__gte=start, bucket__lt=first_day) | Q(bucket__gte=last_day, bucket__lt=end)
+        )
+    else:
+        sketches = []
+        hours = rollups.filter(granularity='hour', bucket__gte=start, bucket__lt=end)
+    sketches += hours.values_list('users_sketch', flat=True)
+
+    union = merged(sketches)
+    return {'estimate': union.count(), 'relative_error': round(union.relative_error, 4)}
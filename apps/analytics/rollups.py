@@ -0,0 +1,126 @@
+"""
+Incremental rollups of chat activity.
+
+``update_rollups`` reads only the messages past its cursor, in id windows
+of ``ANALYTICS_ROLLUP_CHUNK_SIZE``, and folds each window into hourly and
+daily ``RoomRollup`` and ``ActivityRollup`` rows with grouped queries. The
+window's counts and the cursor move in one transaction, so every message is
+counted exactly once however often the job runs. Messages younger than
+``ANALYTICS_ROLLUP_LAG_SECONDS`` are left for the next run, giving
+transactions that are still open time to commit their ids.
+
+Active users are kept as HyperLogLog sketches on the rollup rows, so the
+distinct users of any set of rooms and buckets come from merging sketches
+(see ``reports.active_users``) rather than from scanning messages.
+
+Peak concurrent WebSocket connections come from the connection counter in
+``apps.analytics.connections`` and are folded in on every run; run the job
+at least hourly so no hour's peak expires from the cache.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from apps.chat.models import Message
+from .connections import hour_start, peak_key
+from .hll import HyperLogLog
+from .models import ActivityRollup, RollupCursor, RoomRollup
+
+CURSOR = 'chat.message'
+
+
+def day_start(hour):
+    return timezone.localtime(hour).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _add(model, key, counts):
+    """Add ``counts`` to the rollup row ``key``, creating it if needed"""
+    changes = {field: F(field) + value for field, value in counts.items()}
+    if not model.objects.filter(**key).update(**changes):
+        model.objects.create(**key, **counts)
+
+
+def _add_users(model, key, users):
+    """Add users to the active-user sketch of the rollup row ``key``"""
+    pk, data = model.objects.filter(**key).values_list('pk', 'users_sketch').get()
+    sketch = HyperLogLog.load(data, getattr(settings, 'ANALYTICS_HLL_PRECISION', 12)).update(users)
+    model.objects.filter(pk=pk).update(users_sketch=sketch.to_bytes(), active_users=sketch.count())
+
+
+def fold_window(low, high):
+    """Count the messages with ids in (low, high] into the rollups"""
+    messages = Message.objects.filter(pk__gt=low, pk__lte=high).annotate(hour=TruncHour('timestamp')).order_by()
+    rooms = {}
+    for row in messages.values('hour', 'room_id').annotate(
+        messages=Count('id'), self_destruct_messages=Count('id', filter=Q(self_destruct=True)),
+    ):
+        for bucket in (('hour', row['hour']), ('day', day_start(row['hour']))):
+            counts = rooms.setdefault((*bucket, row['room_id']), {'messages': 0, 'self_destruct_messages': 0})
+            counts['messages'] += row['messages']
+            counts['self_destruct_messages'] += row['self_destruct_messages']
+
+    rooms_users, site_users = {}, {}
+    for hour, room_id, user_id in messages.values_list('hour', 'room_id', 'sender_id').distinct():
+        for granularity, bucket in (('hour', hour), ('day', day_start(hour))):
+            rooms_users.setdefault((granularity, bucket, room_id), set()).add(user_id)
+            site_users.setdefault((granularity, bucket), set()).add(user_id)
+
+    totals = {}
+    for (granularity, bucket, room_id), counts in rooms.items():
+        key = {'granularity': granularity, 'bucket': bucket}
+        _add(RoomRollup, {**key, 'room_id': room_id}, counts)
+        total = totals.setdefault((granularity, bucket), {'messages': 0, 'self_destruct_messages': 0})
+        for field, value in counts.items():
+            total[field] += value
+    for (granularity, bucket), counts in totals.items():
+        _add(ActivityRollup, {'granularity': granularity, 'bucket': bucket}, counts)
+
+    for (granularity, bucket, room_id), users in rooms_users.items():
+        _add_users(RoomRollup, {'granularity': granularity, 'bucket': bucket, 'room_id': room_id}, users)
+    for (granularity, bucket), users in site_users.items():
+        _add_users(ActivityRollup, {'granularity': granularity, 'bucket': bucket}, users)
+    return sum(counts['messages'] for (granularity, _, _), counts in rooms.items() if granularity == 'hour')
+
+
+def fold_peaks(now):
+    """Raise the stored peak connections from this and the previous hour's counters"""
+    for hour in (hour_start(now) - timedelta(hours=1), hour_start(now)):
+        peak = cache.get(peak_key(hour))
+        if not peak:
+            continue
+        for granularity, bucket in (('hour', hour), ('day', day_start(hour))):
+            rollup, _ = ActivityRollup.objects.get_or_create(granularity=granularity, bucket=bucket)
+            if peak > rollup.peak_connections:
+                ActivityRollup.objects.filter(pk=rollup.pk, peak_connections__lt=peak).update(peak_connections=peak)
+
+
+def update_rollups(now=None, chunk_size=None):
+    """Fold the messages added since the last run into the rollups; returns how many"""
+    now = now or timezone.now()
+    chunk_size = chunk_size or getattr(settings, 'ANALYTICS_ROLLUP_CHUNK_SIZE', 10000)
+    lag = timedelta(seconds=getattr(settings, 'ANALYTICS_ROLLUP_LAG_SECONDS', 60))
+    RollupCursor.objects.get_or_create(name=CURSOR)
+
+    folded = 0
+    while True:
+        with transaction.atomic():
+            # The row lock keeps concurrent runs from counting a window twice
+            cursor = RollupCursor.objects.select_for_update().get(name=CURSOR)
+            upper = (
+                Message.objects.filter(pk__gt=cursor.last_id, timestamp__lte=now - lag)
+                .order_by('-pk').values_list('pk', flat=True).first()
+            )
+            if upper is None:
+                break
+            high = min(upper, cursor.last_id + chunk_size)
+            folded += fold_window(cursor.last_id, high)
+            cursor.last_id = high
+            cursor.save(update_fields=['last_id', 'updated_at'])
+
+    fold_peaks(now)
+    return folded
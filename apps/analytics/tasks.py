@@ -0,0 +1,12 @@
+from celery import shared_task
+
+from .rollups import update_rollups
+
+
+@shared_task
+def update_analytics_rollups():
+    """
+    Fold new messages and connection peaks into the analytics rollups
+    """
+    count = update_rollups()
+    return f"Rolled up {count} messages"
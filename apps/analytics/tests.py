@@ -1,3 +1,159 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from apps.chat.models import ChatRoom, Message
+from apps.users.models import CustomUser
+from . import connections, reports
+from .hll import HyperLogLog
+from .models import ActivityRollup, RoomRollup
+from .rollups import update_rollups
+
+HOUR = datetime(2026, 3, 2, 9, tzinfo=dt_timezone.utc)
+DAY = datetime(2026, 3, 2, tzinfo=dt_timezone.utc)
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        self.alice, self.bob = [
+            CustomUser.objects.create_user(username=name, email=f'{name}@example.com', password='secret-pass')
+            for name in ('alice', 'bob')
+        ]
+        self.general = ChatRoom.objects.create(name='general', room_type='group', created_by=self.alice)
+        self.general.participants.add(self.alice, self.bob)
+        self.random = ChatRoom.objects.create(name='random', room_type='group', created_by=self.alice)
+        self.random.participants.add(self.alice)
+        self.later = HOUR + timedelta(days=1)
+
+    def post(self, room, sender, at, self_destruct=False):
+        message = Message.objects.create(
+            room=room, sender=sender, encrypted_content='c', iv='', self_destruct=self_destruct
+        )
+        Message.objects.filter(pk=message.pk).update(timestamp=at)
+        return message
+
+    def rollup(self, model, granularity, bucket, **key):
+        return model.objects.get(granularity=granularity, bucket=bucket, **key)
+
+    def test_folds_messages_into_hourly_and_daily_rollups(self):
+        self.post(self.general, self.alice, HOUR + timedelta(minutes=5))
+        self.post(self.general, self.alice, HOUR + timedelta(minutes=10), self_destruct=True)
+        self.post(self.general, self.bob, HOUR + timedelta(minutes=50))
+        self.post(self.random, self.alice, HOUR + timedelta(hours=2))
+
+        self.assertEqual(update_rollups(now=self.later), 4)
+        hour = self.rollup(ActivityRollup, 'hour', HOUR)
+        self.assertEqual((hour.messages, hour.self_destruct_messages, hour.active_users), (3, 1, 2))
+        day = self.rollup(ActivityRollup, 'day', DAY)
+        self.assertEqual((day.messages, day.self_destruct_messages, day.active_users), (4, 1, 2))
+        room = self.rollup(RoomRollup, 'day', DAY, room=self.random)
+        self.assertEqual((room.messages, room.active_users), (1, 1))
+
+    def test_later_runs_only_add_new_messages(self):
+        self.post(self.general, self.alice, HOUR)
+        update_rollups(now=self.later)
+        self.assertEqual(update_rollups(now=self.later), 0)
+
+        self.post(self.general, self.alice, HOUR + timedelta(minutes=30))
+        self.post(self.general, self.bob, HOUR + timedelta(minutes=40))
+        self.assertEqual(update_rollups(now=self.later, chunk_size=1), 2)
+        hour = self.rollup(RoomRollup, 'hour', HOUR, room=self.general)
+        self.assertEqual((hour.messages, hour.active_users), (3, 2))
+        self.assertEqual(self.rollup(ActivityRollup, 'day', DAY).active_users, 2)
+
+    def test_recent_messages_wait_for_the_lag(self):
+        self.post(self.general, self.alice, HOUR)
+        self.assertEqual(update_rollups(now=HOUR + timedelta(seconds=10)), 0)
+        self.assertEqual(update_rollups(now=HOUR + timedelta(minutes=5)), 1)
+
+    def test_reports_read_one_row_per_bucket(self):
+        for minute in range(0, 60, 5):
+            self.post(self.general, self.alice, HOUR + timedelta(minutes=minute))
+        self.post(self.random, self.alice, HOUR + timedelta(hours=1))
+        update_rollups(now=self.later)
+
+        with self.assertNumQueries(1):
+            buckets = reports.site_activity('hour', DAY, DAY + timedelta(days=1))
+        self.assertEqual([(b['bucket'], b['messages']) for b in buckets], [(HOUR, 12), (HOUR + timedelta(hours=1), 1)])
+        rooms = reports.busiest_rooms(DAY, DAY + timedelta(days=1))
+        self.assertEqual([(r['room__name'], r['messages']) for r in rooms], [('general', 12), ('random', 1)])
+
+    def test_active_users_merge_across_rooms_and_buckets(self):
+        carol = CustomUser.objects.create_user(username='carol', email='carol@example.com', password='secret-pass')
+        self.random.participants.add(carol)
+        self.post(self.general, self.alice, DAY - timedelta(hours=1))
+        self.post(self.general, self.bob, DAY + timedelta(hours=3))
+        self.post(self.random, self.alice, DAY + timedelta(days=1, hours=5))
+        self.post(self.random, carol, DAY + timedelta(days=2, hours=1))
+        update_rollups(now=DAY + timedelta(days=5))
+
+        window = (DAY - timedelta(hours=2), DAY + timedelta(days=2, hours=2))
+        with self.assertNumQueries(2):
+            self.assertEqual(reports.active_users(*window)['estimate'], 3)
+        self.assertEqual(reports.active_users(*window, room_ids=[self.general.pk])['estimate'], 2)
+        self.assertEqual(reports.active_users(DAY, DAY + timedelta(days=2))['estimate'], 2)
+        self.assertEqual(reports.active_users(DAY + timedelta(hours=1), DAY + timedelta(hours=4))['estimate'], 1)
+
+    def test_peak_connections(self):
+        cache.clear()
+        for step in (connections.connection_opened,) * 3 + (connections.connection_closed, connections.connection_opened):
+            async_to_sync(step)()
+        update_rollups()
+        now = timezone.now()
+        hour = ActivityRollup.objects.get(granularity='hour', bucket=connections.hour_start(now))
+        self.assertEqual(hour.peak_connections, 3)
+
+
+class HyperLogLogTests(TestCase):
+    def test_estimate_is_within_the_error_bound(self):
+        sketch = HyperLogLog(precision=12).update(range(20000))
+        self.assertLess(abs(sketch.count() - 20000) / 20000, 3 * sketch.relative_error)
+        self.assertEqual(HyperLogLog().update([1, 2, 3, 2, 1]).count(), 3)
+
+    def test_merge_is_the_union(self):
+        a = HyperLogLog().update(range(0, 3000))
+        b = HyperLogLog().update(range(2000, 5000))
+        union = HyperLogLog().update(range(0, 5000))
+        self.assertEqual(a.merge(b).registers, union.registers)
+        with self.assertRaises(ValueError):
+            a.merge(HyperLogLog(precision=10))
+
+    def test_serialized_sketches_are_compact(self):
+        sketch = HyperLogLog().update(['alice', 'bob'])
+        data = sketch.to_bytes()
+        self.assertLess(len(data), 100)
+        self.assertEqual(HyperLogLog.from_bytes(data).registers, sketch.registers)
+
+
+class AnalyticsViewTests(TestCase):
+    def setUp(self):
+        self.staff = CustomUser.objects.create_user(
+            username='staff', email='staff@example.com', password='secret-pass', is_staff=True
+        )
+        self.member = CustomUser.objects.create_user(username='member', email='member@example.com', password='secret-pass')
+        self.room = ChatRoom.objects.create(name='general', room_type='group', created_by=self.member)
+        self.room.participants.add(self.member)
+        RoomRollup.objects.create(granularity='day', bucket=DAY, room=self.room, messages=7, active_users=1)
+        ActivityRollup.objects.create(granularity='day', bucket=DAY, messages=7, active_users=1)
+
+    def test_site_activity_is_for_staff(self):
+        url = reverse('analytics:site_activity') + '?granularity=day&start=2026-03-01&end=2026-03-04'
+        self.client.force_login(self.member)
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+        self.client.force_login(self.staff)
+        response = self.client.get(url)
+        self.assertEqual([bucket['messages'] for bucket in response.json()['buckets']], [7])
+        self.assertEqual(self.client.get(url.replace('day', 'week', 1)).status_code, 400)
+
+    def test_room_activity_is_for_participants(self):
+        url = reverse('analytics:room_activity', args=['general']) + '?granularity=day&start=2026-03-01&end=2026-03-04'
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get(url).status_code, 404)
 
-# Create your tests here.
+        self.client.force_login(self.member)
+        self.assertEqual(self.client.get(url).json()['buckets'][0]['messages'], 7)
@@ -0,0 +1,10 @@
+from django.urls import path
+from . import views
+
+app_name = 'analytics'
+
+urlpatterns = [
+    path('api/activity/', views.site_activity, name='site_activity'),
+    path('api/rooms/', views.busiest_rooms, name='busiest_rooms'),
+    path('api/rooms/<str:room_name>/activity/', views.room_activity, name='room_activity'),
+]
@@ -1,3 +1,90 @@
-from django.shortcuts import render
+from datetime import datetime, time, timedelta
 
-# Create your views here.
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib.auth.decorators import login_required
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.views.decorators.http import require_http_methods
+
+from apps.chat.models import ChatRoom
+from . import reports
+
+BUCKET_LENGTH = {'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+DEFAULT_BUCKETS = {'hour': 24, 'day': 30}
+
+
+def parse_moment(value):
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(value)
+        moment = datetime.combine(day, time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def period(request):
+    """``(granularity, start, end)`` from the query string; raises ValueError if invalid"""
+    granularity = request.GET.get('granularity', 'hour')
+    if granularity not in BUCKET_LENGTH:
+        raise ValueError(granularity)
+    length = BUCKET_LENGTH[granularity]
+    end = parse_moment(request.GET['end']) if 'end' in request.GET else timezone.now() + length
+    start = parse_moment(request.GET['start']) if 'start' in request.GET else end - DEFAULT_BUCKETS[granularity] * length
+    if start >= end or (end - start) / length > getattr(settings, 'ANALYTICS_MAX_BUCKETS', 1000):
+        raise ValueError('period')
+    return granularity, start, end
+
+
+@staff_member_required
+@require_http_methods(["GET"])
+def site_activity(request):
+    """API: Messages, active users and peak connections per hour or day"""
+    try:
+        granularity, start, end = period(request)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid period'}, status=400)
+    return JsonResponse({
+        'granularity': granularity,
+        'buckets': reports.site_activity(granularity, start, end),
+        'active_users': reports.active_users(start, end),
+        'status': 'success'
+    })
+
+
+@staff_member_required
+@require_http_methods(["GET"])
+def busiest_rooms(request):
+    """API: The rooms with the most messages over a period of days"""
+    try:
+        _, start, end = period(request)
+        limit = min(max(int(request.GET.get('limit', 10)), 1), 100)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid period'}, status=400)
+    return JsonResponse({
+        'rooms': reports.busiest_rooms(start, end, limit),
+        'status': 'success'
+    })
+
+
+@login_required
+@require_http_methods(["GET"])
+def room_activity(request, room_name):
+    """API: A room's activity per hour or day, for its participants"""
+    room = get_object_or_404(ChatRoom, name=room_name, participants=request.user)
+    try:
+        granularity, start, end = period(request)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid period'}, status=400)
+    return JsonResponse({
+        'room': room.name,
+        'granularity': granularity,
+        'buckets': reports.room_activity(room.id, granularity, start, end),
+        'active_users': reports.active_users(start, end, [room.id]),
+        'status': 'success'
+    })
@@ -0,0 +1,63 @@
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, CursorPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from apps.chat.archive import page_after, page_before
+
+
+class IdCursorPagination(CursorPagination):
+    """Keyset pagination on the primary key, newest first"""
+    ordering = '-id'
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+
+class ContactCursorPagination(IdCursorPagination):
+    ordering = 'contact_user_id'
+
+
+class HistoryPagination(BasePagination):
+    """
+    A room's message payloads newest first, across the hot table and the
+    archive (see apps.chat.archive). ``before`` pages to older messages,
+    ``after`` to newer ones.
+    """
+    page_size = IdCursorPagination.page_size
+    page_size_query_param = 'page_size'
+    max_page_size = IdCursorPagination.max_page_size
+
+    def paginate_history(self, room_id, request):
+        self.request = request
+        try:
+            before = int(request.query_params['before']) if 'before' in request.query_params else None
+            after = int(request.query_params['after']) if 'after' in request.query_params else None
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            raise NotFound('Invalid cursor')
+        size = min(max(size, 1), self.max_page_size)
+
+        if after is not None:
+            payloads, has_newer = page_after(room_id, after, size)
+            has_older = True
+        else:
+            payloads, has_older = page_before(room_id, before, size)
+            has_newer = before is not None
+        self.oldest = payloads[0]['message_id'] if payloads and has_older else None
+        self.newest = payloads[-1]['message_id'] if payloads and has_newer else None
+        return payloads[::-1]
+
+    def link(self, key, value):
+        if value is None:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, 'after' if key == 'before' else 'before')
+        return replace_query_param(url, key, value)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.link('before', self.oldest),
+            'previous': self.link('after', self.newest),
+            'results': data,
+        })
@@ -0,0 +1,13 @@
+from rest_framework import permissions
+
+from apps.chat.models import ChatRoom
+
+
+class IsRoomParticipant(permissions.BasePermission):
+    """Allow access to a room's nested resources only to its participants"""
+    message = 'You are not a participant of this room.'
+
+    def has_permission(self, request, view):
+        return ChatRoom.objects.filter(
+            pk=view.kwargs['room_id'], participants=request.user, is_active=True
+        ).exists()
@@ -0,0 +1,110 @@
+"""
+Read-only serializers for rows produced by ``QuerySet.values()``.
+
+List endpoints fetch exactly the columns they render as dicts and skip
+model instantiation and per-field serializer machinery, which is most
+of the cost of a ``ModelSerializer`` page. Each serializer maps output
+keys to ``values()`` lookups; views pass ``lookups()`` to ``values()``.
+Messages are the exception: their history spans the archive, so they are
+rendered from the same payloads as the chat views.
+"""
+from rest_framework import serializers
+
+from apps.chat.presence import visible_online
+
+
+class ValuesSerializer(serializers.BaseSerializer):
+    fields_map = {}
+
+    @classmethod
+    def lookups(cls):
+        return list(cls.fields_map.values())
+
+    def to_representation(self, row):
+        return {name: row[lookup] for name, lookup in self.fields_map.items()}
+
+
+class RoomSerializer(ValuesSerializer):
+    fields_map = {
+        'id': 'id',
+        'name': 'name',
+        'room_type': 'room_type',
+        'description': 'description',
+        'created_by': 'created_by__username',
+        'created_at': 'created_at',
+        'participants_count': 'participants_count',
+        'unread_count': 'unread_count',
+    }
+    last_message_map = {
+        'id': 'last_message_id',
+        'sender': 'last_message_sender',
+        'message_type': 'last_message_type',
+        'timestamp': 'last_message_timestamp',
+    }
+
+    @classmethod
+    def lookups(cls):
+        return super().lookups() + list(cls.last_message_map.values())
+
+    def to_representation(self, row):
+        data = super().to_representation(row)
+        data['last_message'] = (
+            {name: row[lookup] for name, lookup in self.last_message_map.items()}
+            if row['last_message_id'] is not None else None
+        )
+        return data
+
+
+class RoomDetailSerializer(RoomSerializer):
+    fields_map = {**RoomSerializer.fields_map, 'max_participants': 'max_participants'}
+
+    def to_representation(self, row):
+        data = super().to_representation(row)
+        data['participants'] = row['participants']
+        return data
+
+
+class MessageSerializer(serializers.BaseSerializer):
+    """A message payload (apps.chat.payloads), which archived messages keep too"""
+    def to_representation(self, payload):
+        attachment = payload['attachment'] or {}
+        return {
+            'id': payload['message_id'],
+            'sender_id': payload['sender_id'],
+            'sender_username': payload['sender_username'],
+            'encrypted_content': payload['encrypted_content'],
+            'iv': payload['iv'],
+            'message_type': payload['message_type'],
+            'timestamp': payload['timestamp'],
+            # Payloads archived before these were added lack them
+            'edited_at': payload.get('edited_at'),
+            'is_read': payload['is_read'],
+            'is_edited': payload['is_edited'],
+            'self_destruct': payload['self_destruct'],
+            'destroy_after': payload.get('destroy_after'),
+            'reply_to': payload['reply_to'],
+            'file_name': attachment.get('name'),
+            'file_size': attachment.get('size'),
+            'thumbnails': attachment.get('thumbnails', {}),
+        }
+
+
+class PresenceSerializer(ValuesSerializer):
+    fields_map = {
+        'user_id': 'contact_user_id',
+        'username': 'contact_user__username',
+        'online': 'contact_user__presence__online_status',
+        'last_seen': 'contact_user__presence__last_seen',
+        'show_online_status': 'contact_user__profile__show_online_status',
+    }
+
+    def to_representation(self, row):
+        overlay = self.context.get('overlay', {})
+        online = overlay.get(row['contact_user_id'], row['contact_user__presence__online_status'])
+        visible = row['contact_user__profile__show_online_status'] is not False
+        return {
+            'user_id': row['contact_user_id'],
+            'username': row['contact_user__username'],
+            'online': visible_online(online, row['contact_user__profile__show_online_status']),
+            'last_seen': row['contact_user__presence__last_seen'] if visible else None,
+        }
@@ -1,3 +1,147 @@
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 
-# Create your tests here.
+from apps.chat import archive
+from apps.chat.models import ChatRoom, Contact, Message
+from apps.users.models import CustomUser
+
+
+def make_user(name):
+    return CustomUser.objects.create_user(username=name, email=f'{name}@example.com', password='secret-pass')
+
+
+class ApiTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.client.force_login(self.alice)
+
+    def make_room(self, name, *users):
+        room = ChatRoom.objects.create(name=name, room_type='group', created_by=self.alice)
+        room.participants.add(self.alice, *users)
+        return room
+
+    def app_queries(self, url, **headers):
+        """GET url, returning the response and the queries not spent on the session"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, headers=headers)
+        statements = [
+            query['sql'] for query in queries.captured_queries
+            if 'django_session' not in query['sql'] and 'SAVEPOINT' not in query['sql']
+        ]
+        return response, statements
+
+
+class RoomApiTests(ApiTestCase):
+    def test_room_list_query_count_is_constant(self):
+        for i in range(20):
+            room = self.make_room(f'room{i}', self.bob)
+            Message.objects.create(room=room, sender=self.bob, encrypted_content=f'c{i}', iv='')
+        self.make_room('elsewhere').participants.remove(self.alice)
+
+        response, statements = self.app_queries(reverse('api:room_list', args=['v1']))
+        self.assertEqual(response.status_code, 200)
+        rooms = response.json()['results']
+        self.assertEqual(len(rooms), 20)
+        self.assertEqual(rooms[0]['name'], 'room19')
+        self.assertEqual(rooms[0]['participants_count'], 2)
+        self.assertEqual(rooms[0]['unread_count'], 1)
+        self.assertEqual(rooms[0]['last_message']['sender'], 'bob')
+        # The user, then one query for the page
+        self.assertEqual(len(statements), 2)
+
+    def test_room_detail_lists_participants(self):
+        room = self.make_room('general', self.bob)
+        response = self.client.get(reverse('api:room_detail', args=['v1', room.id]))
+        self.assertEqual([p['username'] for p in response.json()['participants']], ['alice', 'bob'])
+        self.assertIsNone(response.json()['last_message'])
+
+        other = ChatRoom.objects.create(name='private', created_by=self.bob)
+        response = self.client.get(reverse('api:room_detail', args=['v1', other.id]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_unknown_version_is_rejected(self):
+        self.assertEqual(self.client.get(reverse('api:room_list', args=['v9'])).status_code, 404)
+
+    def test_requires_login(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('api:room_list', args=['v1'])).status_code, 403)
+
+
+class MessageApiTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.room = self.make_room('general', self.bob)
+        self.messages = [
+            Message.objects.create(room=self.room, sender=self.bob, encrypted_content=f'c{i}', iv='')
+            for i in range(7)
+        ]
+        self.url = reverse('api:message_list', args=['v1', self.room.id])
+
+    def test_cursor_pages_walk_newest_first(self):
+        seen = []
+        url = f'{self.url}?page_size=3'
+        while url:
+            page = self.client.get(url).json()
+            seen.extend(message['id'] for message in page['results'])
+            url = page['next']
+        self.assertEqual(seen, [message.id for message in reversed(self.messages)])
+
+    def test_page_query_count_is_constant(self):
+        response, statements = self.app_queries(self.url)
+        self.assertEqual(response.json()['results'][0]['sender_username'], 'bob')
+        # The user, the participant check, the page, then the archive blocks it reaches
+        self.assertEqual(len(statements), 4)
+
+    def test_pages_continue_into_the_archive(self):
+        Message.objects.update(is_read=True)
+        self.assertEqual(archive.archive_messages(after_days=None, keep_recent=3), 4)
+
+        seen, url = [], f'{self.url}?page_size=3'
+        while url:
+            page = self.client.get(url).json()
+            seen.extend(message['id'] for message in page['results'])
+            url = page['next']
+        self.assertEqual(seen, [message.id for message in reversed(self.messages)])
+
+        previous = self.client.get(page['previous']).json()
+        self.assertEqual([message['id'] for message in previous['results']], [m.id for m in self.messages[3:0:-1]])
+
+    def test_non_participant_is_forbidden(self):
+        self.client.force_login(make_user('mallory'))
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_etag_answers_not_modified(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        self.assertEqual(self.client.get(self.url, headers={'if-none-match': etag}).status_code, 304)
+
+        Message.objects.create(room=self.room, sender=self.bob, encrypted_content='new', iv='')
+        self.assertEqual(self.client.get(self.url, headers={'if-none-match': etag}).status_code, 200)
+
+
+class ContactApiTests(ApiTestCase):
+    def test_contacts_and_presence(self):
+        carol = make_user('carol')
+        Contact.objects.create(user=self.alice, contact_user=self.bob)
+        Contact.objects.create(user=self.alice, contact_user=carol)
+        self.bob.presence.online_status = True
+        self.bob.presence.save()
+        carol.presence.online_status = True
+        carol.presence.save()
+        carol.profile.show_online_status = False
+        carol.profile.save()
+
+        response, statements = self.app_queries(reverse('api:contact_list', args=['v1']))
+        contacts = {contact['username']: contact['online'] for contact in response.json()['results']}
+        self.assertEqual(contacts, {'bob': True, 'carol': False})
+        self.assertEqual(len(statements), 2)
+
+        presence = self.client.get(reverse('api:presence_list', args=['v1'])).json()['results']
+        self.assertEqual([row['online'] for row in presence], [True, False])
+        self.assertIsNotNone(presence[0]['last_seen'])
+        self.assertIsNone(presence[1]['last_seen'])
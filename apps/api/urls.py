@@ -0,0 +1,13 @@
+from django.urls import path
+from . import views
+
+app_name = 'api'
+
+# The version segment is read by DRF's URLPathVersioning
+urlpatterns = [
+    path('<str:version>/rooms/', views.RoomList.as_view(), name='room_list'),
+    path('<str:version>/rooms/<int:pk>/', views.RoomDetail.as_view(), name='room_detail'),
+    path('<str:version>/rooms/<int:room_id>/messages/', views.MessageList.as_view(), name='message_list'),
+    path('<str:version>/contacts/', views.ContactList.as_view(), name='contact_list'),
+    path('<str:version>/presence/', views.PresenceList.as_view(), name='presence_list'),
+]
@@ -1,3 +1,97 @@
-from django.shortcuts import render
+from django.db.models import F
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response, set_response_etag
+from rest_framework import generics
 
-# Create your views here.
+from apps.chat.models import Contact
+from apps.chat.presence import cached_presence, contact_values, present_contacts
+from apps.chat.rooms import Participant, rooms_for, with_summary
+from .pagination import ContactCursorPagination, HistoryPagination, IdCursorPagination
+from .permissions import IsRoomParticipant
+from .serializers import MessageSerializer, PresenceSerializer, RoomDetailSerializer, RoomSerializer
+
+
+class ConditionalGetMixin:
+    """
+    Send an ETag of the rendered body with every successful GET and answer
+    a matching If-None-Match with 304, so polling clients skip the payload.
+    """
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if request.method not in ('GET', 'HEAD') or response.status_code != 200:
+            return response
+        response.render()
+        set_response_etag(response)
+        return get_conditional_response(request, etag=response.get('ETag'), response=response)
+
+
+class ValuesListView(ConditionalGetMixin, generics.ListAPIView):
+    """List endpoint over ``values()`` rows shaped by ``serializer_class.lookups()``"""
+    pagination_class = IdCursorPagination
+
+    def get_queryset(self):
+        return self.get_base_queryset().values(*self.serializer_class.lookups())
+
+
+class RoomQuerysetMixin:
+    def get_base_queryset(self):
+        return with_summary(rooms_for(self.request.user), self.request.user)
+
+
+class RoomList(RoomQuerysetMixin, ValuesListView):
+    """Rooms the user takes part in, with counts and the latest message"""
+    serializer_class = RoomSerializer
+
+
+class RoomDetail(RoomQuerysetMixin, ConditionalGetMixin, generics.RetrieveAPIView):
+    """One room, with its participants"""
+    serializer_class = RoomDetailSerializer
+
+    def get_object(self):
+        row = get_object_or_404(
+            self.get_base_queryset().values(*self.serializer_class.lookups()), pk=self.kwargs['pk']
+        )
+        row['participants'] = list(
+            Participant.objects.filter(chatroom_id=row['id'])
+            .order_by('customuser__username')
+            .values(user_id=F('customuser_id'), username=F('customuser__username'))
+        )
+        return row
+
+
+class MessageList(ConditionalGetMixin, generics.ListAPIView):
+    """Messages of one room, newest first, archived ones included"""
+    serializer_class = MessageSerializer
+    pagination_class = HistoryPagination
+    permission_classes = generics.ListAPIView.permission_classes + [IsRoomParticipant]
+
+    def list(self, request, *args, **kwargs):
+        page = self.paginator.paginate_history(self.kwargs['room_id'], request)
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+
+class ContactList(ConditionalGetMixin, generics.ListAPIView):
+    """The user's unblocked contacts with their visible online status"""
+    pagination_class = ContactCursorPagination
+
+    def get_queryset(self):
+        return contact_values(self.request.user)
+
+    def list(self, request, *args, **kwargs):
+        page = self.paginate_queryset(self.get_queryset())
+        return self.get_paginated_response(present_contacts(page))
+
+
+class PresenceList(ValuesListView):
+    """Online status and last-seen time of the user's contacts"""
+    serializer_class = PresenceSerializer
+    pagination_class = ContactCursorPagination
+
+    def get_base_queryset(self):
+        return Contact.objects.filter(user=self.request.user, is_blocked=False)
+
+    def list(self, request, *args, **kwargs):
+        page = self.paginate_queryset(self.get_queryset())
+        overlay = cached_presence([row['contact_user_id'] for row in page])
+        serializer = self.get_serializer(page, many=True, context={'overlay': overlay})
+        return self.get_paginated_response(serializer.data)
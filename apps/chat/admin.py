@@ -1,6 +1,6 @@
 # apps/chat/admin.py
 from django.contrib import admin
-from .models import ChatRoom, Message, Contact, UserPresence
+from .models import ChatRoom, Message, MessageArchive, Contact, UserPresence
 
 @admin.register(ChatRoom)
 class ChatRoomAdmin(admin.ModelAdmin):
@@ -11,9 +11,16 @@ class ChatRoomAdmin(admin.ModelAdmin):
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
     list_display = ('room', 'sender', 'message_type', 'timestamp', 'is_read', 'is_deleted')
-    search_fields = ('sender__username', 'room__name', 'encrypted_content')
+    # encrypted_content is ciphertext; use the chat search API to find messages by content
+    search_fields = ('sender__username', 'room__name')
     list_filter = ('is_read', 'is_deleted', 'message_type')
 
+@admin.register(MessageArchive)
+class MessageArchiveAdmin(admin.ModelAdmin):
+    list_display = ('room', 'first_id', 'last_id', 'first_timestamp', 'last_timestamp', 'message_count', 'codec')
+    search_fields = ('room__name',)
+    exclude = ('data',)
+
 @admin.register(Contact)
 class ContactAdmin(admin.ModelAdmin):
     list_display = ('user', 'contact_user', 'nickname', 'is_blocked')
@@ -0,0 +1,205 @@
+"""
+Hot/cold message storage.
+
+``chat_messages`` holds recent messages. ``archive_messages`` moves older
+ones into ``MessageArchive`` blocks: the client payloads of up to
+``CHAT_ARCHIVE_BLOCK_SIZE`` messages of one room, compressed together. A
+message is due once it is older than ``CHAT_ARCHIVE_AFTER_DAYS`` or beyond
+the newest ``CHAT_ARCHIVE_KEEP_RECENT`` of its room (None disables either
+rule). Only settled messages move: read, not deleted or self-destructing,
+without an attachment, not the room's latest message and not the target
+of a reply that stays behind. Archived messages can no longer be edited
+or found by search.
+
+``page_before`` and ``page_after`` read a room's history across both
+tiers, so readers do not need to know where a message is stored.
+"""
+import json
+import zlib
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import ChatRoom, Message, MessageArchive, MessageToken, PendingNotification
+from .payloads import PAYLOAD_RELATED, serialize_message
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImproperlyConfigured("Archive codec 'zstd' needs the zstandard package (pip install zstandard)")
+    return zstandard
+
+
+def compress(payloads, codec):
+    data = json.dumps(payloads, separators=(',', ':')).encode()
+    if codec == 'zlib':
+        return zlib.compress(data, 9)
+    if codec == 'zstd':
+        return _zstandard().ZstdCompressor(level=10).compress(data)
+    raise ImproperlyConfigured(f"Unknown archive codec {codec!r}")
+
+
+def decompress(data, codec):
+    data = bytes(data)
+    if codec == 'zlib':
+        return json.loads(zlib.decompress(data))
+    if codec == 'zstd':
+        return json.loads(_zstandard().ZstdDecompressor().decompress(data))
+    raise ImproperlyConfigured(f"Unknown archive codec {codec!r}")
+
+
+def archivable(room_id, last_message_id, now=None, after_days=None, keep_recent=None):
+    """The messages of a room that are due to be archived"""
+    rules = []
+    if after_days is not None:
+        rules.append(Q(timestamp__lt=(now or timezone.now()) - timedelta(days=after_days)))
+    if keep_recent is not None:
+        boundary = list(
+            Message.objects.filter(room_id=room_id).order_by('-id')
+            .values_list('id', flat=True)[keep_recent:keep_recent + 1]
+        )
+        if boundary:
+            rules.append(Q(pk__lte=boundary[0]))
+    if not rules:
+        return Message.objects.none()
+
+    return Message.objects.filter(
+        reduce(or_, rules),
+        Q(file_attachment__isnull=True) | Q(file_attachment=''),
+        room_id=room_id,
+        is_deleted=False,
+        is_read=True,
+        self_destruct=False,
+    ).exclude(pk=last_message_id)
+
+
+def archive_room(room_id, last_message_id, now=None, after_days=None, keep_recent=None):
+    """Move a room's due messages into archive blocks; returns how many moved"""
+    block_size = getattr(settings, 'CHAT_ARCHIVE_BLOCK_SIZE', 500)
+    codec = getattr(settings, 'CHAT_ARCHIVE_CODEC', 'zlib')
+    due = archivable(room_id, last_message_id, now, after_days, keep_recent)
+    archived = 0
+    cursor = 0
+    while True:
+        ids = list(due.filter(pk__gt=cursor).order_by('id').values_list('id', flat=True)[:block_size])
+        if not ids:
+            return archived
+        cursor = ids[-1]
+
+        with transaction.atomic():
+            messages = list(
+                due.filter(pk__in=ids).select_related(*PAYLOAD_RELATED)
+                .select_for_update(of=('self',)).order_by('id')
+            )
+            # Replies left in the hot table keep the messages they quote there
+            quoted = set(
+                Message.objects.filter(reply_to_id__in=ids).exclude(pk__in=ids)
+                .values_list('reply_to_id', flat=True)
+            )
+            messages = [message for message in messages if message.id not in quoted]
+            if not messages:
+                continue
+
+            MessageArchive.objects.create(
+                room_id=room_id,
+                first_id=messages[0].id,
+                last_id=messages[-1].id,
+                first_timestamp=messages[0].timestamp,
+                last_timestamp=messages[-1].timestamp,
+                message_count=len(messages),
+                codec=codec,
+                data=compress([serialize_message(message) for message in messages], codec),
+            )
+            moved = [message.id for message in messages]
+            MessageToken.objects.filter(message_id__in=moved).delete()
+            PendingNotification.objects.filter(message_id__in=moved).delete()
+            # A plain DELETE: the delete signals would announce the messages
+            # as deleted to clients, but they are only moving
+            Message.objects.filter(pk__in=moved)._raw_delete(Message.objects.db)
+            archived += len(moved)
+
+
+def archive_messages(now=None, after_days=None, keep_recent=None):
+    """
+    Archive the due messages of every room, with the thresholds from the
+    settings unless given. Returns the number of messages moved.
+    """
+    if after_days is None:
+        after_days = getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', None)
+    if keep_recent is None:
+        keep_recent = getattr(settings, 'CHAT_ARCHIVE_KEEP_RECENT', None)
+    now = now or timezone.now()
+    return sum(
+        archive_room(room_id, last_message_id, now, after_days, keep_recent)
+        for room_id, last_message_id in ChatRoom.objects.values_list('id', 'last_message_id').iterator()
+    )
+
+
+def _archived(room_id, limit, lower=None, upper=None, newest=True):
+    """
+    Up to ``limit`` archived payloads of a room with ids strictly between
+    ``lower`` and ``upper``, from the newest (or oldest) end.
+    """
+    blocks = MessageArchive.objects.filter(room_id=room_id)
+    if lower is not None:
+        blocks = blocks.filter(last_id__gt=lower)
+    if upper is not None:
+        blocks = blocks.filter(first_id__lt=upper)
+
+    found = []
+    for block in blocks.order_by('-last_id' if newest else 'first_id').iterator():
+        # Blocks can overlap, so stop only once no later block can hold a closer id
+        if len(found) >= limit:
+            edge = found[limit - 1]['message_id']
+            if (block.last_id < edge) if newest else (block.first_id > edge):
+                break
+        found.extend(
+            payload for payload in decompress(block.data, block.codec)
+            if (lower is None or payload['message_id'] > lower)
+            and (upper is None or payload['message_id'] < upper)
+        )
+        found.sort(key=lambda payload: payload['message_id'], reverse=newest)
+    return found[:limit]
+
+
+def page_before(room_id, before, limit):
+    """
+    The newest ``limit`` live messages of a room with ids below ``before``
+    (None for the latest), oldest first, and whether older ones exist.
+    """
+    hot = Message.objects.filter(room_id=room_id, is_deleted=False)
+    if before is not None:
+        hot = hot.filter(pk__lt=before)
+    payloads = [
+        serialize_message(message)
+        for message in hot.select_related(*PAYLOAD_RELATED).order_by('-id')[:limit + 1]
+    ]
+    # With a full hot page, only archived messages newer than its end matter
+    lower = payloads[-1]['message_id'] if len(payloads) > limit else None
+    payloads += _archived(room_id, limit + 1, lower=lower, upper=before, newest=True)
+    payloads.sort(key=lambda payload: payload['message_id'], reverse=True)
+    return payloads[:limit][::-1], len(payloads) > limit
+
+
+def page_after(room_id, after, limit):
+    """
+    The oldest ``limit`` live messages of a room with ids above ``after``,
+    oldest first, and whether newer ones exist.
+    """
+    hot = Message.objects.filter(room_id=room_id, is_deleted=False, pk__gt=after)
+    payloads = [
+        serialize_message(message)
+        for message in hot.select_related(*PAYLOAD_RELATED).order_by('id')[:limit + 1]
+    ]
+    upper = payloads[-1]['message_id'] if len(payloads) > limit else None
+    payloads += _archived(room_id, limit + 1, lower=after, upper=upper, newest=False)
+    payloads.sort(key=lambda payload: payload['message_id'])
+    return payloads[:limit], len(payloads) > limit
@@ -0,0 +1,275 @@
+"""
+Chunked, resumable, encrypted file attachments.
+
+Protocol (all under ``chat/api/``):
+
+``POST uploads/`` with JSON ``room_name``, ``file_name``, ``file_size`` and
+``content_type`` opens an upload and returns its id, ``segment_size`` and
+``offset``. ``PATCH uploads/<id>/`` sends raw bytes starting at the
+``Upload-Offset`` header; every chunk but the last must be a whole number
+of segments. ``HEAD uploads/<id>/`` reports the committed offset, so an
+interrupted client resumes from there. The chunk that completes the file
+creates the file message. ``GET attachments/<message id>/`` streams the
+decrypted file and honours single ``Range`` requests. Image uploads also
+get encrypted previews, generated by a background task.
+
+Files are written as ``SegmentCipher`` segments with a fixed stride, so
+both directions handle one segment at a time and never hold a whole file
+in memory, and any byte range maps straight to the segments holding it.
+"""
+import hashlib
+import os
+from functools import lru_cache
+
+from django.conf import settings
+from django.urls import reverse
+from django.utils import timezone
+
+from apps.users.thumbnails import content_hash, render_thumbnails
+from .encryption import SegmentCipher
+from .models import AttachmentUpload, Message
+from .notifications import queue_notifications
+from Crypto.Random import get_random_bytes
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+@lru_cache(maxsize=4)
+def _derive_key(secret):
+    return hashlib.sha256(b'ciphertalk.chat.attachments:' + secret.encode()).digest()
+
+
+def master_key():
+    return _derive_key(getattr(settings, 'CHAT_ATTACHMENT_KEY', '') or settings.SECRET_KEY)
+
+
+def storage_name(upload_id):
+    return f'chat_attachments/{upload_id}.enc'
+
+
+def storage_path(upload_id):
+    return os.path.join(settings.MEDIA_ROOT, storage_name(upload_id))
+
+
+def thumbnail_path(upload_id, size):
+    return os.path.join(settings.MEDIA_ROOT, f'chat_attachments/{upload_id}-{size}.enc')
+
+
+def file_key(upload):
+    key_cipher = SegmentCipher(master_key(), f'key:{upload.id}')
+    return key_cipher.open(0, bytes.fromhex(upload.wrapped_key), last=True)
+
+
+def file_cipher(upload):
+    return SegmentCipher(file_key(upload), str(upload.id))
+
+
+def thumbnail_cipher(upload, size):
+    return SegmentCipher(file_key(upload), f'{upload.id}:thumbnail:{size}')
+
+
+def segment_count(upload):
+    return -(-upload.file_size // upload.segment_size)
+
+
+# Types a browser can only render as a picture; anything else (SVG, HTML, ...)
+# could run script on this origin, so it is stored and served as a download
+INLINE_IMAGE_TYPES = ('image/png', 'image/jpeg', 'image/gif', 'image/webp')
+DOWNLOAD_TYPE = 'application/octet-stream'
+
+
+def safe_content_type(content_type):
+    """The declared type if it is a raster image type, else a plain download"""
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    return content_type if content_type in INLINE_IMAGE_TYPES else DOWNLOAD_TYPE
+
+
+def start_upload(room, user, file_name, file_size, content_type=''):
+    max_size = getattr(settings, 'CHAT_ATTACHMENT_MAX_SIZE', 1024 ** 3)
+    if not file_name or not isinstance(file_size, int) or file_size <= 0:
+        raise UploadError('file_name and a positive file_size are required')
+    if file_size > max_size:
+        raise UploadError(f'Attachments are limited to {max_size} bytes', status=413)
+
+    upload = AttachmentUpload(
+        room=room,
+        uploader=user,
+        file_name=os.path.basename(file_name)[:255],
+        content_type=safe_content_type(content_type),
+        file_size=file_size,
+        segment_size=getattr(settings, 'CHAT_ATTACHMENT_SEGMENT_SIZE', 64 * 1024),
+    )
+    key_cipher = SegmentCipher(master_key(), f'key:{upload.id}')
+    upload.wrapped_key = key_cipher.seal(0, get_random_bytes(32), last=True).hex()
+    upload.save()
+    os.makedirs(os.path.dirname(storage_path(upload.id)), exist_ok=True)
+    return upload
+
+
+def _read_exactly(stream, size):
+    parts = []
+    while size:
+        data = stream.read(size)
+        if not data:
+            break
+        parts.append(data)
+        size -= len(data)
+    return b''.join(parts)
+
+
+def write_chunk(upload, offset, length, stream):
+    """
+    Encrypt ``length`` bytes from ``stream`` into the upload at ``offset``.
+    Whole segments are committed even if the client disconnects mid-chunk;
+    the returned offset (also saved on ``upload``) is where to resume.
+    Callers hold the upload row locked (``select_for_update``) throughout.
+    """
+    if upload.is_complete:
+        raise UploadError('Upload is already complete', status=409)
+    if offset != upload.received:
+        raise UploadError(f'Expected offset {upload.received}', status=409)
+    end = offset + length
+    if length <= 0 or end > upload.file_size:
+        raise UploadError('Chunk does not fit the declared file size', status=416)
+    if end != upload.file_size and length % upload.segment_size:
+        raise UploadError(f'Chunks must be multiples of {upload.segment_size} bytes')
+
+    cipher = file_cipher(upload)
+    count = segment_count(upload)
+    index = offset // upload.segment_size
+    stride = upload.segment_size + SegmentCipher.OVERHEAD
+    path = storage_path(upload.id)
+    try:
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+            f.seek(index * stride)
+            while upload.received < end:
+                size = min(upload.segment_size, end - upload.received)
+                plaintext = _read_exactly(stream, size)
+                if len(plaintext) < size:
+                    raise UploadError('Chunk ended early; resume from the returned offset')
+                f.write(cipher.seal(index, plaintext, last=index == count - 1))
+                upload.received += size
+                index += 1
+            f.truncate()
+    finally:
+        upload.save(update_fields=['received'])
+    return upload.received
+
+
+def complete_upload(upload):
+    """Attach a fully received upload to a new file message"""
+    message_type = 'image' if upload.content_type in INLINE_IMAGE_TYPES else 'file'
+    message = Message.objects.create(
+        room=upload.room,
+        sender=upload.uploader,
+        encrypted_content='',
+        iv='',
+        message_type=message_type,
+        file_attachment=storage_name(upload.id),
+        file_name=upload.file_name,
+        file_size=upload.file_size,
+    )
+    upload.message = message
+    upload.completed_at = timezone.now()
+    upload.save(update_fields=['message', 'completed_at'])
+    queue_notifications([message])
+    return message
+
+
+def parse_range(header, size):
+    """
+    ``(start, end)`` (inclusive) of a single ``bytes=`` range, or None to
+    send the whole file. Raises UploadError(416) if it cannot be satisfied.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[len('bytes='):].strip().partition('-')
+    try:
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            start, end = max(size - int(last), 0), size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise UploadError('Range not satisfiable', status=416)
+    return start, end
+
+
+def iter_plaintext(upload, start=0, end=None):
+    """Decrypt bytes ``start``..``end`` (inclusive), one segment at a time"""
+    end = upload.file_size - 1 if end is None else end
+    cipher = file_cipher(upload)
+    count = segment_count(upload)
+    stride = upload.segment_size + SegmentCipher.OVERHEAD
+    first, last = start // upload.segment_size, end // upload.segment_size
+    with open(storage_path(upload.id), 'rb') as f:
+        f.seek(first * stride)
+        for index in range(first, last + 1):
+            plaintext = cipher.open(index, f.read(stride), last=index == count - 1)
+            segment_start = index * upload.segment_size
+            yield plaintext[max(start - segment_start, 0):end - segment_start + 1]
+
+
+def make_thumbnails(upload):
+    """Store encrypted previews of an image upload and record their hashes"""
+    if upload.file_size > getattr(settings, 'THUMBNAIL_MAX_SOURCE_SIZE', 32 * 1024 * 1024):
+        return {}
+    sizes = getattr(settings, 'CHAT_IMAGE_THUMBNAIL_SIZES', (320, 960))
+    thumbnails = {}
+    for size, data in render_thumbnails(b''.join(iter_plaintext(upload)), sizes).items():
+        with open(thumbnail_path(upload.id, size), 'wb') as f:
+            f.write(thumbnail_cipher(upload, size).seal(0, data, last=True))
+        thumbnails[str(size)] = content_hash(data)
+    AttachmentUpload.objects.filter(pk=upload.pk).update(thumbnails=thumbnails)
+    upload.thumbnails = thumbnails
+    return thumbnails
+
+
+def read_thumbnail(upload, size):
+    with open(thumbnail_path(upload.id, size), 'rb') as f:
+        return thumbnail_cipher(upload, size).open(0, f.read(), last=True)
+
+
+def thumbnail_urls(message_id, thumbnails):
+    """Map size -> preview URL, smallest first; the URLs change with the content"""
+    return {
+        size: reverse('chat:attachment_thumbnail', args=[message_id, int(size), digest])
+        for size, digest in sorted((thumbnails or {}).items(), key=lambda item: int(item[0]))
+    }
+
+
+def describe(message):
+    """The ``attachment`` entry of the payload of a file message"""
+    try:
+        upload = message.upload
+    except AttachmentUpload.DoesNotExist:
+        upload = None
+    if upload is None:
+        # Files attached before uploads were encrypted are plain media files
+        url, thumbnails = message.file_attachment.url, {}
+    else:
+        url = reverse('chat:download_attachment', args=[message.id])
+        thumbnails = thumbnail_urls(message.id, upload.thumbnails)
+    return {
+        'name': message.file_name,
+        'size': message.file_size,
+        'url': url,
+        'preview': next(iter(thumbnails.values()), None),
+        'thumbnails': thumbnails,
+    }
+
+
+def discard_upload(upload):
+    paths = [storage_path(upload.id)] + [thumbnail_path(upload.id, size) for size in upload.thumbnails]
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    upload.delete()
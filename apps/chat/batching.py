@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+
+from .models import ChatRoom, Message
+from .history import message_history
+from . import notifications, search
+
+logger = logging.getLogger(__name__)
+
+
+class GroupCommitWriter:
+    """
+    Group-commit writer for chat messages.
+
+    Consumers hand unsaved ``Message`` instances to ``submit`` and await
+    them. A single worker thread drains the queue for up to ``window_ms``
+    after the first message arrives (or until ``max_batch`` messages are
+    waiting) and inserts the whole batch with one ``bulk_create`` inside
+    one transaction, so a burst costs one commit instead of one per
+    message. The queue is FIFO and the batch is inserted in order, so
+    messages keep their per-room order and ids. If the batch fails, its
+    messages are retried one at a time so only the bad one's sender sees
+    the error.
+    """
+    def __init__(self, window_ms=None, max_batch=None, enabled=None):
+        self.window = (window_ms if window_ms is not None
+                       else getattr(settings, 'CHAT_GROUP_COMMIT_WINDOW_MS', 5)) / 1000
+        self.max_batch = max_batch or getattr(settings, 'CHAT_GROUP_COMMIT_MAX_BATCH', 200)
+        self.enabled = enabled if enabled is not None else getattr(settings, 'CHAT_GROUP_COMMIT', False)
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    async def submit(self, message):
+        """Queue a message for the next batch and wait until it is committed"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._ensure_started()
+        self._queue.put((message, loop, future))
+        return await future
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='chat-group-commit', daemon=True
+                )
+                self._thread.start()
+
+    def stop(self):
+        """Flush what is queued and let the worker thread exit"""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        running = True
+        while running:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        item = self._queue.get(timeout=remaining)
+                    else:
+                        item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            self._flush(batch)
+        connection.close()
+
+    def _flush(self, batch):
+        messages = [message for message, _, _ in batch]
+        close_old_connections()
+        try:
+            self._commit(messages)
+        except Exception as e:
+            for message in messages:
+                _reset(message)
+            if len(batch) == 1:
+                logger.exception("Group commit of 1 message failed")
+                _, loop, future = batch[0]
+                loop.call_soon_threadsafe(_resolve, future, None, e)
+                return
+            # One bad message rolls back the batch; commit each on its own so
+            # only that sender gets the error
+            logger.warning("Group commit of %d messages failed, retrying one by one", len(batch))
+            for item in batch:
+                self._flush([item])
+            return
+
+        for room_id in {message.room_id for message in messages}:
+            message_history.invalidate(room_id)
+        for message, loop, future in batch:
+            loop.call_soon_threadsafe(_resolve, future, message, None)
+
+    def _commit(self, messages):
+        with transaction.atomic():
+            if connection.features.can_return_rows_from_bulk_insert:
+                Message.objects.bulk_create(messages)
+            else:
+                for message in messages:
+                    message.save(force_insert=True)
+            search.index_messages(messages)
+            notifications.queue_notifications(messages)
+            # bulk_create skips post_save, so move the room versions here
+            last_ids = {}
+            for message in messages:
+                last_ids[message.room_id] = max(message.id, last_ids.get(message.room_id, 0))
+            for room_id, last_message_id in last_ids.items():
+                ChatRoom.bump_version([room_id], last_message_id=last_message_id)
+
+
+def _reset(message):
+    """Forget the id a rolled-back insert gave the message"""
+    message.pk = None
+    message._state.adding = True
+    message._state.db = None
+
+
+def _resolve(future, result, error):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+# Global instance
+group_commit_writer = GroupCommitWriter()
@@ -0,0 +1,111 @@
+"""
+Shared helpers for the chat benchmark management commands.
+"""
+import json
+import math
+import os
+import resource
+import uuid
+from contextlib import contextmanager
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+
+from apps.users.models import CustomUser
+from .models import ChatRoom
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize_ms(seconds):
+    """Latency summary, in milliseconds, of a list of durations in seconds"""
+    if not seconds:
+        return {'count': 0}
+    return {
+        'count': len(seconds),
+        'mean': round(sum(seconds) / len(seconds) * 1000, 3),
+        'p50': round(percentile(seconds, 50) * 1000, 3),
+        'p90': round(percentile(seconds, 90) * 1000, 3),
+        'p99': round(percentile(seconds, 99) * 1000, 3),
+        'max': round(max(seconds) * 1000, 3),
+    }
+
+
+def process_usage(pid=None):
+    """CPU seconds and RSS (MiB) of this process, or of ``pid`` via /proc"""
+    if pid is None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {
+            'cpu_s': round(usage.ru_utime + usage.ru_stime, 3),
+            'max_rss_mib': round(usage.ru_maxrss / 1024, 1),
+        }
+
+    with open(f'/proc/{pid}/stat') as handle:
+        fields = handle.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    with open(f'/proc/{pid}/status') as handle:
+        status = dict(line.split(':', 1) for line in handle if ':' in line)
+    return {
+        'cpu_s': round((int(fields[11]) + int(fields[12])) / ticks, 3),
+        'max_rss_mib': round(int(status['VmHWM'].split()[0]) / 1024, 1),
+    }
+
+
+def session_cookie(user):
+    """Log ``user`` in on a fresh session and return the Cookie header value"""
+    engine = import_module(settings.SESSION_ENGINE)
+    session = engine.SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+    return f'{settings.SESSION_COOKIE_NAME}={session.session_key}'
+
+
+@contextmanager
+def bench_fixtures(users=1, rooms=1):
+    """
+    Create throwaway users and rooms (every user joins every room) and
+    delete them, with their messages, afterwards.
+    """
+    tag = uuid.uuid4().hex[:8]
+    created_users = [
+        CustomUser.objects.create_user(
+            username=f'bench_{tag}_{i}',
+            email=f'bench_{tag}_{i}@bench.invalid',
+            password=None,
+        )
+        for i in range(users)
+    ]
+    created_rooms = []
+    for i in range(rooms):
+        room = ChatRoom.objects.create(
+            name=f'bench_{tag}_room_{i}',
+            room_type='group',
+            created_by=created_users[0],
+            max_participants=users,
+        )
+        room.participants.add(*created_users)
+        created_rooms.append(room)
+    try:
+        yield created_users, created_rooms
+    finally:
+        ChatRoom.objects.filter(pk__in=[room.pk for room in created_rooms]).delete()
+        CustomUser.objects.filter(pk__in=[user.pk for user in created_users]).delete()
+
+
+def write_report(command, report, json_path=None):
+    """Print a benchmark report and optionally save it as JSON"""
+    command.stdout.write(json.dumps(report, indent=2))
+    if json_path:
+        with open(json_path, 'w') as handle:
+            json.dump(report, handle, indent=2)
+        command.stdout.write(command.style.SUCCESS(f'Report written to {json_path}'))
@@ -1,16 +1,89 @@
-import json
 import urllib.parse
 import asyncio
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
 from asgiref.sync import sync_to_async
 from django.utils import timezone
-from .models import ChatRoom, Message, UserPresence
+from django.conf import settings
+from .models import Message
 from .encryption import encryption_manager
+from . import search
+from .framing import FramedConsumerMixin
+from .history import message_history, serialize_message
+from .batching import group_commit_writer
+from .store import chat_store
+from apps.analytics.connections import connection_closed, connection_opened
+from apps.monitoring.profiling import ProfiledConsumerMixin
+from apps.monitoring.metrics import (
+    MESSAGE_DB_SECONDS, WS_CONNECTIONS, WS_CONNECTS, WS_DELIVERIES, WS_EVENT_SECONDS, WS_GROUP_SENDS,
+)
 
 print("🚨 CHAT CONSUMER MODULE LOADED - FILE IS EXECUTING!")
 
-class ChatConsumer(AsyncWebsocketConsumer):
+CLIENT_EVENTS = ('chat_message', 'typing_start', 'typing_stop', 'message_read')
+
+
+def event_payload(event):
+    """A group event's message payload, without the routing keys"""
+    return {key: value for key, value in event.items() if key not in ('type', 'room')}
+
+
+def chat_message_frame(payload, replayed=False):
+    """The client frame for a chat message payload"""
+    return {
+        'type': 'chat_message',
+        'message_id': payload['message_id'],
+        'sender_id': payload['sender_id'],
+        'sender_username': payload['sender_username'],
+        'encrypted_content': payload['encrypted_content'],
+        'iv': payload['iv'],
+        'message_type': payload['message_type'],
+        'timestamp': payload['timestamp'],
+        'is_read': payload.get('is_read', False),
+        'reply_to': payload.get('reply_to'),
+        'self_destruct': payload.get('self_destruct', False),
+        'replayed': replayed,
+    }
+
+
+def build_message(room, user, content, reply_to, self_destruct, destroy_minutes):
+    # Encrypt message
+    encryption_result = encryption_manager.aes_cipher.encrypt(content)
+
+    # Calculate destroy time if self-destruct is enabled
+    destroy_after = None
+    if self_destruct and destroy_minutes > 0:
+        destroy_after = timezone.now() + timezone.timedelta(minutes=destroy_minutes)
+
+    message = Message(
+        room=room,
+        sender=user,
+        encrypted_content=encryption_result,
+        iv='',  # IV is included in the encrypted_content
+        reply_to=reply_to,
+        self_destruct=self_destruct,
+        destroy_after=destroy_after,
+    )
+    # Search tokens are derived here, while the plaintext is still at hand
+    return search.prepare(message, content)
+
+
+async def save_chat_message(store, message, sender_username):
+    """Store a built message and record it in the room's history; returns its payload"""
+    if group_commit_writer.enabled:
+        # Hand the insert to the group-commit writer
+        await group_commit_writer.submit(message)
+        payload = serialize_message(message, sender_username=sender_username)
+        message_history.append(message.room_id, payload)
+    else:
+        await store.save_message(message)
+        payload = serialize_message(message, sender_username=sender_username)
+        message_history.record(message.room_id, payload)
+    return payload
+
+
+class ChatConsumer(ProfiledConsumerMixin, FramedConsumerMixin, AsyncWebsocketConsumer):
+    store = chat_store
+
     def __init__(self, *args, **kwargs):
         print("🚨 CHAT CONSUMER INSTANCE CREATED!")
         super().__init__(*args, **kwargs)
@@ -18,6 +91,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
         self.room_group_name = None
         self.user = None
         self.room = None
+        self.tracking_history = False
+        self.accepted = False
 
     async def connect(self):
         print("=" * 60)
@@ -46,6 +121,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
             if self.user.is_anonymous:
                 print("❌ REJECTED: User is anonymous")
+                WS_CONNECTS.labels('anonymous').inc()
                 await self.close(code=4001)
                 return
 
@@ -54,18 +130,24 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.room = await self.get_room(self.room_name)
             if not self.room:
                 print(f"❌ REJECTED: Room not found: '{self.room_name}'")
+                WS_CONNECTS.labels('room_not_found').inc()
                 await self.close(code=4002)
                 return
                 
             print(f"✅ Room found: {self.room.name}")
 
-            # Check if user is participant
+            # Check if user is participant (a ticket for this room was issued to one)
             print(f"🔍 Checking if user is participant...")
-            is_participant = await self.is_participant(self.room, self.user)
+            ticket = self.scope.get('ticket')
+            is_participant = (
+                (ticket is not None and ticket['room'] == self.room_name)
+                or await self.is_participant(self.room, self.user)
+            )
             print(f"🔍 Participant result: {is_participant}")
             
             if not is_participant:
                 print(f"❌ REJECTED: User is not a participant")
+                WS_CONNECTS.labels('forbidden').inc()
                 await self.close(code=4003)
                 return
 
@@ -75,6 +157,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 self.room_group_name,
                 self.channel_name
             )
+            await self.track_history()
 
             # Update user presence
             print("👤 Updating user presence...")
@@ -82,12 +165,20 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
             print("✅ ACCEPTING WebSocket connection...")
             await self.accept()
+            self.accepted = True
+            WS_CONNECTS.labels('accepted').inc()
+            WS_CONNECTIONS.inc()
+            await connection_opened()
             print("🎉 WEB SOCKET CONNECTION SUCCESSFUL!")
             print(f"✅ WebSocket connected to: {self.room_name}")
 
+            # Replay anything the client missed while disconnected
+            last_message_id = self.get_resume_point()
+            if last_message_id is not None:
+                await self.replay_missed_messages(last_message_id)
+
             # Send join notification
-            await self.channel_layer.group_send(
-                self.room_group_name,
+            await self.broadcast(
                 {
                     'type': 'user_joined',
                     'user_id': self.user.id,
@@ -101,10 +192,15 @@ class ChatConsumer(AsyncWebsocketConsumer):
             print(f"💥 CONNECTION ERROR: {str(e)}")
             import traceback
             traceback.print_exc()
+            WS_CONNECTS.labels('error').inc()
             await self.close(code=4000)
 
     async def disconnect(self, close_code):
         print(f"🔌 WebSocket disconnected from: {self.room_name}, code: {close_code}")
+        if self.accepted:
+            self.accepted = False
+            WS_CONNECTIONS.dec()
+            await connection_closed()
         try:
             # Leave room group
             if hasattr(self, 'room_group_name'):
@@ -112,6 +208,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     self.room_group_name,
                     self.channel_name
                 )
+            if self.tracking_history:
+                message_history.unsubscribe(self.room.id)
+                self.tracking_history = False
 
             # Update user presence
             if self.user and not self.user.is_anonymous:
@@ -119,8 +218,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
                 # Send leave notification
                 if hasattr(self, 'room_group_name'):
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
+                    await self.broadcast(
                         {
                             'type': 'user_left',
                             'user_id': self.user.id,
@@ -132,30 +230,26 @@ class ChatConsumer(AsyncWebsocketConsumer):
         except Exception as e:
             print(f"❌ WebSocket disconnect error: {e}")
 
-    async def receive(self, text_data):
+    async def receive_frame(self, data):
         try:
-            text_data_json = json.loads(text_data)
-            message_type = text_data_json.get('type', 'chat_message')
-
-            if message_type == 'chat_message':
-                await self.handle_chat_message(text_data_json)
-            elif message_type == 'typing_start':
-                await self.handle_typing_start()
-            elif message_type == 'typing_stop':
-                await self.handle_typing_stop()
-            elif message_type == 'message_read':
-                await self.handle_message_read(text_data_json)
-
-        except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
-                'type': 'error',
-                'error': 'Invalid JSON'
-            }))
+            message_type = data.get('type', 'chat_message')
+            event_label = message_type if message_type in CLIENT_EVENTS else 'unknown'
+
+            with WS_EVENT_SECONDS.labels(event_label).time():
+                if message_type == 'chat_message':
+                    await self.handle_chat_message(data)
+                elif message_type == 'typing_start':
+                    await self.handle_typing_start()
+                elif message_type == 'typing_stop':
+                    await self.handle_typing_stop()
+                elif message_type == 'message_read':
+                    await self.handle_message_read(data)
+
         except Exception as e:
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'type': 'error',
                 'error': str(e)
-            }))
+            })
 
     async def handle_chat_message(self, data):
         """Handle incoming chat messages"""
@@ -168,34 +262,25 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
 
         # Create message in database
-        message = await self.create_message(
-            message_content, 
-            reply_to_id, 
-            self_destruct, 
-            destroy_minutes
-        )
+        with MESSAGE_DB_SECONDS.time():
+            payload = await self.create_message(
+                message_content, 
+                reply_to_id, 
+                self_destruct, 
+                destroy_minutes
+            )
 
         # Broadcast message to room
-        await self.channel_layer.group_send(
-            self.room_group_name,
+        await self.broadcast(
             {
                 'type': 'chat_message',
-                'message_id': message.id,
-                'sender_id': self.user.id,
-                'sender_username': self.user.username,
-                'encrypted_content': message.encrypted_content,
-                'iv': message.iv,
-                'message_type': message.message_type,
-                'timestamp': message.timestamp.isoformat(),
-                'reply_to': reply_to_id,
-                'self_destruct': self_destruct,
+                **payload,
             }
         )
 
     async def handle_typing_start(self):
         """Handle typing start event"""
-        await self.channel_layer.group_send(
-            self.room_group_name,
+        await self.broadcast(
             {
                 'type': 'typing_indicator',
                 'user_id': self.user.id,
@@ -206,8 +291,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     async def handle_typing_stop(self):
         """Handle typing stop event"""
-        await self.channel_layer.group_send(
-            self.room_group_name,
+        await self.broadcast(
             {
                 'type': 'typing_indicator',
                 'user_id': self.user.id,
@@ -222,8 +306,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         if message_id:
             await self.mark_message_as_read(message_id)
             
-            await self.channel_layer.group_send(
-                self.room_group_name,
+            await self.broadcast(
                 {
                     'type': 'message_read',
                     'message_id': message_id,
@@ -232,130 +315,140 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 }
             )
 
+    async def broadcast(self, event):
+        """Send an event to every consumer in this room"""
+        WS_GROUP_SENDS.labels(event['type']).inc()
+        await self.channel_layer.group_send(self.room_group_name, {**event, 'room': self.room_name})
+
+    async def dispatch(self, message):
+        if not message['type'].startswith('websocket.'):
+            WS_DELIVERIES.labels(message['type']).inc()
+        await super().dispatch(message)
+
+    async def track_history(self):
+        """Start feeding this room's broadcasts into the history buffer"""
+        if not message_history.acquire(self.room.id):
+            floor = await self.get_latest_message_id()
+            message_history.subscribe(self.room.id, floor)
+        self.tracking_history = True
+
+    def get_resume_point(self):
+        """Read the client's last seen message id from the query string"""
+        query = urllib.parse.parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            return int(query['last_message_id'][0])
+        except (KeyError, IndexError, ValueError):
+            return None
+
+    async def replay_missed_messages(self, last_message_id):
+        """Send the messages newer than ``last_message_id`` to this client"""
+        limit = getattr(settings, 'CHAT_RESUME_MAX_MESSAGES', 500)
+        missed = message_history.since(self.room.id, last_message_id)
+        source = 'buffer'
+        if missed is None:
+            missed = await self.get_messages_after(last_message_id, limit + 1)
+            source = 'database'
+
+        if len(missed) > limit:
+            # Too far behind to replay; the client reloads the page instead
+            await self.send_frame({'type': 'resync_required'})
+            return
+
+        for payload in missed:
+            await self.send_chat_message(payload, replayed=True)
+
+        await self.send_frame({
+            'type': 'resume_complete',
+            'count': len(missed),
+            'source': source,
+        })
+
+    async def send_chat_message(self, payload, replayed=False):
+        await self.send_frame(chat_message_frame(payload, replayed))
+
     # Handler methods for different message types
     async def chat_message(self, event):
         """Send chat message to WebSocket"""
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message_id': event['message_id'],
-            'sender_id': event['sender_id'],
-            'sender_username': event['sender_username'],
-            'encrypted_content': event['encrypted_content'],
-            'iv': event['iv'],
-            'message_type': event['message_type'],
-            'timestamp': event['timestamp'],
-            'reply_to': event.get('reply_to'),
-            'self_destruct': event.get('self_destruct', False),
-        }))
+        payload = event_payload(event)
+        message_history.append(self.room.id, payload)
+        await self.send_chat_message(payload)
 
     async def user_joined(self, event):
         """Send user joined notification"""
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'user_joined',
             'user_id': event['user_id'],
             'username': event['username'],
             'timestamp': event['timestamp'],
-        }))
+        })
 
     async def user_left(self, event):
         """Send user left notification"""
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'user_left',
             'user_id': event['user_id'],
             'username': event['username'],
             'timestamp': event['timestamp'],
-        }))
+        })
 
     async def typing_indicator(self, event):
         """Send typing indicator"""
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'typing_indicator',
             'user_id': event['user_id'],
             'username': event['username'],
             'typing': event['typing'],
-        }))
+        })
 
     async def message_read(self, event):
         """Send message read receipt"""
-        await self.send(text_data=json.dumps({
+        message_history.mark_read(self.room.id, [event['message_id']])
+        await self.send_frame({
             'type': 'message_read',
             'message_id': event['message_id'],
             'user_id': event['user_id'],
             'username': event['username'],
-        }))
+        })
 
-    # Database operations - WITH DEBUGGING
-    @database_sync_to_async
-    def get_room(self, room_name):
-        try:
-            print(f"🔍 DATABASE: Looking for room '{room_name}'")
-            room = ChatRoom.objects.get(name=room_name, is_active=True)
-            print(f"✅ DATABASE: Room found - '{room.name}' (ID: {room.id})")
-            
-            # Debug participants
-            participants = list(room.participants.all())
-            print(f"👥 Room participants: {[p.username for p in participants]}")
-            
-            return room
-        except ChatRoom.DoesNotExist:
+    async def message_deleted(self, event):
+        """Forget a deleted message and tell the client to remove it"""
+        message_history.discard(self.room.id, event['message_id'])
+        await self.send_frame({
+            'type': 'message_deleted',
+            'message_id': event['message_id'],
+        })
+
+    async def message_edited(self, event):
+        """Keep the buffered copy of an edited message current"""
+        payload = event_payload(event)
+        message_history.replace(self.room.id, payload)
+
+    # Database operations, through the configured store (see store.py)
+    async def get_room(self, room_name):
+        room = await self.store.get_room(room_name)
+        if room is None:
             print(f"❌ DATABASE: Room '{room_name}' not found or not active")
-            
-            # List all available rooms for debugging
-            all_rooms = ChatRoom.objects.filter(is_active=True)
-            print(f"📋 Available active rooms: {[r.name for r in all_rooms]}")
-            return None
-        except Exception as e:
-            print(f"💥 DATABASE ERROR: {e}")
-            return None
+        return room
 
-    @database_sync_to_async
-    def is_participant(self, room, user):
-        result = room.participants.filter(id=user.id).exists()
-        print(f"🔍 DATABASE: Participant check - User {user.username} in room {room.name}: {result}")
-        return result
+    async def is_participant(self, room, user):
+        return await self.store.is_participant(room.id, user.id)
 
-    @database_sync_to_async
-    def create_message(self, content, reply_to_id, self_destruct, destroy_minutes):
-        # Encrypt message
-        encryption_result = encryption_manager.aes_cipher.encrypt(content)
-        
-        # Calculate destroy time if self-destruct is enabled
-        destroy_after = None
-        if self_destruct and destroy_minutes > 0:
-            destroy_after = timezone.now() + timezone.timedelta(minutes=destroy_minutes)
-
-        # Get reply message if provided
-        reply_to = None
-        if reply_to_id:
-            try:
-                reply_to = Message.objects.get(id=reply_to_id, room=self.room)
-            except Message.DoesNotExist:
-                pass
-
-        message = Message.objects.create(
-            room=self.room,
-            sender=self.user,
-            encrypted_content=encryption_result,
-            iv='',  # IV is included in the encrypted_content
-            reply_to=reply_to,
-            self_destruct=self_destruct,
-            destroy_after=destroy_after,
-        )
-        return message
+    async def get_latest_message_id(self):
+        return await self.store.latest_message_id(self.room.id)
 
-    @database_sync_to_async
-    def mark_message_as_read(self, message_id):
-        try:
-            message = Message.objects.get(id=message_id, room=self.room)
-            message.mark_as_read()
-            return True
-        except Message.DoesNotExist:
-            return False
-
-    @database_sync_to_async
-    def update_user_presence(self, online):
-        presence, created = UserPresence.objects.get_or_create(user=self.user)
-        presence.online_status = online
-        if not online:
-            presence.typing_in = None
-        presence.save()
\ No newline at end of file
+    async def get_messages_after(self, last_message_id, limit):
+        return await self.store.messages_after(self.room.id, last_message_id, limit)
+
+    async def create_message(self, content, reply_to_id, self_destruct, destroy_minutes):
+        reply_to = await self.get_reply_to(reply_to_id) if reply_to_id else None
+        message = build_message(self.room, self.user, content, reply_to, self_destruct, destroy_minutes)
+        return await save_chat_message(self.store, message, self.user.username)
+
+    async def get_reply_to(self, reply_to_id):
+        return await self.store.get_reply_to(self.room.id, reply_to_id)
+
+    async def mark_message_as_read(self, message_id):
+        return await self.store.mark_read(self.room.id, message_id)
+
+    async def update_user_presence(self, online):
+        await self.store.set_presence(self.user.id, online)
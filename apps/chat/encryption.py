@@ -6,6 +6,10 @@ from Crypto.Random import get_random_bytes
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_OAEP
 from django.conf import settings
+from apps.monitoring.metrics import ENCRYPTION_SECONDS
+
+ENCRYPT_TIMER = ENCRYPTION_SECONDS.labels('encrypt')
+DECRYPT_TIMER = ENCRYPTION_SECONDS.labels('decrypt')
 
 
 class AESCipher:
@@ -17,25 +21,27 @@ class AESCipher:
 
     def encrypt(self, plaintext):
         """Encrypt plaintext using AES-256-CBC"""
-        try:
-            iv = get_random_bytes(16)
-            cipher = AES.new(self.key, AES.MODE_CBC, iv)
-            encrypted = cipher.encrypt(pad(plaintext.encode('utf-8'), AES.block_size))
-            return base64.b64encode(iv + encrypted).decode('utf-8')
-        except Exception as e:
-            raise Exception(f"Encryption failed: {str(e)}")
+        with ENCRYPT_TIMER.time():
+            try:
+                iv = get_random_bytes(16)
+                cipher = AES.new(self.key, AES.MODE_CBC, iv)
+                encrypted = cipher.encrypt(pad(plaintext.encode('utf-8'), AES.block_size))
+                return base64.b64encode(iv + encrypted).decode('utf-8')
+            except Exception as e:
+                raise Exception(f"Encryption failed: {str(e)}")
 
     def decrypt(self, encrypted_data):
         """Decrypt AES-256-CBC encrypted data"""
-        try:
-            raw = base64.b64decode(encrypted_data)
-            iv = raw[:16]
-            encrypted = raw[16:]
-            cipher = AES.new(self.key, AES.MODE_CBC, iv)
-            decrypted = unpad(cipher.decrypt(encrypted), AES.block_size)
-            return decrypted.decode('utf-8')
-        except Exception as e:
-            raise Exception(f"Decryption failed: {str(e)}")
+        with DECRYPT_TIMER.time():
+            try:
+                raw = base64.b64decode(encrypted_data)
+                iv = raw[:16]
+                encrypted = raw[16:]
+                cipher = AES.new(self.key, AES.MODE_CBC, iv)
+                decrypted = unpad(cipher.decrypt(encrypted), AES.block_size)
+                return decrypted.decode('utf-8')
+            except Exception as e:
+                raise Exception(f"Decryption failed: {str(e)}")
 
     def get_key_b64(self):
         """Get base64 encoded key for storage"""
@@ -48,6 +54,46 @@ class AESCipher:
         return cls(key)
 
 
+class SegmentCipher:
+    """
+    AES-256-GCM for files stored as fixed-size segments.
+
+    Each plaintext segment is sealed on its own as ``nonce | ciphertext |
+    tag`` with a fresh random nonce, so any segment can be rewritten or
+    decrypted without touching the others. The associated data binds a
+    segment to its file, its position and whether it is the last one,
+    so segments cannot be reordered, moved between files or cut off.
+    """
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+    OVERHEAD = NONCE_SIZE + TAG_SIZE
+
+    def __init__(self, key, file_id):
+        self.key = key
+        self.file_id = file_id.encode('utf-8') if isinstance(file_id, str) else file_id
+
+    def _associated_data(self, index, last):
+        return self.file_id + index.to_bytes(8, 'big') + (b'\x01' if last else b'\x00')
+
+    def seal(self, index, plaintext, last):
+        with ENCRYPT_TIMER.time():
+            nonce = get_random_bytes(self.NONCE_SIZE)
+            cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+            cipher.update(self._associated_data(index, last))
+            ciphertext, tag = cipher.encrypt_and_digest(plaintext)
+            return nonce + ciphertext + tag
+
+    def open(self, index, sealed, last):
+        """Decrypt one segment; raises ValueError if it was tampered with"""
+        with DECRYPT_TIMER.time():
+            nonce, ciphertext, tag = (
+                sealed[:self.NONCE_SIZE], sealed[self.NONCE_SIZE:-self.TAG_SIZE], sealed[-self.TAG_SIZE:]
+            )
+            cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+            cipher.update(self._associated_data(index, last))
+            return cipher.decrypt_and_verify(ciphertext, tag)
+
+
 class RSACipher:
     """
     RSA encryption for secure key exchange
@@ -0,0 +1,158 @@
+"""
+WebSocket frame encodings for the chat consumers.
+
+JSON text frames are the default. A client can instead ask for a binary
+encoding through the WebSocket subprotocol header:
+
+    new WebSocket(url, ["ciphertalk.msgpack", "ciphertalk.json"])
+
+The first offered protocol the server supports is accepted. In MessagePack
+(``msgpack`` package) and CBOR (``cbor2`` package) frames, ciphertext fields
+travel as raw bytes rather than base64 text, which saves a third of their
+size and the base64 step on both ends. Frames from the client use the same
+encoding. Binary encodings whose package is missing are not offered.
+"""
+import base64
+import binascii
+import json
+
+# Frame fields holding base64 ciphertext, sent as raw bytes by binary codecs
+BINARY_FIELDS = ('encrypted_content',)
+
+
+class JsonCodec:
+    name = 'json'
+    label = 'JSON'
+    subprotocol = 'ciphertalk.json'
+    binary = False
+
+    def encode(self, frame):
+        return json.dumps(frame)
+
+    def decode(self, data):
+        frame = json.loads(data)
+        if not isinstance(frame, dict):
+            raise ValueError("Frame is not an object")
+        return frame
+
+
+class BinaryCodec:
+    binary = True
+
+    def dumps(self, frame):
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+    def encode(self, frame):
+        frame = dict(frame)
+        for field in BINARY_FIELDS:
+            value = frame.get(field)
+            if isinstance(value, str):
+                try:
+                    frame[field] = base64.b64decode(value, validate=True)
+                except binascii.Error:
+                    # Not base64 (e.g. set by a client over HTTP); leave it as text
+                    pass
+        return self.dumps(frame)
+
+    def decode(self, data):
+        if not isinstance(data, bytes):
+            raise ValueError(f"{self.label} frames must be binary")
+        try:
+            frame = self.loads(data)
+        except Exception as e:
+            raise ValueError(f"Invalid {self.label}: {e}")
+        if not isinstance(frame, dict):
+            raise ValueError("Frame is not a map")
+        for field in BINARY_FIELDS:
+            if isinstance(frame.get(field), bytes):
+                frame[field] = base64.b64encode(frame[field]).decode()
+        return frame
+
+
+class MsgpackCodec(BinaryCodec):
+    name = 'msgpack'
+    label = 'MessagePack'
+    subprotocol = 'ciphertalk.msgpack'
+
+    def __init__(self):
+        import msgpack
+        self.packer = msgpack.Packer(use_bin_type=True)
+        self.unpackb = msgpack.unpackb
+
+    def dumps(self, frame):
+        return self.packer.pack(frame)
+
+    def loads(self, data):
+        return self.unpackb(data, raw=False)
+
+
+class CborCodec(BinaryCodec):
+    name = 'cbor'
+    label = 'CBOR'
+    subprotocol = 'ciphertalk.cbor'
+
+    def __init__(self):
+        import cbor2
+        self.dumps = cbor2.dumps
+        self.loads = cbor2.loads
+
+
+def available_codecs():
+    """Codec instances by subprotocol, for the encodings installed here"""
+    codecs = {}
+    for codec_class in (JsonCodec, MsgpackCodec, CborCodec):
+        try:
+            codec = codec_class()
+        except ImportError:
+            continue
+        codecs[codec.subprotocol] = codec
+    return codecs
+
+
+CODECS = available_codecs()
+DEFAULT_CODEC = CODECS[JsonCodec.subprotocol]
+
+
+def negotiate(requested):
+    """The codec for the first supported subprotocol a client offered, or JSON with none"""
+    for subprotocol in requested or ():
+        if subprotocol in CODECS:
+            return CODECS[subprotocol], subprotocol
+    return DEFAULT_CODEC, None
+
+
+class FramedConsumerMixin:
+    """
+    Send and receive frames as dicts in the negotiated encoding. Consumers
+    implement ``receive_frame(frame)`` and call ``send_frame(frame)``.
+    """
+    codec = DEFAULT_CODEC
+    subprotocol = None
+
+    async def websocket_connect(self, message):
+        self.codec, self.subprotocol = negotiate(self.scope.get('subprotocols'))
+        await super().websocket_connect(message)
+
+    async def accept(self, subprotocol=None, headers=None):
+        await super().accept(subprotocol=subprotocol or self.subprotocol, headers=headers)
+
+    async def send_frame(self, frame):
+        data = self.codec.encode(frame)
+        if self.codec.binary:
+            await self.send(bytes_data=data)
+        else:
+            await self.send(text_data=data)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            frame = self.codec.decode(text_data if text_data is not None else bytes_data)
+        except ValueError:
+            await self.send_frame({'type': 'error', 'error': f'Invalid {self.codec.label}'})
+            return
+        await self.receive_frame(frame)
+
+    async def receive_frame(self, frame):
+        raise NotImplementedError
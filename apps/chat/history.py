@@ -0,0 +1,210 @@
+import threading
+from bisect import bisect_left, bisect_right
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .archive import page_before
+from .payloads import serialize_message  # noqa: F401 (re-exported)
+
+
+def load_recent_messages(room_id, limit):
+    """Query the newest ``limit`` live messages of a room, oldest first"""
+    return page_before(room_id, None, limit)[0]
+
+
+class _RoomState:
+    __slots__ = ('ids', 'payloads', 'floor', 'subscribers')
+
+    def __init__(self, floor):
+        self.ids = []
+        self.payloads = []
+        self.floor = floor
+        self.subscribers = 0
+
+
+class RoomHistoryBuffer:
+    """
+    Per-process ring buffer of the most recent messages in each room.
+
+    A room is only tracked while at least one consumer in this process is
+    subscribed to the room's channel group. Every message broadcast to the
+    group is appended, so the buffer holds every live message with an id
+    greater than ``floor`` (the newest id that existed when tracking
+    started, or the newest id evicted since). Resumes from before ``floor``
+    fall back to the database.
+
+    Processes that are not tracking a room (plain HTTP workers, or rooms
+    nobody here has open) read the newest page through the Django cache.
+    Each room's cached page lives under a generation number that every
+    append, edit, delete or read receipt bumps, so a page filled from a
+    stale query can never be served after a newer write.
+    """
+    def __init__(self, size=None):
+        self.size = size or getattr(settings, 'CHAT_HISTORY_BUFFER_SIZE', 200)
+        self._rooms = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.cache_hits = 0
+        self.misses = 0
+
+    # Subscription tracking
+    def acquire(self, room_id):
+        """Register another subscriber for an already tracked room"""
+        with self._lock:
+            state = self._rooms.get(room_id)
+            if state is None:
+                return False
+            state.subscribers += 1
+            return True
+
+    def subscribe(self, room_id, floor):
+        """Start tracking a room whose newest message id is ``floor``"""
+        with self._lock:
+            state = self._rooms.get(room_id)
+            if state is None:
+                state = self._rooms[room_id] = _RoomState(floor or 0)
+            state.subscribers += 1
+
+    def unsubscribe(self, room_id):
+        """Drop a subscriber; stop tracking once the last one leaves"""
+        with self._lock:
+            state = self._rooms.get(room_id)
+            if state is None:
+                return
+            state.subscribers -= 1
+            if state.subscribers <= 0:
+                del self._rooms[room_id]
+
+    # Writes
+    def append(self, room_id, payload):
+        """Record a broadcast message, ignoring duplicates"""
+        message_id = payload['message_id']
+        with self._lock:
+            state = self._rooms.get(room_id)
+            if state is None or message_id <= state.floor:
+                return False
+            index = bisect_right(state.ids, message_id)
+            if index and state.ids[index - 1] == message_id:
+                return False
+            state.ids.insert(index, message_id)
+            state.payloads.insert(index, payload)
+            if len(state.ids) > self.size:
+                state.floor = state.ids.pop(0)
+                state.payloads.pop(0)
+        return True
+
+    def record(self, room_id, payload):
+        """Append a newly created message and invalidate the shared copy"""
+        self.append(room_id, payload)
+        self.invalidate(room_id)
+
+    def replace(self, room_id, payload):
+        """Swap in the new payload of an edited message"""
+        with self._lock:
+            state = self._rooms.get(room_id)
+            index = self._index(state, payload['message_id'])
+            if index is not None:
+                state.payloads[index] = payload
+
+    def discard(self, room_id, message_id):
+        """Forget a deleted or expired message"""
+        with self._lock:
+            state = self._rooms.get(room_id)
+            index = self._index(state, message_id)
+            if index is not None:
+                del state.ids[index]
+                del state.payloads[index]
+
+    def mark_read(self, room_id, message_ids=None, exclude_sender=None):
+        """Flag buffered messages as read, like the matching UPDATE did"""
+        with self._lock:
+            state = self._rooms.get(room_id)
+            if state is None:
+                return
+            wanted = set(message_ids) if message_ids is not None else None
+            for index, payload in enumerate(state.payloads):
+                if payload.get('is_read'):
+                    continue
+                if wanted is not None and payload['message_id'] not in wanted:
+                    continue
+                if exclude_sender is not None and payload['sender_id'] == exclude_sender:
+                    continue
+                state.payloads[index] = {**payload, 'is_read': True}
+
+    def invalidate(self, room_id):
+        """Bump the room's cache generation so the shared page is refetched"""
+        key = self._generation_key(room_id)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)
+
+    # Reads
+    def since(self, room_id, last_id):
+        """
+        Return the buffered messages newer than ``last_id``, or None when
+        the buffer cannot prove it holds the whole gap.
+        """
+        with self._lock:
+            state = self._rooms.get(room_id)
+            if state is None or last_id < state.floor:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return state.payloads[bisect_right(state.ids, last_id):]
+
+    def latest(self, room_id, limit, loader=load_recent_messages):
+        """
+        Return the newest ``limit`` messages of a room, oldest first.
+
+        Served from this process when it tracks the room, then from the
+        Django cache, and only then from ``loader(room_id, limit)``.
+        """
+        with self._lock:
+            state = self._rooms.get(room_id)
+            if state is not None and (len(state.ids) >= limit or state.floor == 0):
+                self.hits += 1
+                return state.payloads[-limit:] if limit else []
+
+        generation = cache.get(self._generation_key(room_id), 0)
+        key = f'chat:history:{room_id}:{generation}:{limit}'
+        payloads = cache.get(key)
+        if payloads is not None:
+            with self._lock:
+                self.cache_hits += 1
+            return payloads
+
+        with self._lock:
+            self.misses += 1
+        payloads = loader(room_id, limit)
+        cache.set(key, payloads, getattr(settings, 'CHAT_HISTORY_CACHE_TIMEOUT', 300))
+        return payloads
+
+    def stats(self):
+        """Hit/miss counters for monitoring"""
+        with self._lock:
+            return {
+                'rooms_tracked': len(self._rooms),
+                'messages_buffered': sum(len(state.ids) for state in self._rooms.values()),
+                'hits': self.hits,
+                'cache_hits': self.cache_hits,
+                'misses': self.misses,
+            }
+
+    @staticmethod
+    def _generation_key(room_id):
+        return f'chat:history-generation:{room_id}'
+
+    @staticmethod
+    def _index(state, message_id):
+        if state is None:
+            return None
+        index = bisect_left(state.ids, message_id)
+        if index < len(state.ids) and state.ids[index] == message_id:
+            return index
+        return None
+
+
+# Global instance
+message_history = RoomHistoryBuffer()
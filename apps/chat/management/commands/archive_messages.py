@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from apps.chat.archive import archive_messages
+from apps.chat.models import MessageArchive
+
+
+class Command(BaseCommand):
+    help = 'Move old messages out of chat_messages into compressed archive blocks'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--after-days', type=int,
+            help='Archive messages older than this (default: CHAT_ARCHIVE_AFTER_DAYS)'
+        )
+        parser.add_argument(
+            '--keep-recent', type=int,
+            help='Archive messages beyond the newest N of each room (default: CHAT_ARCHIVE_KEEP_RECENT)'
+        )
+
+    def handle(self, *args, **options):
+        blocks_before = MessageArchive.objects.count()
+        moved = archive_messages(after_days=options['after_days'], keep_recent=options['keep_recent'])
+        blocks = MessageArchive.objects.count() - blocks_before
+        self.stdout.write(self.style.SUCCESS(f'Archived {moved} messages into {blocks} blocks'))
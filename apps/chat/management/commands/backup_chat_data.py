@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from apps.chat.backup import run_backup
+
+
+class Command(BaseCommand):
+    help = 'Back up the chat data added or changed since the last backup'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', dest='root', help='Backup directory (default: CHAT_BACKUP_DIR)')
+
+    def handle(self, *args, **options):
+        manifest = run_backup(options['root'])
+        rows = sum(segment['rows'] for segment in manifest['segments'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Backed up {rows} rows in {len(manifest['segments'])} segments to {manifest['id']}"
+        ))
@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.chat.benchmarks import bench_fixtures, summarize_ms, write_report
+from apps.chat.models import Message
+from apps.chat.store import AsyncChatStore, ThreadedChatStore
+
+
+class Command(BaseCommand):
+    help = 'Compare consumer database access via database_sync_to_async and the async ORM store'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=50, help='Concurrent simulated sockets')
+        parser.add_argument('--connects', type=int, default=1000, help='Connect sequences per run')
+        parser.add_argument('--messages', type=int, default=1000, help='Messages per run')
+        parser.add_argument('--rooms', type=int, default=5, help='Rooms the clients spread over')
+        parser.add_argument(
+            '--lanes', default='1,4,8',
+            help='Comma-separated lane counts to try for the async store'
+        )
+        parser.add_argument('--json', dest='json_path', help='Write the report to this file')
+
+    def handle(self, *args, **options):
+        stores = [('database_sync_to_async', None, ThreadedChatStore())]
+        for lanes in [int(n) for n in options['lanes'].split(',') if n.strip()]:
+            stores.append((f'async ORM, {lanes} lanes', lanes, AsyncChatStore(lanes=lanes)))
+
+        report = {key: options[key] for key in ('clients', 'connects', 'messages', 'rooms')}
+        report['runs'] = []
+        with bench_fixtures(users=options['clients'], rooms=options['rooms']) as (users, rooms):
+            for label, lanes, store in stores:
+                report['runs'].append(self.run(label, lanes, store, users, rooms, options))
+        write_report(self, report, options['json_path'])
+
+    def run(self, label, lanes, store, users, rooms, options):
+        connect_latencies, message_latencies = [], []
+
+        async def connect(user, room):
+            # What ChatConsumer.connect asks of the database
+            started = time.perf_counter()
+            found = await store.get_room(room.name)
+            await store.is_participant(found.id, user.id)
+            await store.latest_message_id(found.id)
+            await store.set_presence(user.id, True)
+            connect_latencies.append(time.perf_counter() - started)
+
+        async def send(user, room):
+            started = time.perf_counter()
+            await store.save_message(Message(room=room, sender=user, encrypted_content='x' * 64, iv=''))
+            message_latencies.append(time.perf_counter() - started)
+
+        async def drive(step, total):
+            async def client(i):
+                for n in range(i, total, len(users)):
+                    await step(users[i], rooms[n % len(rooms)])
+            await asyncio.gather(*(client(i) for i in range(len(users))))
+
+        async def measure(step, total):
+            started = time.perf_counter()
+            await drive(step, total)
+            return time.perf_counter() - started
+
+        async def main():
+            return await measure(connect, options['connects']), await measure(send, options['messages'])
+
+        connect_elapsed, message_elapsed = asyncio.run(main())
+        result = {
+            'label': label,
+            'lanes': lanes,
+            'connects_per_sec': round(len(connect_latencies) / connect_elapsed, 1),
+            'messages_per_sec': round(len(message_latencies) / message_elapsed, 1),
+            'connect_latency_ms': summarize_ms(connect_latencies),
+            'message_latency_ms': summarize_ms(message_latencies),
+        }
+        self.stderr.write(
+            f"{label:>26}: {result['connects_per_sec']:>9} connects/s {result['messages_per_sec']:>9} msg/s"
+        )
+        return result
@@ -0,0 +1,90 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, transaction
+
+from apps.chat.benchmarks import bench_fixtures, summarize_ms, write_report
+from apps.chat.models import ChatRoom, Message
+
+SQLITE_PRAGMAS = ('journal_mode', 'synchronous', 'busy_timeout', 'mmap_size')
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure concurrent message writes/sec on the configured database profile; '
+        'run once per DATABASE_PROFILE (and with SQLITE_TUNING=0) to compare'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writes', type=int, default=2000, help='Messages per run')
+        parser.add_argument('--threads', default='1,4,16', help='Comma-separated writer thread counts')
+        parser.add_argument('--rooms', type=int, default=5, help='Rooms the writers spread over')
+        parser.add_argument('--json', dest='json_path', help='Write the report to this file')
+
+    def handle(self, *args, **options):
+        report = {
+            'profile': getattr(settings, 'DATABASE_PROFILE', None),
+            'vendor': connection.vendor,
+            'settings': self.describe(),
+            'writes': options['writes'],
+            'runs': [],
+        }
+        with bench_fixtures(users=1, rooms=options['rooms']) as (users, rooms):
+            for threads in [int(n) for n in options['threads'].split(',') if n.strip()]:
+                report['runs'].append(self.run(threads, users[0], rooms, options['writes']))
+        write_report(self, report, options['json_path'])
+
+    def describe(self):
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                return {pragma: cursor.execute(f'PRAGMA {pragma}').fetchone()[0] for pragma in SQLITE_PRAGMAS}
+        db = connection.settings_dict
+        return {'conn_max_age': db['CONN_MAX_AGE'], 'pool': db['OPTIONS'].get('pool')}
+
+    def run(self, threads, user, rooms, writes):
+        latencies, errors = [], []
+        lock = threading.Lock()
+
+        def writer(index):
+            count = writes // threads + (1 if index < writes % threads else 0)
+            mine, failed = [], 0
+            try:
+                for i in range(count):
+                    room = rooms[(index + i) % len(rooms)]
+                    started = time.perf_counter()
+                    try:
+                        # One transaction per message, like the consumer's send path
+                        with transaction.atomic():
+                            message = Message.objects.create(room=room, sender=user, encrypted_content='x' * 64, iv='')
+                            ChatRoom.bump_version([room.pk], last_message_id=message.pk)
+                    except OperationalError:
+                        failed += 1
+                        continue
+                    mine.append(time.perf_counter() - started)
+            finally:
+                connection.close()
+            with lock:
+                latencies.extend(mine)
+                errors.append(failed)
+
+        workers = [threading.Thread(target=writer, args=(i,)) for i in range(threads)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+        result = {
+            'threads': threads,
+            'elapsed_s': round(elapsed, 3),
+            'writes_per_sec': round(len(latencies) / elapsed, 1),
+            'failed_writes': sum(errors),
+            'write_latency_ms': summarize_ms(latencies),
+        }
+        self.stderr.write(
+            f"{threads:>4} writers: {result['writes_per_sec']:>9} writes/s, {result['failed_writes']} failed"
+        )
+        return result
@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+from channels.db import database_sync_to_async
+from django.core.management.base import BaseCommand
+
+from apps.chat.batching import GroupCommitWriter
+from apps.chat.benchmarks import bench_fixtures, summarize_ms, write_report
+from apps.chat.models import Message
+
+
+class Command(BaseCommand):
+    help = 'Measure sustained message inserts/sec with and without group commit'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000, help='Messages per run')
+        parser.add_argument('--producers', type=int, default=50, help='Concurrent senders')
+        parser.add_argument('--rooms', type=int, default=5, help='Rooms the senders spread over')
+        parser.add_argument(
+            '--windows', default='0,1,2,5,10',
+            help='Comma-separated group-commit windows in milliseconds'
+        )
+        parser.add_argument('--json', dest='json_path', help='Write the report to this file')
+
+    def handle(self, *args, **options):
+        windows = [float(w) for w in options['windows'].split(',') if w.strip()]
+        report = {
+            'messages': options['messages'],
+            'producers': options['producers'],
+            'rooms': options['rooms'],
+            'runs': [],
+        }
+
+        with bench_fixtures(users=1, rooms=options['rooms']) as (users, rooms):
+            report['runs'].append(self.run('per-message commit', None, users[0], rooms, options))
+            for window in windows:
+                report['runs'].append(
+                    self.run(f'group commit {window:g} ms', window, users[0], rooms, options)
+                )
+
+        write_report(self, report, options['json_path'])
+
+    def run(self, label, window, user, rooms, options):
+        writer = GroupCommitWriter(window_ms=window, enabled=True) if window is not None else None
+        latencies = []
+
+        @database_sync_to_async
+        def create_directly(message):
+            message.save()
+
+        async def producer(count, offset):
+            for i in range(count):
+                message = Message(
+                    room=rooms[(offset + i) % len(rooms)],
+                    sender=user,
+                    encrypted_content='x' * 64,
+                    iv='',
+                )
+                started = time.perf_counter()
+                if writer is not None:
+                    await writer.submit(message)
+                else:
+                    await create_directly(message)
+                latencies.append(time.perf_counter() - started)
+
+        async def drive():
+            per_producer, extra = divmod(options['messages'], options['producers'])
+            await asyncio.gather(*(
+                producer(per_producer + (1 if i < extra else 0), i)
+                for i in range(options['producers'])
+            ))
+
+        started = time.perf_counter()
+        asyncio.run(drive())
+        elapsed = time.perf_counter() - started
+        if writer is not None:
+            writer.stop()
+
+        result = {
+            'label': label,
+            'window_ms': window,
+            'elapsed_s': round(elapsed, 3),
+            'messages_per_sec': round(len(latencies) / elapsed, 1),
+            'insert_latency_ms': summarize_ms(latencies),
+        }
+        self.stderr.write(f"{label:>24}: {result['messages_per_sec']:>10} msg/s")
+        return result
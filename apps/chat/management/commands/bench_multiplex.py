@@ -0,0 +1,78 @@
+import asyncio
+import contextlib
+import json
+import os
+import time
+import tracemalloc
+
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+
+from apps.chat.benchmarks import bench_fixtures, session_cookie, summarize_ms, write_report
+
+
+class Command(BaseCommand):
+    help = 'Compare one socket per room with one multiplexed socket per user for users in several rooms'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--rooms', type=int, default=5, help='Rooms each user has open')
+        parser.add_argument('--json', dest='json_path', help='Write the report to this file')
+
+    def handle(self, *args, **options):
+        report = {'users': options['users'], 'rooms_per_user': options['rooms'], 'runs': []}
+        with bench_fixtures(users=options['users'], rooms=options['rooms']) as (users, rooms):
+            cookies = [session_cookie(user) for user in users]
+            # The single-room consumer logs every connect to stdout; keep the report readable
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                for mode in ('per-room', 'multiplexed'):
+                    report['runs'].append(asyncio.run(self.run(mode, cookies, rooms)))
+        write_report(self, report, options['json_path'])
+
+    async def run(self, mode, cookies, rooms):
+        from ciphertalk.asgi import application
+
+        async def open_rooms(cookie):
+            """Open every room for one user; returns (sockets, seconds)"""
+            headers = [(b'cookie', cookie.encode())]
+            started = time.perf_counter()
+            if mode == 'per-room':
+                sockets = [WebsocketCommunicator(application, f'ws/chat/{room.name}/', headers) for room in rooms]
+                for socket in sockets:
+                    await socket.connect(timeout=30)
+                return sockets, time.perf_counter() - started
+
+            socket = WebsocketCommunicator(application, 'ws/chat/', headers)
+            await socket.connect(timeout=30)
+            for room in rooms:
+                await socket.send_to(text_data=json.dumps({'type': 'subscribe', 'room': room.name}))
+            pending = {room.name for room in rooms}
+            while pending:
+                frame = json.loads(await socket.receive_from(timeout=30))
+                if frame['type'] == 'subscribed':
+                    pending.discard(frame['room'])
+            return [socket], time.perf_counter() - started
+
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        opened = await asyncio.gather(*(open_rooms(cookie) for cookie in cookies))
+        elapsed = time.perf_counter() - started
+        held = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+
+        sockets = [socket for user_sockets, _ in opened for socket in user_sockets]
+        for socket in sockets:
+            await socket.disconnect()
+        result = {
+            'mode': mode,
+            'sockets': len(sockets),
+            'elapsed_s': round(elapsed, 3),
+            'open_latency_ms': summarize_ms([seconds for _, seconds in opened]),
+            'memory_kib_per_user': round(held / len(cookies) / 1024, 1),
+        }
+        self.stderr.write(
+            f"{mode:>12}: {result['sockets']} sockets, {result['elapsed_s']} s, "
+            f"{result['memory_kib_per_user']} KiB/user"
+        )
+        return result
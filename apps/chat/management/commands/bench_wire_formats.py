@@ -0,0 +1,90 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.chat.benchmarks import write_report
+from apps.chat.consumers import chat_message_frame
+from apps.chat.encryption import AESCipher
+from apps.chat.framing import CODECS
+
+# Plaintext lengths of short, medium and long chat messages
+MESSAGE_SIZES = {'short': 40, 'medium': 300, 'long': 2000}
+
+# Relative weights of the frames a client receives in each mix
+MIXES = {
+    'chat': {'short': 0.55, 'medium': 0.12, 'long': 0.03, 'typing': 0.2, 'read': 0.1},
+    'typing-heavy': {'short': 0.15, 'medium': 0.05, 'typing': 0.7, 'read': 0.1},
+    'long-form': {'medium': 0.5, 'long': 0.4, 'read': 0.1},
+}
+
+
+class Command(BaseCommand):
+    help = 'Compare frame size and encode/decode time of the WebSocket encodings for typical message mixes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--frames', type=int, default=2000, help='Frames per mix')
+        parser.add_argument('--repeat', type=int, default=5, help='Timing passes over the frames')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--json', dest='json_path', help='Write the report to this file')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        cipher = AESCipher()
+        report = {'frames': options['frames'], 'codecs': [codec.name for codec in CODECS.values()], 'mixes': {}}
+        for mix, weights in MIXES.items():
+            kinds = rng.choices(list(weights), list(weights.values()), k=options['frames'])
+            frames = [self.make_frame(kind, index, cipher, rng) for index, kind in enumerate(kinds)]
+            report['mixes'][mix] = self.measure(frames, options['repeat'])
+            for name, result in report['mixes'][mix].items():
+                self.stderr.write(
+                    f"{mix:>12} {name:>8}: {result['bytes_per_frame']:>7} B/frame "
+                    f"({result['bandwidth_vs_json']:.0%} of JSON), "
+                    f"encode {result['encode_us']} us, decode {result['decode_us']} us"
+                )
+        write_report(self, report, options['json_path'])
+
+    def make_frame(self, kind, index, cipher, rng):
+        if kind == 'typing':
+            return {'type': 'typing_indicator', 'user_id': 17, 'username': 'alice', 'typing': rng.random() < 0.5}
+        if kind == 'read':
+            return {'type': 'message_read', 'message_id': 100000 + index, 'user_id': 17, 'username': 'alice'}
+        text = ''.join(rng.choices('abcdefghijklmnopqrstuvwxyz ', k=MESSAGE_SIZES[kind]))
+        return chat_message_frame({
+            'message_id': 100000 + index,
+            'sender_id': 17,
+            'sender_username': 'alice',
+            'encrypted_content': cipher.encrypt(text),
+            'iv': '',
+            'message_type': 'text',
+            'timestamp': timezone.now().isoformat(),
+        })
+
+    def measure(self, frames, repeat):
+        results = {}
+        for codec in CODECS.values():
+            encoded = [codec.encode(frame) for frame in frames]
+            size = sum(len(data.encode() if isinstance(data, str) else data) for data in encoded)
+
+            started = time.perf_counter()
+            for _ in range(repeat):
+                for frame in frames:
+                    codec.encode(frame)
+            encode_s = time.perf_counter() - started
+
+            started = time.perf_counter()
+            for _ in range(repeat):
+                for data in encoded:
+                    codec.decode(data)
+            decode_s = time.perf_counter() - started
+
+            results[codec.name] = {
+                'bytes_per_frame': round(size / len(frames), 1),
+                'encode_us': round(encode_s / (repeat * len(frames)) * 1e6, 2),
+                'decode_us': round(decode_s / (repeat * len(frames)) * 1e6, 2),
+            }
+        json_size = results['json']['bytes_per_frame']
+        for result in results.values():
+            result['bandwidth_vs_json'] = round(result['bytes_per_frame'] / json_size, 3)
+        return results
@@ -0,0 +1,214 @@
+import asyncio
+import contextlib
+import json
+import os
+import random
+import time
+import urllib.parse
+
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.chat.benchmarks import (
+    bench_fixtures, process_usage, session_cookie, summarize_ms, write_report,
+)
+from apps.chat.tickets import issue_ticket
+
+
+class InProcessClient:
+    """WebSocket client talking to the ASGI application in this process"""
+    def __init__(self, application, path, cookie):
+        self.communicator = WebsocketCommunicator(
+            application, path, headers=[(b'cookie', cookie.encode())]
+        )
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=30)
+        return connected
+
+    async def send(self, data):
+        await self.communicator.send_to(text_data=json.dumps(data))
+
+    async def receive(self, timeout):
+        return json.loads(await self.communicator.receive_from(timeout=timeout))
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class RemoteClient:
+    """WebSocket client talking to a running server (e.g. Daphne)"""
+    def __init__(self, url, cookie):
+        self.url = url
+        self.cookie = cookie
+        self.socket = None
+
+    async def connect(self):
+        import websockets
+        self.socket = await websockets.connect(self.url, additional_headers={'Cookie': self.cookie})
+        return True
+
+    async def send(self, data):
+        await self.socket.send(json.dumps(data))
+
+    async def receive(self, timeout):
+        return json.loads(await asyncio.wait_for(self.socket.recv(), timeout))
+
+    async def close(self):
+        await self.socket.close()
+
+
+class Command(BaseCommand):
+    help = 'Drive N authenticated WebSocket clients across M rooms and report latency/throughput'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=50)
+        parser.add_argument('--rooms', type=int, default=5)
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds of traffic per client')
+        parser.add_argument('--rate', type=float, default=2.0, help='Actions per second per client')
+        parser.add_argument(
+            '--mix', default='send=0.7,typing=0.2,read=0.1',
+            help='Relative weights of send/typing/read actions'
+        )
+        parser.add_argument('--seed', type=int, default=1, help='Random seed for a reproducible run')
+        parser.add_argument(
+            '--url', help='ws:// base URL of a running server (needs the websockets package); '
+                          'defaults to the in-process ASGI application'
+        )
+        parser.add_argument(
+            '--auth', choices=('session', 'ticket'), default='session',
+            help='Authenticate connects with the session cookie or a signed connect ticket'
+        )
+        parser.add_argument('--server-pid', type=int, help='Report CPU/RSS of this server process')
+        parser.add_argument('--json', dest='json_path', help='Write the report to this file')
+
+    def handle(self, *args, **options):
+        mix = self.parse_mix(options['mix'])
+        if options['url']:
+            try:
+                import websockets  # noqa: F401
+            except ImportError:
+                raise CommandError('--url needs the websockets package (pip install websockets)')
+
+        with bench_fixtures(users=options['clients'], rooms=options['rooms']) as (users, rooms):
+            cookies = [session_cookie(user) for user in users]
+            usage_before = process_usage(options['server_pid'])
+            # The consumer logs every connect to stdout; keep the report readable
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                stats = asyncio.run(self.drive(users, rooms, cookies, mix, options))
+            usage_after = process_usage(options['server_pid'])
+
+        delivery = [
+            received - stats['sent_at'][message_id]
+            for message_id, received in stats['received']
+            if message_id in stats['sent_at']
+        ]
+        report = {
+            'target': options['url'] or 'in-process',
+            'clients': options['clients'],
+            'rooms': options['rooms'],
+            'duration_s': options['duration'],
+            'rate_per_client': options['rate'],
+            'mix': mix,
+            'seed': options['seed'],
+            'auth': options['auth'],
+            'connect_failures': stats['connect_failures'],
+            'connect_ms': summarize_ms(stats['connect']),
+            'delivery_ms': summarize_ms(delivery),
+            'actions': stats['actions'],
+            'messages_sent': len(stats['sent_at']),
+            'messages_delivered': len(stats['received']),
+            'messages_sent_per_sec': round(len(stats['sent_at']) / stats['elapsed'], 1),
+            'deliveries_per_sec': round(len(stats['received']) / stats['elapsed'], 1),
+            'server': {
+                'cpu_s': round(usage_after['cpu_s'] - usage_before['cpu_s'], 3),
+                'max_rss_mib': usage_after['max_rss_mib'],
+            },
+        }
+        write_report(self, report, options['json_path'])
+
+    def parse_mix(self, text):
+        mix = {}
+        for part in text.split(','):
+            name, _, weight = part.partition('=')
+            if name not in ('send', 'typing', 'read'):
+                raise CommandError(f'Unknown action in --mix: {name}')
+            mix[name] = float(weight)
+        return mix
+
+    def make_client(self, user, room, cookie, options):
+        path = f'ws/chat/{urllib.parse.quote(room.name)}/'
+        if options['auth'] == 'ticket':
+            path += '?' + urllib.parse.urlencode({'ticket': issue_ticket(user, room.name)[0]})
+        if options['url']:
+            return RemoteClient(f"{options['url'].rstrip('/')}/{path}", cookie)
+        from ciphertalk.asgi import application
+        return InProcessClient(application, path, cookie)
+
+    async def drive(self, users, rooms, cookies, mix, options):
+        rng = random.Random(options['seed'])
+        stats = {
+            'connect': [], 'connect_failures': 0, 'sent_at': {}, 'received': [],
+            'actions': {name: 0 for name in mix},
+        }
+        names, weights = list(mix), list(mix.values())
+
+        async def run_client(index):
+            user = users[index]
+            client = self.make_client(user, rooms[index % len(rooms)], cookies[index], options)
+            client_rng = random.Random(rng.random())
+
+            started = time.perf_counter()
+            try:
+                connected = await client.connect()
+            except Exception:
+                connected = False
+            if not connected:
+                stats['connect_failures'] += 1
+                return
+            stats['connect'].append(time.perf_counter() - started)
+
+            pending_sends = []
+            last_seen = {'id': None}
+            deadline = time.perf_counter() + options['duration']
+
+            async def reader():
+                while True:
+                    try:
+                        event = await client.receive(timeout=options['duration'] + 5)
+                    except Exception:
+                        return
+                    if event.get('type') != 'chat_message':
+                        continue
+                    now = time.perf_counter()
+                    message_id = event['message_id']
+                    last_seen['id'] = message_id
+                    if event['sender_id'] == user.id and pending_sends:
+                        # Our own echo tells us which id our oldest pending send got
+                        stats['sent_at'][message_id] = pending_sends.pop(0)
+                    else:
+                        stats['received'].append((message_id, now))
+
+            reader_task = asyncio.create_task(reader())
+            while time.perf_counter() < deadline:
+                await asyncio.sleep(client_rng.expovariate(options['rate']))
+                action = client_rng.choices(names, weights)[0]
+                stats['actions'][action] += 1
+                if action == 'send':
+                    pending_sends.append(time.perf_counter())
+                    await client.send({'type': 'chat_message', 'message': f'load test {index}'})
+                elif action == 'typing':
+                    await client.send({'type': 'typing_start'})
+                elif last_seen['id'] is not None:
+                    await client.send({'type': 'message_read', 'message_id': last_seen['id']})
+
+            # Give in-flight messages a moment to arrive before hanging up
+            await asyncio.sleep(1)
+            reader_task.cancel()
+            with contextlib.suppress(Exception):
+                await client.close()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(run_client(i) for i in range(len(users))))
+        stats['elapsed'] = time.perf_counter() - started
+        return stats
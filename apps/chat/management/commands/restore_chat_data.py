@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.chat.backup import BackupError, restore_backup
+
+
+class Command(BaseCommand):
+    help = 'Restore chat data from the incremental backups in CHAT_BACKUP_DIR'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', dest='root', help='Backup directory (default: CHAT_BACKUP_DIR)')
+        parser.add_argument('--upto', help='Stop after this backup run id')
+        parser.add_argument('--workers', type=int, help='Segments restored in parallel per table')
+
+    def handle(self, *args, **options):
+        try:
+            rows = restore_backup(options['root'], upto=options['upto'], workers=options['workers'])
+        except BackupError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f'Restored {rows} rows'))
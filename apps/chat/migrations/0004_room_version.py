@@ -0,0 +1,38 @@
+# Generated by Django 5.2.7 on 2026-10-19 00:50
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def fill_last_message_id(apps, schema_editor):
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    Message = apps.get_model('chat', 'Message')
+    ChatRoom.objects.update(last_message_id=Subquery(
+        Message.objects.filter(room=OuterRef('pk'), is_deleted=False).order_by('-id').values('id')[:1]
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_message_chat_messag_room_id_8086da_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='modified_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_last_message_id, migrations.RunPython.noop),
+    ]
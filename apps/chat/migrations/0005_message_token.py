@@ -0,0 +1,31 @@
+# Generated by Django 5.2.7 on 2026-10-19 00:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_room_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=32)),
+                ('count', models.PositiveSmallIntegerField(default=1)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='index_tokens', to='chat.message')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.chatroom')),
+            ],
+            options={
+                'verbose_name': 'Message Token',
+                'verbose_name_plural': 'Message Tokens',
+                'db_table': 'chat_message_tokens',
+                'indexes': [models.Index(fields=['token', 'room', 'message'], name='chat_messag_token_98b77f_idx')],
+                'constraints': [models.UniqueConstraint(fields=('message', 'token'), name='unique_message_token')],
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.7 on 2026-10-19 00:57
+
+import django.db.models.functions.text
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_message_token'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(django.db.models.functions.text.Lower('name'), name='chat_room_name_lower_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='contact',
+            index=models.Index(models.F('user'), django.db.models.functions.text.Lower('nickname'), name='contact_nickname_lower_idx'),
+        ),
+    ]
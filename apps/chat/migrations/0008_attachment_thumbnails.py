@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 01:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_attachment_upload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachmentupload',
+            name='thumbnails',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
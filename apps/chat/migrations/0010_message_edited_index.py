@@ -0,0 +1,19 @@
+# Generated by Django 5.2.7 on 2026-10-19 01:20
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_message_archive'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('edited_at__isnull', False)), fields=['edited_at'], name='chat_msg_edited_at_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.7 on 2026-10-19 01:23
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_message_edited_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingNotification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.message')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pending_notifications', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Pending Notification',
+                'verbose_name_plural': 'Pending Notifications',
+                'db_table': 'chat_pending_notifications',
+                'indexes': [models.Index(fields=['user', 'created_at'], name='chat_pendin_user_id_50e57c_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'message'), name='unique_pending_notification')],
+            },
+        ),
+    ]
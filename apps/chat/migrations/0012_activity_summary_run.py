@@ -0,0 +1,29 @@
+# Generated by Django 5.2.7 on 2026-10-19 01:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_pending_notification'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivitySummaryRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(unique=True)),
+                ('last_user_id', models.BigIntegerField(default=0)),
+                ('sent', models.PositiveIntegerField(default=0)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Activity Summary Run',
+                'verbose_name_plural': 'Activity Summary Runs',
+                'db_table': 'chat_activity_summary_runs',
+            },
+        ),
+    ]
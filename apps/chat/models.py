@@ -1,4 +1,8 @@
+import uuid
+
 from django.db import models
+from django.db.models import F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest, Lower
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 from datetime import timedelta
@@ -23,15 +27,63 @@ class ChatRoom(models.Model):
     description = models.TextField(blank=True, null=True)
     max_participants = models.IntegerField(default=10)
 
+    # Change tracking for conditional GETs: bumped whenever the room itself,
+    # its messages or its participants change
+    version = models.PositiveBigIntegerField(default=0)
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    modified_at = models.DateTimeField(null=True, blank=True)
+
     class Meta:
         db_table = 'chat_rooms'
         verbose_name = 'Chat Room'
         verbose_name_plural = 'Chat Rooms'
         ordering = ['-created_at']
+        indexes = [
+            # Case-insensitive prefix search from the dashboard
+            models.Index(Lower('name'), name='chat_room_name_lower_idx'),
+        ]
+
+    # Moved only by bump_version's queryset updates
+    VERSION_FIELDS = ('version', 'last_message_id', 'modified_at')
 
     def __str__(self):
         return f"{self.name} ({self.room_type})"
 
+    def save(self, *args, **kwargs):
+        # A stale instance must not roll the version back and reuse an old ETag
+        if not self._state.adding and not args and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.VERSION_FIELDS
+            ]
+        super().save(*args, **kwargs)
+
+    @property
+    def group_name(self):
+        """Channel layer group the room's consumers join"""
+        return f'chat_{self.name}'
+
+    @classmethod
+    def version_changes(cls, last_message_id=None, refresh_last_message=False):
+        """
+        The update that records a room change. ``last_message_id`` raises the
+        stored last message id; ``refresh_last_message`` recomputes it after deletes.
+        """
+        changes = {'version': F('version') + 1, 'modified_at': timezone.now()}
+        if refresh_last_message:
+            changes['last_message_id'] = Subquery(
+                Message.objects.filter(room=OuterRef('pk'), is_deleted=False)
+                .order_by('-id').values('id')[:1]
+            )
+        elif last_message_id is not None:
+            changes['last_message_id'] = Greatest(Coalesce('last_message_id', Value(0)), Value(last_message_id))
+        return changes
+
+    @classmethod
+    def bump_version(cls, room_ids, last_message_id=None, refresh_last_message=False):
+        """Record that rooms changed (see ``version_changes``)"""
+        cls.objects.filter(pk__in=room_ids).update(**cls.version_changes(last_message_id, refresh_last_message))
+
     def get_participants_count(self):
         return self.participants.count()
 
@@ -59,6 +111,7 @@ class Message(models.Model):
     # Timestamps
     timestamp = models.DateTimeField(auto_now_add=True)
     edited_at = models.DateTimeField(null=True, blank=True)
+    deleted_at = models.DateTimeField(null=True, blank=True)
     
     # Message status
     is_read = models.BooleanField(default=False)
@@ -75,7 +128,7 @@ class Message(models.Model):
     # File attachments (if any)
     file_attachment = models.FileField(upload_to='chat_attachments/', null=True, blank=True)
     file_name = models.CharField(max_length=255, blank=True, null=True)
-    file_size = models.IntegerField(null=True, blank=True)
+    file_size = models.BigIntegerField(null=True, blank=True)
 
     class Meta:
         db_table = 'chat_messages'
@@ -84,8 +137,12 @@ class Message(models.Model):
         ordering = ['timestamp']
         indexes = [
             models.Index(fields=['room', 'timestamp']),
+            models.Index(fields=['room', 'id']),
             models.Index(fields=['sender', 'timestamp']),
             models.Index(fields=['is_read', 'sender']),
+            # Incremental backups pick up edits and deletions; most messages have neither
+            models.Index(fields=['edited_at'], name='chat_msg_edited_at_idx', condition=Q(edited_at__isnull=False)),
+            models.Index(fields=['deleted_at'], name='chat_msg_deleted_at_idx', condition=Q(deleted_at__isnull=False)),
         ]
 
     def __str__(self):
@@ -93,10 +150,11 @@ class Message(models.Model):
 
     def mark_as_read(self):
         self.is_read = True
-        self.save()
+        self.save(update_fields=['is_read'])
 
     def soft_delete(self):
         self.is_deleted = True
+        self.deleted_at = timezone.now()
         self.encrypted_content = "[deleted]"
         self.iv = ""
         self.save()
@@ -107,6 +165,146 @@ class Message(models.Model):
         return False
 
 
+class MessageToken(models.Model):
+    """
+    Blind keyword index: one row per (word, message), where the word is
+    stored only as a keyed HMAC. Postings for a token are read in
+    (room, message id) order from the composite index.
+    """
+    token = models.CharField(max_length=32)
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='+')
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='index_tokens')
+    count = models.PositiveSmallIntegerField(default=1)
+
+    class Meta:
+        db_table = 'chat_message_tokens'
+        verbose_name = 'Message Token'
+        verbose_name_plural = 'Message Tokens'
+        indexes = [
+            models.Index(fields=['token', 'room', 'message']),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['message', 'token'], name='unique_message_token'),
+        ]
+
+    def __str__(self):
+        return f"{self.token} -> {self.message_id}"
+
+
+class MessageArchive(models.Model):
+    """
+    A compressed block of old messages of one room, moved out of
+    ``chat_messages``. ``data`` holds their client payloads as a JSON list,
+    oldest first, compressed with ``codec``.
+    """
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='archives')
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    message_count = models.PositiveIntegerField()
+    codec = models.CharField(max_length=10)
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'chat_message_archives'
+        verbose_name = 'Message Archive'
+        verbose_name_plural = 'Message Archives'
+        indexes = [
+            models.Index(fields=['room', 'last_id']),
+        ]
+
+    def __str__(self):
+        return f"{self.room.name} #{self.first_id}-{self.last_id} ({self.message_count})"
+
+
+class AttachmentUpload(models.Model):
+    """
+    A resumable attachment upload. Chunks are encrypted into
+    ``MEDIA_ROOT/chat_attachments/<id>.enc`` as they arrive; once ``received``
+    reaches ``file_size`` the upload is attached to a new file message.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='uploads')
+    uploader = models.ForeignKey(User, on_delete=models.CASCADE, related_name='attachment_uploads')
+    file_name = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100, blank=True)
+    file_size = models.BigIntegerField()
+    segment_size = models.PositiveIntegerField()
+    received = models.BigIntegerField(default=0)
+    # Per-file AES key, itself encrypted with the attachment master key
+    wrapped_key = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    # Image previews: size -> content hash of the encrypted thumbnail
+    thumbnails = models.JSONField(default=dict, blank=True)
+    message = models.OneToOneField(
+        Message, on_delete=models.CASCADE, null=True, blank=True, related_name='upload'
+    )
+
+    class Meta:
+        db_table = 'chat_attachment_uploads'
+        verbose_name = 'Attachment Upload'
+        verbose_name_plural = 'Attachment Uploads'
+        indexes = [
+            models.Index(fields=['completed_at', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.file_name} ({self.received}/{self.file_size})"
+
+    @property
+    def is_complete(self):
+        return self.completed_at is not None
+
+
+class PendingNotification(models.Model):
+    """
+    A message a participant missed while offline, waiting to be mailed in
+    their next digest. Rows are removed once the digest is sent.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='pending_notifications')
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='+')
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='+')
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        db_table = 'chat_pending_notifications'
+        verbose_name = 'Pending Notification'
+        verbose_name_plural = 'Pending Notifications'
+        indexes = [
+            models.Index(fields=['user', 'created_at']),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'message'], name='unique_pending_notification'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} <- {self.message_id}"
+
+
+class ActivitySummaryRun(models.Model):
+    """
+    Progress of the daily activity summary for one day: summaries are sent
+    in user id order and ``last_user_id`` is saved after every batch, so a
+    restarted run carries on where it stopped.
+    """
+    day = models.DateField(unique=True)
+    last_user_id = models.BigIntegerField(default=0)
+    sent = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'chat_activity_summary_runs'
+        verbose_name = 'Activity Summary Run'
+        verbose_name_plural = 'Activity Summary Runs'
+
+    def __str__(self):
+        return f"{self.day} ({'done' if self.completed_at else f'after user {self.last_user_id}'})"
+
+
 class Contact(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='contacts')
     contact_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='added_by')
@@ -120,6 +318,9 @@ class Contact(models.Model):
         verbose_name_plural = 'Contacts'
         unique_together = ['user', 'contact_user']
         ordering = ['nickname', 'contact_user__username']
+        indexes = [
+            models.Index('user', Lower('nickname'), name='contact_nickname_lower_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} -> {self.contact_user.username}"
@@ -0,0 +1,218 @@
+"""
+One WebSocket for many rooms.
+
+``ws/chat/`` serves ``MultiplexChatConsumer``: the client authenticates and
+goes online once, then subscribes to rooms over the open socket. Frames in
+both directions carry a ``room`` field:
+
+    -> {"type": "subscribe", "room": "general", "last_message_id": 41}
+    <- {"type": "subscribed", "room": "general"}
+    -> {"type": "chat_message", "room": "general", "message": "..."}
+    <- {"type": "chat_message", "room": "general", "message_id": 42, ...}
+    -> {"type": "unsubscribe", "room": "general"}
+
+Room events are the same as on ``ws/chat/<room_name>/``, in the same
+negotiated encoding (see framing.py). Subscribing checks
+membership and joins the room's channel group; auth, presence and the
+connection count happen once per socket instead of once per room. At most
+``CHAT_MULTIPLEX_MAX_ROOMS`` rooms can be subscribed at a time.
+"""
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from django.utils import timezone
+
+from apps.analytics.connections import connection_closed, connection_opened
+from apps.monitoring.metrics import (
+    MESSAGE_DB_SECONDS, WS_CONNECTIONS, WS_CONNECTS, WS_DELIVERIES, WS_EVENT_SECONDS, WS_GROUP_SENDS,
+)
+from apps.monitoring.profiling import ProfiledConsumerMixin
+from .consumers import CLIENT_EVENTS, build_message, chat_message_frame, event_payload, save_chat_message
+from .framing import FramedConsumerMixin
+from .history import message_history
+from .store import chat_store
+
+
+class MultiplexChatConsumer(ProfiledConsumerMixin, FramedConsumerMixin, AsyncWebsocketConsumer):
+    store = chat_store
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user = None
+        self.rooms = {}
+        self.accepted = False
+
+    async def connect(self):
+        self.user = self.scope['user']
+        if self.user.is_anonymous:
+            WS_CONNECTS.labels('anonymous').inc()
+            await self.close(code=4001)
+            return
+
+        await self.store.set_presence(self.user.id, True)
+        await self.accept()
+        self.accepted = True
+        WS_CONNECTS.labels('accepted').inc()
+        WS_CONNECTIONS.inc()
+        await connection_opened()
+
+    async def disconnect(self, close_code):
+        if not self.accepted:
+            return
+        self.accepted = False
+        WS_CONNECTIONS.dec()
+        await connection_closed()
+        for name in list(self.rooms):
+            await self.leave(name)
+        await self.store.set_presence(self.user.id, False)
+
+    async def receive_frame(self, data):
+        message_type = data.get('type', 'chat_message')
+        name = data.get('room')
+        try:
+            if message_type == 'subscribe':
+                last_message_id = data.get('last_message_id')
+                await self.subscribe(name, None if last_message_id is None else int(last_message_id))
+            elif message_type == 'unsubscribe':
+                if name in self.rooms:
+                    await self.leave(name)
+                await self.send_frame({'type': 'unsubscribed', 'room': name})
+            elif message_type in CLIENT_EVENTS:
+                if name not in self.rooms:
+                    await self.send_frame({'type': 'error', 'room': name, 'error': 'Not subscribed'})
+                    return
+                with WS_EVENT_SECONDS.labels(message_type).time():
+                    await getattr(self, f'handle_{message_type}')(self.rooms[name], data)
+        except Exception as e:
+            await self.send_frame({'type': 'error', 'room': name, 'error': str(e)})
+
+    async def subscribe(self, name, last_message_id=None):
+        """Join a room's group, replaying anything after ``last_message_id``"""
+        if name in self.rooms:
+            await self.send_frame({'type': 'subscribed', 'room': name})
+            return
+        if len(self.rooms) >= getattr(settings, 'CHAT_MULTIPLEX_MAX_ROOMS', 50):
+            await self.send_frame({'type': 'error', 'room': name, 'error': 'Too many rooms'})
+            return
+        room = await self.store.get_room(name) if isinstance(name, str) else None
+        if room is None or not await self.store.is_participant(room.id, self.user.id):
+            await self.send_frame({'type': 'error', 'room': name, 'error': 'Room not found'})
+            return
+
+        await self.channel_layer.group_add(room.group_name, self.channel_name)
+        if not message_history.acquire(room.id):
+            message_history.subscribe(room.id, await self.store.latest_message_id(room.id))
+        self.rooms[name] = room
+        await self.send_frame({'type': 'subscribed', 'room': name})
+
+        if last_message_id is not None:
+            await self.replay_missed_messages(room, last_message_id)
+        await self.broadcast(room, {
+            'type': 'user_joined',
+            'user_id': self.user.id,
+            'username': self.user.username,
+            'timestamp': timezone.now().isoformat(),
+        })
+
+    async def leave(self, name):
+        room = self.rooms.pop(name)
+        await self.channel_layer.group_discard(room.group_name, self.channel_name)
+        message_history.unsubscribe(room.id)
+        await self.broadcast(room, {
+            'type': 'user_left',
+            'user_id': self.user.id,
+            'username': self.user.username,
+            'timestamp': timezone.now().isoformat(),
+        })
+
+    async def replay_missed_messages(self, room, last_message_id):
+        limit = getattr(settings, 'CHAT_RESUME_MAX_MESSAGES', 500)
+        missed = message_history.since(room.id, last_message_id)
+        source = 'buffer'
+        if missed is None:
+            missed = await self.store.messages_after(room.id, last_message_id, limit + 1)
+            source = 'database'
+
+        if len(missed) > limit:
+            await self.send_frame({'type': 'resync_required', 'room': room.name})
+            return
+        for payload in missed:
+            await self.send_frame({**chat_message_frame(payload, replayed=True), 'room': room.name})
+        await self.send_frame({'type': 'resume_complete', 'room': room.name, 'count': len(missed), 'source': source})
+
+    async def handle_chat_message(self, room, data):
+        content = data.get('message', '').strip()
+        if not content:
+            return
+        reply_to_id = data.get('reply_to')
+        with MESSAGE_DB_SECONDS.time():
+            reply_to = await self.store.get_reply_to(room.id, reply_to_id) if reply_to_id else None
+            message = build_message(
+                room, self.user, content, reply_to, data.get('self_destruct', False), data.get('destroy_minutes', 0)
+            )
+            payload = await save_chat_message(self.store, message, self.user.username)
+        await self.broadcast(room, {'type': 'chat_message', **payload})
+
+    async def handle_typing_start(self, room, data):
+        await self.broadcast(room, {
+            'type': 'typing_indicator', 'user_id': self.user.id, 'username': self.user.username, 'typing': True,
+        })
+
+    async def handle_typing_stop(self, room, data):
+        await self.broadcast(room, {
+            'type': 'typing_indicator', 'user_id': self.user.id, 'username': self.user.username, 'typing': False,
+        })
+
+    async def handle_message_read(self, room, data):
+        message_id = data.get('message_id')
+        if message_id:
+            await self.store.mark_read(room.id, message_id)
+            await self.broadcast(room, {
+                'type': 'message_read', 'message_id': message_id,
+                'user_id': self.user.id, 'username': self.user.username,
+            })
+
+    async def broadcast(self, room, event):
+        WS_GROUP_SENDS.labels(event['type']).inc()
+        await self.channel_layer.group_send(room.group_name, {**event, 'room': room.name})
+
+    async def dispatch(self, message):
+        if not message['type'].startswith('websocket.'):
+            WS_DELIVERIES.labels(message['type']).inc()
+        await super().dispatch(message)
+
+    # Group events; ones for a room left since they were sent are dropped
+    async def chat_message(self, event):
+        room = self.rooms.get(event['room'])
+        if room:
+            payload = event_payload(event)
+            message_history.append(room.id, payload)
+            await self.send_frame({**chat_message_frame(payload), 'room': room.name})
+
+    async def user_joined(self, event):
+        if event['room'] in self.rooms:
+            await self.send_frame(event)
+
+    async def user_left(self, event):
+        if event['room'] in self.rooms:
+            await self.send_frame(event)
+
+    async def typing_indicator(self, event):
+        if event['room'] in self.rooms:
+            await self.send_frame(event)
+
+    async def message_read(self, event):
+        room = self.rooms.get(event['room'])
+        if room:
+            message_history.mark_read(room.id, [event['message_id']])
+            await self.send_frame(event)
+
+    async def message_deleted(self, event):
+        room = self.rooms.get(event['room'])
+        if room:
+            message_history.discard(room.id, event['message_id'])
+            await self.send_frame(event)
+
+    async def message_edited(self, event):
+        room = self.rooms.get(event['room'])
+        if room:
+            message_history.replace(room.id, event_payload(event))
@@ -0,0 +1,135 @@
+"""
+Email digests of messages missed while offline.
+
+The send paths call ``queue_notifications`` with the messages they saved;
+it records one ``PendingNotification`` per offline participant and
+message. ``send_digests`` (run periodically by the
+``send_notification_digests`` task) mails each user whose oldest pending
+notification is ``CHAT_NOTIFICATION_DIGEST_MINUTES`` old a single digest
+covering everything queued for them since, so a busy room costs one email
+per member per window instead of one per message. Digests go out through
+one reused mail connection, ``CHAT_NOTIFICATION_BATCH_SIZE`` at a time.
+
+Message bodies are end-to-end encrypted, so digests only name rooms,
+senders and counts.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import Count, Max, Min
+from django.utils import timezone
+
+from .models import ChatRoom, PendingNotification
+
+User = get_user_model()
+Participant = ChatRoom.participants.through
+
+
+def queue_notifications(messages):
+    """Queue the given saved messages for their rooms' offline participants"""
+    messages = [message for message in messages if message.message_type != 'system']
+    if not messages:
+        return 0
+
+    offline = {}
+    for room_id, user_id in (
+        Participant.objects.filter(chatroom_id__in={message.room_id for message in messages})
+        .exclude(customuser__presence__online_status=True)
+        .values_list('chatroom_id', 'customuser_id')
+    ):
+        offline.setdefault(room_id, []).append(user_id)
+
+    now = timezone.now()
+    rows = [
+        PendingNotification(user_id=user_id, room_id=message.room_id, message_id=message.id, created_at=now)
+        for message in messages
+        for user_id in offline.get(message.room_id, [])
+        if user_id != message.sender_id
+    ]
+    PendingNotification.objects.bulk_create(rows, ignore_conflicts=True)
+    return len(rows)
+
+
+def due_users(now=None, window_minutes=None):
+    """Users whose oldest pending notification has waited a full window"""
+    if window_minutes is None:
+        window_minutes = getattr(settings, 'CHAT_NOTIFICATION_DIGEST_MINUTES', 15)
+    cutoff = (now or timezone.now()) - timedelta(minutes=window_minutes)
+    return list(
+        PendingNotification.objects.values('user_id')
+        .annotate(oldest=Min('created_at'))
+        .filter(oldest__lte=cutoff)
+        .order_by('user_id')
+        .values_list('user_id', flat=True)
+    )
+
+
+def render_digest(user, rooms):
+    """The digest email for one user; ``rooms`` maps room name -> {sender: count}"""
+    total = sum(sum(senders.values()) for senders in rooms.values())
+    lines = []
+    for room_name, senders in sorted(rooms.items()):
+        names = ', '.join(sorted(senders))
+        count = sum(senders.values())
+        lines.append(f"    - {room_name}: {count} new message{'s' if count != 1 else ''} from {names}")
+    body = f"""
+    Hello {user['username']},
+
+    You have {total} new message{'s' if total != 1 else ''} on CipherTalk while you were away:
+
+{chr(10).join(lines)}
+
+    Login to CipherTalk to read and reply to them.
+
+    Best regards,
+    The CipherTalk Team
+    """
+    return EmailMessage(
+        f"{total} new message{'s' if total != 1 else ''} - CipherTalk",
+        body,
+        settings.DEFAULT_FROM_EMAIL,
+        [user['email']],
+    )
+
+
+def build_digests(user_ids, upto):
+    """One digest per user, covering their pending notifications up to id ``upto``"""
+    pending = PendingNotification.objects.filter(user_id__in=user_ids, pk__lte=upto, message__is_deleted=False)
+    rooms = {}
+    for user_id, room_name, sender, count in (
+        pending.values_list('user_id', 'room__name', 'message__sender__username')
+        .annotate(count=Count('id')).order_by()
+    ):
+        rooms.setdefault(user_id, {}).setdefault(room_name, {})[sender] = count
+
+    users = User.objects.filter(pk__in=list(rooms)).exclude(email='').values('id', 'username', 'email')
+    return [render_digest(user, rooms[user['id']]) for user in users]
+
+
+def send_digests(now=None, window_minutes=None, batch_size=None):
+    """Send the digests that are due; returns how many were sent"""
+    batch_size = batch_size or getattr(settings, 'CHAT_NOTIFICATION_BATCH_SIZE', 100)
+    users = due_users(now, window_minutes)
+    if not users:
+        return 0
+    # Notifications queued while sending wait for the next digest
+    upto = PendingNotification.objects.aggregate(top=Max('pk'))['top']
+
+    # Users who came back online have seen their messages
+    online = set(
+        User.objects.filter(pk__in=users, presence__online_status=True).values_list('pk', flat=True)
+    )
+    PendingNotification.objects.filter(user_id__in=online, pk__lte=upto).delete()
+    users = [user_id for user_id in users if user_id not in online]
+
+    sent = 0
+    with get_connection() as connection:
+        for start in range(0, len(users), batch_size):
+            batch = users[start:start + batch_size]
+            digests = build_digests(batch, upto)
+            if digests:
+                sent += connection.send_messages(digests) or 0
+            PendingNotification.objects.filter(user_id__in=batch, pk__lte=upto).delete()
+    return sent
@@ -0,0 +1,30 @@
+"""
+The message payload sent to clients, cached in history and archived.
+"""
+from .attachments import describe
+
+# Relations read by ``serialize_message``; select them with the messages
+PAYLOAD_RELATED = ('sender', 'reply_to__sender', 'upload')
+
+
+def serialize_message(message, sender_username=None):
+    """Build the payload broadcast to clients for a message"""
+    reply_to = message.reply_to if message.reply_to_id else None
+    return {
+        'message_id': message.id,
+        'sender_id': message.sender_id,
+        'sender_username': sender_username or message.sender.username,
+        'encrypted_content': message.encrypted_content,
+        'iv': message.iv,
+        'message_type': message.message_type,
+        'timestamp': message.timestamp.isoformat(),
+        'edited_at': message.edited_at.isoformat() if message.edited_at else None,
+        'is_read': message.is_read,
+        'is_edited': message.is_edited,
+        'reply_to': message.reply_to_id,
+        'reply_to_sender': reply_to.sender.username if reply_to else None,
+        'reply_to_content': reply_to.encrypted_content[:50] if reply_to else None,
+        'self_destruct': message.self_destruct,
+        'destroy_after': message.destroy_after.isoformat() if message.destroy_after else None,
+        'attachment': describe(message) if message.file_attachment else None,
+    }
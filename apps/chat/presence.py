@@ -0,0 +1,115 @@
+"""
+Contact presence lookups.
+
+A contact list is read with one query joining each contact's presence
+and profile rows, instead of one presence query per contact. Users who
+turned off ``show_online_status`` always appear offline. When
+``CHAT_PRESENCE_CACHE`` is on, consumers also write presence changes to
+the Django cache and readers overlay those fresher values on the rows.
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from apps.users.thumbnails import avatar_url
+from .models import Contact
+
+CONTACT_FIELDS = (
+    'contact_user_id',
+    'contact_user__username',
+    'contact_user__email',
+    'contact_user__presence__online_status',
+    'contact_user__profile__show_online_status',
+    'contact_user__profile__avatar_thumbnails',
+    'nickname',
+)
+
+
+def presence_cache_enabled():
+    return getattr(settings, 'CHAT_PRESENCE_CACHE', False)
+
+
+def presence_key(user_id):
+    return f'chat:presence:{user_id}'
+
+
+def cache_presence(user_id, online):
+    """Record a presence change for the cached overlay"""
+    if presence_cache_enabled():
+        cache.set(presence_key(user_id), online, getattr(settings, 'CHAT_PRESENCE_CACHE_TIMEOUT', 300))
+
+
+def forget_presence(user_ids):
+    """Drop cached presence, e.g. after a bulk update in the database"""
+    if presence_cache_enabled() and user_ids:
+        cache.delete_many([presence_key(user_id) for user_id in user_ids])
+
+
+def cached_presence(user_ids):
+    """Map user id -> online for the users with a cached presence value"""
+    if not presence_cache_enabled() or not user_ids:
+        return {}
+    keys = {presence_key(user_id): user_id for user_id in user_ids}
+    return {keys[key]: online for key, online in cache.get_many(list(keys)).items()}
+
+
+def visible_online(online, show_online_status):
+    # Users without a profile row keep the model default of showing status
+    return bool(online) and show_online_status is not False
+
+
+def contacts_with_presence(user):
+    """Unblocked contacts of ``user`` with presence and profile joined in"""
+    return Contact.objects.filter(user=user, is_blocked=False).select_related(
+        'contact_user__presence', 'contact_user__profile'
+    )
+
+
+def is_visibly_online(user, online=None):
+    """
+    Online status of a user fetched through ``contacts_with_presence``;
+    pass ``online`` to use a cached value instead of the presence row.
+    """
+    if online is None:
+        presence = getattr(user, 'presence', None)
+        online = presence is not None and presence.online_status
+    profile = getattr(user, 'profile', None)
+    return visible_online(online, profile.show_online_status if profile is not None else None)
+
+
+def with_online_flags(contacts):
+    """Evaluate contacts from ``contacts_with_presence``, setting ``online`` on each"""
+    contacts = list(contacts)
+    overlay = cached_presence([contact.contact_user_id for contact in contacts])
+    for contact in contacts:
+        contact.online = is_visibly_online(contact.contact_user, overlay.get(contact.contact_user_id))
+    return contacts
+
+
+def contact_values(user):
+    """Unblocked contacts of ``user`` as ``values()`` rows, presence and profile joined in"""
+    return Contact.objects.filter(user=user, is_blocked=False).values(*CONTACT_FIELDS)
+
+
+def present_contacts(rows):
+    """Turn ``contact_values`` rows into contact list entries"""
+    rows = list(rows)
+    overlay = cached_presence([row['contact_user_id'] for row in rows])
+    return [
+        {
+            'id': row['contact_user_id'],
+            'username': row['contact_user__username'],
+            'email': row['contact_user__email'],
+            'online': visible_online(
+                overlay.get(row['contact_user_id'], row['contact_user__presence__online_status']),
+                row['contact_user__profile__show_online_status'],
+            ),
+            'nickname': row['nickname'],
+            'avatar': avatar_url(row['contact_user__profile__avatar_thumbnails'], 96),
+        }
+        for row in rows
+    ]
+
+
+def contact_list_rows(user):
+    """The JSON rows of the contact list endpoint, in one query"""
+    return present_contacts(contact_values(user))
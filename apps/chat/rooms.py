@@ -0,0 +1,49 @@
+"""
+Room list queries shared by the dashboard and the REST API.
+
+Counts and the latest message are correlated subqueries on the room row,
+and the latest message is found through ``ChatRoom.last_message_id``, so a
+page of rooms is one query however many rooms or messages there are.
+"""
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .models import ChatRoom, Message
+
+# Rows of the room <-> user many-to-many table
+Participant = ChatRoom.participants.through
+
+
+def count_subquery(queryset, group_by):
+    """Correlated COUNT(*) of ``queryset`` as an annotation (0 when empty)"""
+    counts = queryset.order_by().values(group_by).annotate(n=Count('*')).values('n')
+    return Coalesce(Subquery(counts, output_field=IntegerField()), Value(0))
+
+
+def rooms_for(user):
+    """The user's active rooms"""
+    return ChatRoom.objects.filter(
+        pk__in=Participant.objects.filter(customuser=user).values('chatroom_id'),
+        is_active=True,
+    )
+
+
+def with_summary(rooms, user):
+    """Annotate participant and unread counts and the latest message's details"""
+    last_message = Message.objects.filter(pk=OuterRef('last_message_id'))
+    return rooms.annotate(
+        participants_count=count_subquery(Participant.objects.filter(chatroom=OuterRef('pk')), 'chatroom'),
+        unread_count=count_subquery(
+            Message.objects.filter(room=OuterRef('pk'), is_read=False, is_deleted=False)
+            .exclude(sender=user),
+            'room',
+        ),
+        last_message_sender=Subquery(last_message.values('sender__username')[:1]),
+        last_message_type=Subquery(last_message.values('message_type')[:1]),
+        last_message_timestamp=Subquery(last_message.values('timestamp')[:1]),
+    )
+
+
+def recent_first(rooms):
+    """Rooms with the newest activity first; rooms without messages last"""
+    return rooms.order_by(F('last_message_id').desc(nulls_last=True), '-created_at')
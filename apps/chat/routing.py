@@ -1,6 +1,8 @@
 from django.urls import re_path
-from . import consumers
+from . import consumers, multiplex
 
 websocket_urlpatterns = [
+    # One socket, many rooms (see multiplex.py)
+    re_path(r'ws/chat/$', multiplex.MultiplexChatConsumer.as_asgi()),
     re_path(r'ws/chat/(?P<room_name>.+)/$', consumers.ChatConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -0,0 +1,188 @@
+"""
+Search: messages over a blind keyword index, rooms and contacts by prefix.
+
+Message bodies are stored encrypted, so they cannot be searched with SQL.
+Instead the send path normalizes the words of each message while it still
+has the plaintext and stores a keyed HMAC of each word in
+``MessageToken``. A query is normalized and hashed the same way and
+answered from the token index: messages in the user's rooms are ranked by
+how many query words they contain, then by how often, then newest first.
+Only HMACs are stored; without ``CHAT_SEARCH_KEY`` they cannot be turned
+back into words.
+
+Archiving a message deletes its tokens (see archive.py), so archived
+messages are no longer found.
+
+Room names and contact names are plaintext and are matched by
+case-insensitive prefix against ``Lower()`` expression indexes.
+"""
+import hashlib
+import hmac
+import re
+import unicodedata
+from collections import Counter
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Lower
+from django.urls import reverse
+
+from apps.users.thumbnails import profile_avatar_url
+from .history import serialize_message
+from .models import ChatRoom, Message, MessageToken
+from .presence import contacts_with_presence, with_online_flags
+from .rooms import rooms_for
+
+_WORD = re.compile(r'\w+')
+
+MIN_WORD_LENGTH = 2
+MAX_QUERY_WORDS = 8
+
+
+@lru_cache(maxsize=4)
+def _derive_key(secret):
+    return hashlib.sha256(b'ciphertalk.chat.search:' + secret.encode()).digest()
+
+
+def search_key():
+    return _derive_key(getattr(settings, 'CHAT_SEARCH_KEY', '') or settings.SECRET_KEY)
+
+
+def normalize_words(text):
+    """Case-folded, NFKC-normalized words of ``text``, in order, repeats kept"""
+    text = unicodedata.normalize('NFKC', text).casefold()
+    return [word for word in _WORD.findall(text) if len(word) >= MIN_WORD_LENGTH]
+
+
+def blind_token(word):
+    return hmac.new(search_key(), word.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def message_tokens(text):
+    """Map token -> occurrences for the words of a message"""
+    limit = getattr(settings, 'CHAT_SEARCH_MAX_TOKENS', 64)
+    counts = Counter(normalize_words(text))
+    return {blind_token(word): min(count, 32767) for word, count in counts.most_common(limit)}
+
+
+def prepare(message, plaintext):
+    """Attach the tokens of ``plaintext`` to an unsaved message for ``index_messages``"""
+    message.pending_search_tokens = message_tokens(plaintext)
+    return message
+
+
+def index_messages(messages):
+    """Store the pending tokens of saved messages in one insert"""
+    rows = [
+        MessageToken(token=token, room_id=message.room_id, message_id=message.id, count=count)
+        for message in messages
+        for token, count in getattr(message, 'pending_search_tokens', {}).items()
+    ]
+    if rows:
+        MessageToken.objects.bulk_create(rows, ignore_conflicts=True)
+    for message in messages:
+        message.pending_search_tokens = {}
+
+
+def forget_message(message_id):
+    MessageToken.objects.filter(message_id=message_id).delete()
+
+
+def search_messages(user, query, page=1, page_size=20):
+    """
+    One page of ranked matches in the user's active rooms. Returns the
+    serialized messages (each with ``score``, the number of query words it
+    contains) and whether another page follows.
+    """
+    tokens = list(dict.fromkeys(blind_token(word) for word in normalize_words(query)))[:MAX_QUERY_WORDS]
+    if not tokens:
+        return [], False
+
+    rooms = ChatRoom.participants.through.objects.filter(
+        customuser=user, chatroom__is_active=True
+    ).values('chatroom_id')
+    offset = (page - 1) * page_size
+    ranked = list(
+        MessageToken.objects.filter(token__in=tokens, room__in=rooms)
+        .values('message_id')
+        .annotate(matched=Count('token'), weight=Sum('count'))
+        .order_by('-matched', '-weight', '-message_id')[offset:offset + page_size + 1]
+    )
+    has_next = len(ranked) > page_size
+    ranked = ranked[:page_size]
+
+    messages = Message.objects.filter(
+        pk__in=[row['message_id'] for row in ranked], is_deleted=False
+    ).select_related('room', 'sender', 'reply_to__sender', 'upload').in_bulk()
+    results = [
+        {
+            **serialize_message(messages[row['message_id']]),
+            'room': messages[row['message_id']].room.name,
+            'score': row['matched'],
+        }
+        for row in ranked if row['message_id'] in messages
+    ]
+    return results, has_next
+
+
+def prefix_filter(field, prefix):
+    """
+    Match a lowercased ``field`` starting with ``prefix``. The range lets
+    an index on ``Lower(field)`` narrow the scan; ``startswith`` keeps the
+    result exact under collations that are not plain code-point order.
+    """
+    match = Q(**{f'{field}__startswith': prefix})
+    if ord(prefix[-1]) < 0x10FFFF:
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        match &= Q(**{f'{field}__gte': prefix, f'{field}__lt': upper})
+    return match
+
+
+def directory_matches(user, query, limit):
+    """Rooms and contacts of ``user`` whose names start with ``query``"""
+    prefix = unicodedata.normalize('NFKC', query).strip().lower()
+    if not prefix:
+        return {'rooms': [], 'contacts': []}
+
+    rooms = (
+        rooms_for(user).alias(name_lower=Lower('name'))
+        .filter(prefix_filter('name_lower', prefix))
+        .order_by('name').values('name', 'room_type')[:limit]
+    )
+    contacts = with_online_flags(
+        contacts_with_presence(user)
+        .alias(nickname_lower=Lower('nickname'), username_lower=Lower('contact_user__username'))
+        .filter(prefix_filter('nickname_lower', prefix) | prefix_filter('username_lower', prefix))[:limit]
+    )
+    return {
+        'rooms': [
+            {**room, 'url': reverse('chat:room', args=[room['name']])}
+            for room in rooms
+        ],
+        'contacts': [
+            {
+                'username': contact.contact_user.username,
+                'nickname': contact.nickname,
+                'online': contact.online,
+                'avatar': profile_avatar_url(getattr(contact.contact_user, 'profile', None), 96),
+                'url': reverse('chat:private_chat', args=[contact.contact_user.username]),
+            }
+            for contact in contacts
+        ],
+    }
+
+
+def cached_directory_matches(user, query, limit):
+    """
+    ``directory_matches`` behind a short per-user cache, so the repeated
+    prefixes of a user typing and deleting are answered without queries.
+    """
+    digest = hashlib.md5(f'{query.strip().lower()}:{limit}'.encode()).hexdigest()
+    key = f'chat:directory-search:{user.id}:{digest}'
+    matches = cache.get(key)
+    if matches is None:
+        matches = directory_matches(user, query, limit)
+        cache.set(key, matches, getattr(settings, 'CHAT_DIRECTORY_SEARCH_CACHE_TIMEOUT', 30))
+    return matches
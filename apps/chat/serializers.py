@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from .models import ChatRoom, Message, Contact
+from .presence import is_visibly_online
 
 
 class UserSerializer(serializers.Serializer):
@@ -63,4 +64,5 @@ class ContactSerializer(serializers.ModelSerializer):
         ]
 
     def get_contact_online(self, obj):
-        return hasattr(obj.contact_user, 'presence') and obj.contact_user.presence.online_status
\ No newline at end of file
+        # Serialize querysets from presence.contacts_with_presence to avoid a query per contact
+        return is_visibly_online(obj.contact_user)
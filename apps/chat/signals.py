@@ -1,7 +1,11 @@
-from django.db.models.signals import post_save
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db.models.signals import m2m_changed, post_save, post_delete
 from django.dispatch import receiver
 from django.contrib.auth import get_user_model
-from .models import UserPresence
+from .models import ChatRoom, Message, UserPresence
+from .history import message_history, serialize_message
+from .search import forget_message
 
 User = get_user_model()
 
@@ -11,4 +15,85 @@ def create_user_presence(sender, instance, created, **kwargs):
     Automatically create UserPresence when a new User is created
     """
     if created:
-        UserPresence.objects.create(user=instance)
\ No newline at end of file
+        UserPresence.objects.create(user=instance)
+
+
+def broadcast_to_room(room_id, event):
+    """Send an event to every consumer of a room, from synchronous code"""
+    room_name = ChatRoom.objects.filter(pk=room_id).values_list('name', flat=True).first()
+    channel_layer = get_channel_layer()
+    if room_name is None or channel_layer is None:
+        return
+    async_to_sync(channel_layer.group_send)(ChatRoom(name=room_name).group_name, {**event, 'room': room_name})
+
+
+@receiver(post_save, sender=Message)
+def sync_message_history(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Keep the recent-message buffers in step with edits, deletes and expiry.
+    New messages are recorded by the send paths themselves.
+    """
+    if created:
+        return
+
+    if update_fields and set(update_fields) <= {'is_read'}:
+        message_history.mark_read(instance.room_id, [instance.id])
+        message_history.invalidate(instance.room_id)
+        return
+
+    if instance.is_deleted:
+        forget_message(instance.id)
+        message_history.discard(instance.room_id, instance.id)
+        event = {'type': 'message_deleted', 'message_id': instance.id}
+    else:
+        payload = serialize_message(instance)
+        message_history.replace(instance.room_id, payload)
+        event = {'type': 'message_edited', **payload}
+
+    message_history.invalidate(instance.room_id)
+    broadcast_to_room(instance.room_id, event)
+
+
+@receiver(post_delete, sender=Message)
+def forget_deleted_message(sender, instance, **kwargs):
+    """Drop hard-deleted messages from the recent-message buffers"""
+    message_history.discard(instance.room_id, instance.id)
+    message_history.invalidate(instance.room_id)
+    broadcast_to_room(instance.room_id, {'type': 'message_deleted', 'message_id': instance.id})
+
+
+@receiver(post_save, sender=Message)
+def bump_room_on_save(sender, instance, created, **kwargs):
+    """Move the room's version on every new, edited, read or deleted message"""
+    if created:
+        ChatRoom.bump_version([instance.room_id], last_message_id=instance.id)
+    else:
+        ChatRoom.bump_version([instance.room_id], refresh_last_message=instance.is_deleted)
+
+
+@receiver(post_delete, sender=Message)
+def bump_room_on_delete(sender, instance, **kwargs):
+    ChatRoom.bump_version([instance.room_id], refresh_last_message=True)
+
+
+@receiver(post_save, sender=ChatRoom)
+def bump_room_on_edit(sender, instance, created, raw=False, **kwargs):
+    """Room lists show the room's own fields too, so a rename or type change is a change"""
+    if not created and not raw:
+        ChatRoom.bump_version([instance.pk])
+
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def bump_room_on_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    """Participant changes alter room lists, from either side of the relation"""
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            ChatRoom.bump_version([instance.pk])
+        return
+    # instance is a user; pk_set holds room ids, except on clear
+    if action == 'pre_clear':
+        instance._cleared_room_ids = list(instance.chat_rooms.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        ChatRoom.bump_version(getattr(instance, '_cleared_room_ids', []))
+    elif action in ('post_add', 'post_remove'):
+        ChatRoom.bump_version(pk_set)
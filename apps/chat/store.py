@@ -0,0 +1,214 @@
+"""
+Database access for the chat consumer.
+
+Two implementations share one interface, picked with ``CHAT_DB_ACCESS``:
+
+- ``ThreadedChatStore`` ('threaded') wraps sync ORM calls in
+  ``database_sync_to_async``. Channels sets no thread-sensitive context,
+  so every such call in the process queues for the same single thread and
+  one slow query holds up every socket.
+- ``AsyncChatStore`` ('async', the default) uses the async queryset API
+  (``aget``, ``aexists``, ``afirst``, ``aupdate``, ``acreate``), one
+  statement per step where it can: read receipts are a conditional UPDATE
+  instead of a SELECT plus a save, and presence is an UPDATE that only
+  inserts for users without a row. Calls run in one of ``CHAT_DB_LANES``
+  lanes. A lane is a thread-sensitive context, so it has its own thread and
+  so its own database connection. Like ``database_sync_to_async``, each
+  block starts and ends with ``close_old_connections``: with
+  ``CONN_MAX_AGE`` > 0 (the PostgreSQL profile without a pool) the lane
+  keeps its connection for that long; with 0 (SQLite, or PostgreSQL with
+  a pool) every block connects afresh, or borrows from the pool.
+  The lane pool doubles as the concurrency limiter: at most that many
+  queries run at once, and callers beyond that wait for a free lane rather
+  than opening more connections. SQLite allows a single writer, so it gets
+  one lane unless configured.
+
+Django 5.2's async queryset methods still run the query with
+``sync_to_async``; the lanes are what let them run side by side. Code
+called from a sync caller through ``async_to_sync`` (tests, management
+commands) runs on that caller's thread instead, as asgiref requires.
+"""
+import asyncio
+import weakref
+from contextlib import asynccontextmanager
+
+from asgiref.sync import SyncToAsync, sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.utils import timezone
+
+from . import notifications, search
+from .archive import page_after
+from .history import message_history
+from .models import ChatRoom, Message, UserPresence
+from .presence import cache_presence
+
+Participant = ChatRoom.participants.through
+
+
+def save_message(message):
+    """Insert a built message with its search tokens and notifications"""
+    with transaction.atomic():
+        message.save()
+        search.index_messages([message])
+        notifications.queue_notifications([message])
+    return message
+
+
+class ThreadedChatStore:
+    """Each call is a ``database_sync_to_async`` hop on the shared thread"""
+
+    @database_sync_to_async
+    def get_room(self, name):
+        try:
+            return ChatRoom.objects.get(name=name, is_active=True)
+        except ChatRoom.DoesNotExist:
+            return None
+
+    @database_sync_to_async
+    def is_participant(self, room_id, user_id):
+        return Participant.objects.filter(chatroom_id=room_id, customuser_id=user_id).exists()
+
+    @database_sync_to_async
+    def latest_message_id(self, room_id):
+        return Message.objects.filter(room_id=room_id).order_by('-id').values_list('id', flat=True).first() or 0
+
+    @database_sync_to_async
+    def messages_after(self, room_id, after, limit):
+        return page_after(room_id, after, limit)[0]
+
+    @database_sync_to_async
+    def get_reply_to(self, room_id, message_id):
+        return Message.objects.select_related('sender').filter(pk=message_id, room_id=room_id).first()
+
+    @database_sync_to_async
+    def save_message(self, message):
+        return save_message(message)
+
+    @database_sync_to_async
+    def mark_read(self, room_id, message_id):
+        try:
+            message = Message.objects.get(pk=message_id, room_id=room_id)
+        except Message.DoesNotExist:
+            return False
+        message.mark_as_read()
+        return True
+
+    @database_sync_to_async
+    def set_presence(self, user_id, online):
+        presence, _ = UserPresence.objects.get_or_create(user_id=user_id)
+        presence.online_status = online
+        if not online:
+            presence.typing_in = None
+        presence.save()
+        cache_presence(user_id, online)
+
+
+class _Lane:
+    """Key for one thread-sensitive executor (and so one DB connection)"""
+
+
+class AsyncChatStore:
+    def __init__(self, lanes=None):
+        self.lanes = lanes
+        self._pools = weakref.WeakKeyDictionary()
+
+    def lane_count(self):
+        if self.lanes is None:
+            default = 1 if connection.vendor == 'sqlite' else 8
+            self.lanes = getattr(settings, 'CHAT_DB_LANES', None) or default
+        return self.lanes
+
+    def _pool(self):
+        loop = asyncio.get_running_loop()
+        pool = self._pools.get(loop)
+        if pool is None:
+            pool = self._pools[loop] = asyncio.Queue()
+            for _ in range(self.lane_count()):
+                pool.put_nowait(_Lane())
+        return pool
+
+    @asynccontextmanager
+    async def lane(self):
+        """Run the block's ORM calls on a free lane, waiting for one if needed"""
+        pool = self._pool()
+        lane = await pool.get()
+        token = SyncToAsync.thread_sensitive_context.set(lane)
+        try:
+            # As database_sync_to_async does, on the lane's own thread: drop
+            # connections past CONN_MAX_AGE or broken by an error
+            await sync_to_async(close_old_connections)()
+            yield
+        finally:
+            try:
+                await sync_to_async(close_old_connections)()
+            finally:
+                SyncToAsync.thread_sensitive_context.reset(token)
+            pool.put_nowait(lane)
+
+    async def get_room(self, name):
+        async with self.lane():
+            try:
+                return await ChatRoom.objects.aget(name=name, is_active=True)
+            except ChatRoom.DoesNotExist:
+                return None
+
+    async def is_participant(self, room_id, user_id):
+        async with self.lane():
+            return await Participant.objects.filter(chatroom_id=room_id, customuser_id=user_id).aexists()
+
+    async def latest_message_id(self, room_id):
+        async with self.lane():
+            latest = await Message.objects.filter(room_id=room_id).order_by('-id').values_list('id', flat=True).afirst()
+        return latest or 0
+
+    async def messages_after(self, room_id, after, limit):
+        async with self.lane():
+            return (await sync_to_async(page_after)(room_id, after, limit))[0]
+
+    async def get_reply_to(self, room_id, message_id):
+        async with self.lane():
+            return await Message.objects.select_related('sender').filter(pk=message_id, room_id=room_id).afirst()
+
+    async def save_message(self, message):
+        # A transaction has to stay on one thread, so this is one sync call
+        async with self.lane():
+            return await sync_to_async(save_message)(message)
+
+    async def mark_read(self, room_id, message_id):
+        async with self.lane():
+            updated = await Message.objects.filter(pk=message_id, room_id=room_id, is_read=False).aupdate(is_read=True)
+            if updated:
+                # update() skips post_save, so do what its handlers would
+                await ChatRoom.objects.filter(pk=room_id).aupdate(**ChatRoom.version_changes())
+        if updated:
+            message_history.mark_read(room_id, [message_id])
+            message_history.invalidate(room_id)
+        return bool(updated)
+
+    async def set_presence(self, user_id, online):
+        changes = {'online_status': online, 'last_seen': timezone.now()}
+        if not online:
+            changes['typing_in'] = None
+        async with self.lane():
+            if not await UserPresence.objects.filter(user_id=user_id).aupdate(**changes):
+                try:
+                    await UserPresence.objects.acreate(user_id=user_id, online_status=online)
+                except IntegrityError:
+                    # Created by a concurrent connect of the same user
+                    await UserPresence.objects.filter(user_id=user_id).aupdate(**changes)
+        cache_presence(user_id, online)
+
+
+def make_store(access=None):
+    access = access or getattr(settings, 'CHAT_DB_ACCESS', 'async')
+    if access == 'threaded':
+        return ThreadedChatStore()
+    if access == 'async':
+        return AsyncChatStore()
+    raise ValueError(f"Unknown CHAT_DB_ACCESS {access!r}")
+
+
+# Global instance used by the consumers
+chat_store = make_store()
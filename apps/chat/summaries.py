@@ -0,0 +1,119 @@
+"""
+Daily activity summary emails.
+
+``send_daily_summaries`` counts a day's messages with two grouped queries
+(per room, and per room and sender) and then walks the members of the
+rooms that had any, in user id order and ``CHAT_NOTIFICATION_BATCH_SIZE``
+users at a time. Each batch costs a fixed handful of queries and one
+``send_messages`` call on a shared mail connection, so the work follows
+the active rooms and their members rather than the whole user table.
+
+Progress is kept in ``ActivitySummaryRun``: after each batch is sent the
+last user id is saved, and a finished day is never sent again.
+"""
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import ActivitySummaryRun, ChatRoom, Message
+
+User = get_user_model()
+Participant = ChatRoom.participants.through
+
+
+def day_bounds(day):
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    return start, start + timedelta(days=1)
+
+
+def room_activity(day):
+    """``(totals, names, own)``: messages per room, room names, and messages per (room, sender)"""
+    start, end = day_bounds(day)
+    messages = Message.objects.filter(timestamp__gte=start, timestamp__lt=end, is_deleted=False).order_by()
+    totals, names = {}, {}
+    for room_id, room_name, count in messages.values_list('room_id', 'room__name').annotate(count=Count('id')):
+        totals[room_id] = count
+        names[room_id] = room_name
+    own = {
+        (room_id, sender_id): count
+        for room_id, sender_id, count in messages.values_list('room_id', 'sender_id').annotate(count=Count('id'))
+    }
+    return totals, names, own
+
+
+def render_summary(user, day, rooms):
+    """The summary email for one user; ``rooms`` is a list of (room name, count)"""
+    total = sum(count for _, count in rooms)
+    lines = '\n'.join(
+        f"    - {room_name}: {count} message{'s' if count != 1 else ''}"
+        for room_name, count in sorted(rooms, key=lambda room: (-room[1], room[0]))
+    )
+    body = f"""
+    Hello {user['username']},
+
+    Here is what happened in your CipherTalk rooms on {day:%A, %d %B %Y}:
+
+{lines}
+
+    Login to CipherTalk to catch up.
+
+    Best regards,
+    The CipherTalk Team
+    """
+    return EmailMessage(
+        f"Your CipherTalk activity: {total} new message{'s' if total != 1 else ''}",
+        body,
+        settings.DEFAULT_FROM_EMAIL,
+        [user['email']],
+    )
+
+
+def send_daily_summaries(day=None, batch_size=None):
+    """
+    Mail every member of a room that had messages from others on ``day``
+    (yesterday by default) a summary of them. Returns how many were sent
+    by this call; a day already completed sends nothing.
+    """
+    day = day or timezone.localdate() - timedelta(days=1)
+    batch_size = batch_size or getattr(settings, 'CHAT_NOTIFICATION_BATCH_SIZE', 100)
+    run, _ = ActivitySummaryRun.objects.get_or_create(day=day)
+    if run.completed_at is not None:
+        return 0
+
+    totals, names, own = room_activity(day)
+    members = Participant.objects.filter(chatroom_id__in=list(totals)).order_by()
+    sent = 0
+    with get_connection() as connection:
+        while True:
+            user_ids = list(
+                members.filter(customuser_id__gt=run.last_user_id)
+                .order_by('customuser_id').values_list('customuser_id', flat=True)
+                .distinct()[:batch_size]
+            )
+            if not user_ids:
+                break
+
+            rooms = {}
+            for user_id, room_id in members.filter(customuser_id__in=user_ids).values_list('customuser_id', 'chatroom_id'):
+                count = totals[room_id] - own.get((room_id, user_id), 0)
+                if count:
+                    rooms.setdefault(user_id, []).append((names[room_id], count))
+            users = (
+                User.objects.filter(pk__in=list(rooms), is_active=True).exclude(email='')
+                .values('id', 'username', 'email')
+            )
+            summaries = [render_summary(user, day, rooms[user['id']]) for user in users]
+            if summaries:
+                sent += connection.send_messages(summaries) or 0
+
+            run.last_user_id = user_ids[-1]
+            run.sent += len(summaries)
+            run.save(update_fields=['last_user_id', 'sent'])
+
+    run.completed_at = timezone.now()
+    run.save(update_fields=['completed_at'])
+    return sent
@@ -1,9 +1,14 @@
 from celery import shared_task
-from django.core.mail import send_mail
 from django.conf import settings
 from django.utils import timezone
-from datetime import timedelta
-from .models import Message, ChatRoom, UserPresence
+from datetime import date, timedelta
+from .archive import archive_messages
+from .attachments import discard_upload, make_thumbnails
+from .backup import run_backup
+from .models import AttachmentUpload, Message, ChatRoom, UserPresence
+from .notifications import send_digests
+from .presence import forget_presence
+from .summaries import send_daily_summaries
 
 
 @shared_task
@@ -27,31 +32,12 @@ def cleanup_expired_messages():
 
 
 @shared_task
-def send_message_notification(user_email, room_name, sender_username, message_preview):
+def send_notification_digests():
     """
-    Send email notification for new messages (when user is offline)
+    Email offline users one digest of the messages they missed
     """
-    subject = f'New message in {room_name} - CipherTalk'
-    message = f"""
-    Hello,
-    
-    You have a new message from {sender_username} in the chat room '{room_name}':
-    
-    "{message_preview}"
-    
-    Login to CipherTalk to view and reply to the message.
-    
-    Best regards,
-    The CipherTalk Team
-    """
-    
-    send_mail(
-        subject,
-        message,
-        settings.DEFAULT_FROM_EMAIL,
-        [user_email],
-        fail_silently=True,
-    )
+    count = send_digests()
+    return f"Sent {count} notification digests"
 
 
 @shared_task
@@ -65,27 +51,65 @@ def update_offline_users():
         last_seen__lte=threshold
     )
     
-    count = offline_users.count()
-    offline_users.update(online_status=False, typing_in=None)
+    user_ids = list(offline_users.values_list('user_id', flat=True))
+    count = offline_users.update(online_status=False, typing_in=None)
+    forget_presence(user_ids)
     
     return f"Updated {count} users to offline status"
 
 
 @shared_task
-def send_daily_activity_summary():
+def cleanup_stale_uploads():
     """
-    Send daily activity summary to users (optional feature)
+    Delete attachment uploads that were abandoned before completion
     """
-    # This would be implemented based on user preferences
-    # For now, it's a placeholder for future functionality
-    pass
+    threshold = timezone.now() - timedelta(hours=getattr(settings, 'CHAT_ATTACHMENT_UPLOAD_TTL_HOURS', 24))
+    stale_uploads = AttachmentUpload.objects.filter(completed_at__isnull=True, created_at__lte=threshold)
+
+    count = 0
+    for upload in stale_uploads.iterator():
+        discard_upload(upload)
+        count += 1
+
+    return f"Removed {count} stale uploads"
+
+
+@shared_task
+def send_daily_activity_summary(day=None):
+    """
+    Email room members a summary of a day's activity (yesterday by default)
+    """
+    count = send_daily_summaries(date.fromisoformat(day) if day else None)
+    return f"Sent {count} activity summaries"
 
 
 @shared_task
 def backup_chat_data():
     """
-    Backup chat data (placeholder for future implementation)
+    Back up the chat data added or changed since the last backup
+    """
+    manifest = run_backup()
+    rows = sum(segment['rows'] for segment in manifest['segments'])
+    return f"Backed up {rows} rows in {len(manifest['segments'])} segments to {manifest['id']}"
+
+
+@shared_task
+def generate_attachment_thumbnails(upload_id):
+    """
+    Make the encrypted previews of an uploaded image
+    """
+    upload = AttachmentUpload.objects.filter(pk=upload_id, completed_at__isnull=False).first()
+    if upload is None:
+        return "No completed upload"
+
+    thumbnails = make_thumbnails(upload)
+    return f"Generated {len(thumbnails)} thumbnails"
+
+
+@shared_task
+def archive_old_messages():
+    """
+    Move messages past the archive thresholds into compressed archive blocks
     """
-    # This would export chat data to secure storage
-    # Implementation depends on storage solution
-    pass
\ No newline at end of file
+    count = archive_messages()
+    return f"Archived {count} messages"
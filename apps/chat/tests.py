@@ -1,3 +1,1410 @@
-from django.test import TestCase
+import asyncio
+import base64
+import json
+import os
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.db.models import QuerySet
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from apps.users.models import CustomUser, UserProfile
+from .batching import GroupCommitWriter
+from .history import RoomHistoryBuffer, load_recent_messages, message_history, serialize_message
+from . import archive, attachments, backup, framing, notifications, search, summaries, tickets
+from .encryption import SegmentCipher
+from .models import (
+    ActivitySummaryRun, AttachmentUpload, ChatRoom, Contact, Message, MessageArchive, MessageToken, PendingNotification, UserPresence,
+)
+from .presence import cache_presence
+from .store import AsyncChatStore, ThreadedChatStore
+from .routing import websocket_urlpatterns
+from .tasks import cleanup_expired_messages
+
+
+def make_payload(message_id):
+    return {'message_id': message_id, 'encrypted_content': f'm{message_id}'}
+
+
+class RoomHistoryBufferTests(TestCase):
+    def test_untracked_room_is_not_served(self):
+        buffer = RoomHistoryBuffer(size=5)
+        buffer.append(1, make_payload(10))
+        self.assertIsNone(buffer.since(1, 0))
+
+    def test_serves_gap_above_floor(self):
+        buffer = RoomHistoryBuffer(size=5)
+        buffer.subscribe(1, floor=10)
+        for message_id in (11, 13, 12, 13):
+            buffer.append(1, make_payload(message_id))
+
+        missed = buffer.since(1, 11)
+        self.assertEqual([p['message_id'] for p in missed], [12, 13])
+        self.assertEqual(buffer.since(1, 13), [])
+        self.assertIsNone(buffer.since(1, 9))
+
+    def test_eviction_raises_floor(self):
+        buffer = RoomHistoryBuffer(size=2)
+        buffer.subscribe(1, floor=0)
+        for message_id in (1, 2, 3):
+            buffer.append(1, make_payload(message_id))
+
+        self.assertIsNone(buffer.since(1, 0))
+        self.assertEqual([p['message_id'] for p in buffer.since(1, 1)], [2, 3])
+
+    def test_last_unsubscribe_stops_tracking(self):
+        buffer = RoomHistoryBuffer(size=5)
+        buffer.subscribe(1, floor=0)
+        self.assertTrue(buffer.acquire(1))
+        buffer.unsubscribe(1)
+        buffer.unsubscribe(1)
+        self.assertFalse(buffer.acquire(1))
+
+
+class RecentMessageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user(
+            username='alice', email='alice@example.com', password='secret-pass'
+        )
+        self.room = ChatRoom.objects.create(name='general', room_type='group', created_by=self.user)
+        self.room.participants.add(self.user)
+        self.messages = [
+            Message.objects.create(room=self.room, sender=self.user, encrypted_content=f'c{i}', iv='')
+            for i in range(5)
+        ]
+
+    def test_tracked_room_is_served_from_process(self):
+        buffer = RoomHistoryBuffer(size=10)
+        buffer.subscribe(self.room.id, floor=0)
+        for message in self.messages:
+            buffer.append(self.room.id, serialize_message(message))
+
+        with self.assertNumQueries(0):
+            page = buffer.latest(self.room.id, 3)
+        self.assertEqual([p['message_id'] for p in page], [m.id for m in self.messages[-3:]])
+        self.assertEqual(buffer.stats()['hits'], 1)
+
+    def test_untracked_room_is_served_from_django_cache(self):
+        buffer = RoomHistoryBuffer(size=10)
+        first = buffer.latest(self.room.id, 3)
+        with self.assertNumQueries(0):
+            second = buffer.latest(self.room.id, 3)
+
+        self.assertEqual(first, second)
+        self.assertEqual(first, load_recent_messages(self.room.id, 3))
+        self.assertEqual(buffer.stats()['misses'], 1)
+        self.assertEqual(buffer.stats()['cache_hits'], 1)
+
+    def test_delete_invalidates_cached_page(self):
+        buffer = RoomHistoryBuffer(size=10)
+        buffer.latest(self.room.id, 3)
+        self.messages[-1].soft_delete()
+
+        page = buffer.latest(self.room.id, 3)
+        self.assertNotIn(self.messages[-1].id, [p['message_id'] for p in page])
+        self.assertEqual(buffer.stats()['misses'], 2)
+
+    def test_room_page_uses_history_cache(self):
+        self.client.force_login(self.user)
+        url = reverse('chat:room', args=[self.room.name])
+        self.client.get(url)
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['messages']), 5)
+        self.assertContains(response, f'data-message-id="{self.messages[0].id}"')
+
+
+class ChatConsumerResumeTests(TransactionTestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='alice', email='alice@example.com', password='secret-pass'
+        )
+        self.room = ChatRoom.objects.create(name='general', room_type='group', created_by=self.user)
+        self.room.participants.add(self.user)
+
+    def create_message(self, content='ciphertext'):
+        return Message.objects.create(room=self.room, sender=self.user, encrypted_content=content, iv='')
+
+    async def connect(self, path='/ws/chat/general/'):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path.lstrip('/'))
+        communicator.scope['user'] = self.user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual((await communicator.receive_json_from())['type'], 'user_joined')
+        return communicator
+
+    def test_resume_replays_from_database(self):
+        first = self.create_message()
+        second = self.create_message()
+        third = self.create_message()
+
+        async def run():
+            # Replayed messages arrive before the join notification
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), f'ws/chat/general/?last_message_id={first.id}'
+            )
+            communicator.scope['user'] = self.user
+            await communicator.connect()
+            events = [await communicator.receive_json_from() for _ in range(3)]
+            await communicator.disconnect()
+            return events
+
+        events = async_to_sync(run)()
+        self.assertEqual([e['message_id'] for e in events[:2]], [second.id, third.id])
+        self.assertTrue(events[0]['replayed'])
+        self.assertEqual(events[2], {'type': 'resume_complete', 'count': 2, 'source': 'database'})
+
+    def test_resume_uses_buffer_while_room_is_live(self):
+        before = self.create_message()
+
+        async def run():
+            listener = await self.connect()
+            await listener.send_json_to({'type': 'chat_message', 'message': 'hello'})
+            live = await listener.receive_json_from()
+
+            resumer = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), f'ws/chat/general/?last_message_id={before.id}'
+            )
+            resumer.scope['user'] = self.user
+            await resumer.connect()
+            replayed = await resumer.receive_json_from()
+            complete = await resumer.receive_json_from()
+            await resumer.disconnect()
+            await listener.disconnect()
+            return live, replayed, complete
+
+        live, replayed, complete = async_to_sync(run)()
+        self.assertEqual(replayed['message_id'], live['message_id'])
+        self.assertEqual(complete['source'], 'buffer')
+        self.assertFalse(message_history.acquire(self.room.id))
+
+    def test_resume_too_far_behind_requires_resync(self):
+        for _ in range(3):
+            self.create_message()
+
+        async def run():
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), 'ws/chat/general/?last_message_id=0'
+            )
+            communicator.scope['user'] = self.user
+            await communicator.connect()
+            event = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return event
+
+        with self.settings(CHAT_RESUME_MAX_MESSAGES=2):
+            event = async_to_sync(run)()
+        self.assertEqual(event, {'type': 'resync_required'})
+
+    def test_serialize_message_matches_broadcast_shape(self):
+        message = self.create_message()
+        payload = serialize_message(message)
+        self.assertEqual(payload['message_id'], message.id)
+        self.assertEqual(payload['sender_username'], 'alice')
+        self.assertIsNone(payload['reply_to'])
+
+
+class RoomVersionTests(TestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user(
+            username='alice', email='alice@example.com', password='secret-pass'
+        )
+        self.bob = CustomUser.objects.create_user(
+            username='bob', email='bob@example.com', password='secret-pass'
+        )
+        self.room = ChatRoom.objects.create(name='general', room_type='group', created_by=self.alice)
+        self.room.participants.add(self.alice)
+        self.client.force_login(self.alice)
+
+    def version(self):
+        self.room.refresh_from_db()
+        return self.room.version
+
+    def test_message_changes_move_version_and_last_message(self):
+        start = self.version()
+        first = Message.objects.create(room=self.room, sender=self.alice, encrypted_content='a', iv='')
+        second = Message.objects.create(room=self.room, sender=self.alice, encrypted_content='b', iv='')
+        self.assertEqual(self.version(), start + 2)
+        self.assertEqual(self.room.last_message_id, second.id)
+
+        second.mark_as_read()
+        self.assertEqual(self.version(), start + 3)
+        second.soft_delete()
+        self.assertEqual(self.version(), start + 4)
+        self.assertEqual(self.room.last_message_id, first.id)
+        first.delete()
+        self.assertEqual(self.version(), start + 5)
+        self.assertIsNone(self.room.last_message_id)
+
+    def test_membership_changes_move_version_from_both_sides(self):
+        start = self.version()
+        self.room.participants.add(self.bob)
+        self.assertEqual(self.version(), start + 1)
+        self.bob.chat_rooms.remove(self.room)
+        self.assertEqual(self.version(), start + 2)
+        self.bob.chat_rooms.add(self.room)
+        self.bob.chat_rooms.clear()
+        self.assertEqual(self.version(), start + 4)
+
+    def conditional_get(self, url, etag):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, headers={'if-none-match': etag})
+        statements = [
+            query['sql'] for query in queries.captured_queries
+            if 'django_session' not in query['sql'] and 'SAVEPOINT' not in query['sql']
+        ]
+        return response, statements
+
+    def test_unchanged_message_list_is_not_modified(self):
+        Message.objects.create(room=self.room, sender=self.alice, encrypted_content='a', iv='')
+        url = reverse('chat:message_list', args=[self.room.name])
+        etag = self.client.get(url)['ETag']
+
+        response, statements = self.conditional_get(url, etag)
+        self.assertEqual(response.status_code, 304)
+        # The user and the room's validators; the messages are never read
+        self.assertEqual(len(statements), 2)
+        self.assertFalse(any('chat_messages' in sql for sql in statements))
+
+        Message.objects.create(room=self.room, sender=self.bob, encrypted_content='b', iv='')
+        response, _ = self.conditional_get(url, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['messages']), 2)
+
+    def test_unchanged_room_list_is_not_modified(self):
+        url = reverse('chat:room_list')
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.conditional_get(url, etag)[0].status_code, 304)
+
+        other = ChatRoom.objects.create(name='other', room_type='group', created_by=self.bob)
+        other.participants.add(self.alice)
+        response, _ = self.conditional_get(url, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['rooms']), 2)
+
+    def test_renamed_room_changes_room_list(self):
+        url = reverse('chat:room_list')
+        etag = self.client.get(url)['ETag']
+
+        self.room.name = 'renamed'
+        self.room.save()
+        response, _ = self.conditional_get(url, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['rooms'][0]['name'], 'renamed')
+
+    def test_non_participant_gets_not_found(self):
+        self.client.force_login(self.bob)
+        url = reverse('chat:message_list', args=[self.room.name])
+        self.assertEqual(self.client.get(url, headers={'if-none-match': '*'}).status_code, 404)
+
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user(
+            username='alice', email='alice@example.com', password='secret-pass'
+        )
+        self.bob = CustomUser.objects.create_user(
+            username='bob', email='bob@example.com', password='secret-pass'
+        )
+        self.room = ChatRoom.objects.create(name='general', room_type='group', created_by=self.alice)
+        self.room.participants.add(self.alice, self.bob)
+        self.hidden = ChatRoom.objects.create(name='hidden', room_type='group', created_by=self.bob)
+        self.hidden.participants.add(self.bob)
+        self.client.force_login(self.alice)
+
+    def send(self, room, text):
+        message = search.prepare(
+            Message(room=room, sender=self.bob, encrypted_content='ciphertext', iv=''), text
+        )
+        message.save()
+        search.index_messages([message])
+        return message
+
+    def test_words_are_normalized(self):
+        self.assertEqual(search.normalize_words('Deploy the ＡＰＩ, deploy!  a'), ['deploy', 'the', 'api', 'deploy'])
+        self.assertEqual(search.message_tokens('Hello hello'), {search.blind_token('hello'): 2})
+
+    def test_index_holds_no_plaintext(self):
+        self.send(self.room, 'launch codes')
+        tokens = list(MessageToken.objects.values_list('token', flat=True))
+        self.assertEqual(len(tokens), 2)
+        self.assertFalse(any('launch' in token or 'codes' in token for token in tokens))
+
+    def test_results_are_ranked_and_scoped_to_users_rooms(self):
+        one_word = self.send(self.room, 'release notes')
+        both_words = self.send(self.room, 'Release PLAN for the release')
+        newer_plan = self.send(self.room, 'plan')
+        self.send(self.hidden, 'release plan')
+
+        results, has_next = search.search_messages(self.alice, 'release plan')
+        self.assertEqual([r['message_id'] for r in results], [both_words.id, newer_plan.id, one_word.id])
+        self.assertEqual(results[0]['score'], 2)
+        self.assertEqual(results[0]['room'], 'general')
+        self.assertFalse(has_next)
+
+    def test_endpoint_paginates_and_skips_deleted(self):
+        messages = [self.send(self.room, f'standup {i}') for i in range(5)]
+        messages[-1].soft_delete()
+        self.assertFalse(MessageToken.objects.filter(message=messages[-1]).exists())
+
+        url = reverse('chat:search_messages')
+        with self.settings(CHAT_SEARCH_PAGE_SIZE=3):
+            first = self.client.get(url, {'q': 'standup'}).json()
+            second = self.client.get(url, {'q': 'standup', 'page': 2}).json()
+        self.assertTrue(first['has_next'])
+        self.assertFalse(second['has_next'])
+        self.assertEqual(
+            [r['message_id'] for r in first['results'] + second['results']],
+            [message.id for message in reversed(messages[:-1])],
+        )
+        self.assertEqual(self.client.get(url).status_code, 400)
+
+
+class DirectorySearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = CustomUser.objects.create_user(
+            username='alice', email='alice@example.com', password='secret-pass'
+        )
+        for name in ('Design', 'design-review', 'marketing'):
+            room = ChatRoom.objects.create(name=name, room_type='group', created_by=self.alice)
+            room.participants.add(self.alice)
+        ChatRoom.objects.create(name='design-secret', room_type='group', created_by=self.alice)
+        for username, nickname in (('deb', None), ('erin', 'Designer Erin'), ('frank', None)):
+            friend = CustomUser.objects.create_user(
+                username=username, email=f'{username}@example.com', password='secret-pass'
+            )
+            Contact.objects.create(user=self.alice, contact_user=friend, nickname=nickname)
+        self.client.force_login(self.alice)
+        self.url = reverse('chat:directory_search')
+
+    def test_prefix_matches_rooms_usernames_and_nicknames(self):
+        data = self.client.get(self.url, {'q': 'DE'}).json()
+        self.assertEqual([room['name'] for room in data['rooms']], ['Design', 'design-review'])
+        self.assertEqual([contact['username'] for contact in data['contacts']], ['deb', 'erin'])
+        self.assertEqual(data['rooms'][0]['url'], reverse('chat:room', args=['Design']))
+
+        data = self.client.get(self.url, {'q': 'de', 'limit': 1}).json()
+        self.assertEqual(len(data['rooms']), 1)
+        self.assertEqual(self.client.get(self.url, {'q': 'zz'}).json()['rooms'], [])
+
+    def test_repeated_queries_are_cached(self):
+        first = self.client.get(self.url, {'q': 'mar'})
+        self.assertIn('private', first['Cache-Control'])
+        with CaptureQueriesContext(connection) as queries:
+            second = self.client.get(self.url, {'q': 'Mar'})
+        self.assertEqual(first.json(), second.json())
+        self.assertFalse(any('chat_rooms' in query['sql'] for query in queries.captured_queries))
+
+    @override_settings(CHAT_DASHBOARD_PAGE_SIZE=2)
+    def test_dashboard_renders_a_bounded_first_page(self):
+        room = ChatRoom.objects.get(name='marketing')
+        Message.objects.create(room=room, sender=self.alice, encrypted_content='hello', iv='')
+        response = self.client.get(reverse('chat:dashboard'))
+        rooms = response.context['chat_rooms']
+        self.assertEqual([r.name for r in rooms], ['marketing', 'design-review'])
+        self.assertEqual(rooms[0].last_message_sender, 'alice')
+        self.assertEqual(len(response.context['contacts']), 2)
+
+
+class SegmentCipherTests(TestCase):
+    def test_segments_round_trip_and_reject_tampering(self):
+        cipher = SegmentCipher(b'k' * 32, 'file-1')
+        sealed = cipher.seal(3, b'hello', last=False)
+        self.assertEqual(len(sealed), 5 + SegmentCipher.OVERHEAD)
+        self.assertEqual(cipher.open(3, sealed, last=False), b'hello')
+
+        flipped = sealed[:-1] + bytes([sealed[-1] ^ 1])
+        for index, blob, last, file_id in (
+            (3, flipped, False, 'file-1'),   # modified
+            (4, sealed, False, 'file-1'),    # moved
+            (3, sealed, True, 'file-1'),     # truncated after it
+            (3, sealed, False, 'file-2'),    # swapped between files
+        ):
+            with self.assertRaises(ValueError):
+                SegmentCipher(b'k' * 32, file_id).open(index, blob, last)
+
+
+class AttachmentUploadTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, CHAT_ATTACHMENT_SEGMENT_SIZE=16)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.alice = CustomUser.objects.create_user(
+            username='alice', email='alice@example.com', password='secret-pass'
+        )
+        self.mallory = CustomUser.objects.create_user(
+            username='mallory', email='mallory@example.com', password='secret-pass'
+        )
+        self.room = ChatRoom.objects.create(name='files', room_type='group', created_by=self.alice)
+        self.room.participants.add(self.alice)
+        self.client.force_login(self.alice)
+        self.data = bytes(range(256)) * 2 + b'tail'
+
+    def start(self, size=None, file_name='notes.bin', content_type=''):
+        response = self.client.post(
+            reverse('chat:start_upload'),
+            json.dumps({
+                'room_name': 'files', 'file_name': file_name, 'file_size': size or len(self.data),
+                'content_type': content_type,
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def patch(self, upload, offset, chunk):
+        return self.client.patch(
+            upload['url'], chunk, content_type='application/octet-stream',
+            headers={'Upload-Offset': str(offset)},
+        )
+
+    def upload(self):
+        upload = self.start()
+        response = self.patch(upload, 0, self.data)
+        self.assertEqual(response.status_code, 201)
+        return response.json()['message']
+
+    def test_stored_file_is_encrypted_per_segment(self):
+        message = self.upload()
+        upload = AttachmentUpload.objects.get(message_id=message['message_id'])
+        with open(attachments.storage_path(upload.id), 'rb') as f:
+            stored = f.read()
+        segments = attachments.segment_count(upload)
+        self.assertEqual(len(stored), len(self.data) + segments * SegmentCipher.OVERHEAD)
+        self.assertNotIn(self.data[:16], stored)
+
+    def test_interrupted_upload_resumes_from_committed_offset(self):
+        upload = self.start()
+        response = self.patch(upload, 0, self.data[:64])
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response['Upload-Offset'], '64')
+
+        # A connection dropped mid-chunk keeps the whole segments it delivered
+        pending = AttachmentUpload.objects.get(pk=upload['upload_id'])
+        with self.assertRaises(attachments.UploadError):
+            attachments.write_chunk(pending, 64, 64, BytesIO(self.data[64:100]))
+        self.assertEqual(pending.received, 96)
+
+        response = self.client.head(upload['url'])
+        self.assertEqual(response['Upload-Offset'], '96')
+        self.assertEqual(response['Upload-Length'], str(len(self.data)))
+
+        self.assertEqual(self.patch(upload, 64, self.data[64:96]).status_code, 409)
+        response = self.patch(upload, 96, self.data[96:])
+        self.assertEqual(response.status_code, 201)
+
+        message = Message.objects.get(pk=response.json()['message']['message_id'])
+        self.assertEqual((message.file_name, message.file_size), ('notes.bin', len(self.data)))
+        self.assertEqual(b''.join(self.client.get(response.json()['message']['attachment']['url']).streaming_content), self.data)
+
+    def test_chunks_lock_the_upload(self):
+        upload = self.start()
+        select_for_update = QuerySet.select_for_update
+        with mock.patch.object(QuerySet, 'select_for_update', autospec=True, side_effect=select_for_update) as lock:
+            self.assertEqual(self.patch(upload, 0, self.data[:64]).status_code, 204)
+            self.client.head(upload['url'])
+        self.assertEqual(lock.call_count, 1)
+        self.assertEqual(lock.call_args.args[0].model, AttachmentUpload)
+
+    def test_chunks_must_be_whole_segments(self):
+        upload = self.start()
+        self.assertEqual(self.patch(upload, 0, self.data[:20]).status_code, 400)
+        self.assertEqual(self.client.head(upload['url'])['Upload-Offset'], '0')
+
+    def test_completed_upload_is_broadcast_with_its_attachment(self):
+        message = self.upload()
+        self.assertEqual(message['message_type'], 'file')
+        self.assertEqual(message['attachment']['name'], 'notes.bin')
+        self.assertEqual(message_history.latest(self.room.id, 1)[-1]['attachment'], message['attachment'])
+
+    def test_download_honours_ranges(self):
+        url = self.upload()['attachment']['url']
+        response = self.client.get(url, headers={'Range': 'bytes=10-40'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-40/{len(self.data)}')
+        self.assertEqual(b''.join(response.streaming_content), self.data[10:41])
+
+        response = self.client.get(url, headers={'Range': 'bytes=-4'})
+        self.assertEqual(b''.join(response.streaming_content), b'tail')
+
+        response = self.client.get(url, headers={'Range': f'bytes={len(self.data)}-'})
+        self.assertEqual(response.status_code, 416)
+
+    def test_other_users_cannot_read_or_append(self):
+        upload = self.start()
+        url = self.upload()['attachment']['url']
+        self.client.force_login(self.mallory)
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.patch(upload, 0, self.data).status_code, 404)
+
+    @override_settings(CHAT_IMAGE_THUMBNAIL_SIZES=(32, 64))
+    def test_image_uploads_get_encrypted_previews(self):
+        output = BytesIO()
+        Image.new('RGB', (300, 200), (10, 120, 200)).save(output, 'PNG')
+        self.data = output.getvalue()
+        upload = self.client.post(
+            reverse('chat:start_upload'),
+            json.dumps({'room_name': 'files', 'file_name': 'cat.png', 'file_size': len(self.data), 'content_type': 'image/png'}),
+            content_type='application/json',
+        ).json()
+        with self.captureOnCommitCallbacks(execute=True):
+            message_id = self.patch(upload, 0, self.data).json()['message']['message_id']
+
+        attachment = serialize_message(Message.objects.get(pk=message_id))['attachment']
+        self.assertEqual(list(attachment['thumbnails']), ['32', '64'])
+        self.assertEqual(attachment['preview'], attachment['thumbnails']['32'])
+        response = self.client.get(attachment['preview'])
+        self.assertEqual(response['Cache-Control'], 'private, max-age=31536000, immutable')
+        self.assertEqual(Image.open(BytesIO(response.content)).width, 32)
+
+        with open(attachments.thumbnail_path(upload['upload_id'], 32), 'rb') as f:
+            self.assertNotIn(response.content[:16], f.read())
+        self.assertEqual(self.client.get(attachment['preview'].replace('/32/', '/64/')).status_code, 404)
+
+    def test_starting_an_upload_needs_the_csrf_token(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.alice)
+        body = json.dumps({'room_name': 'files', 'file_name': 'notes.bin', 'file_size': 10})
+        url = reverse('chat:start_upload')
+        self.assertEqual(client.post(url, body, content_type='application/json').status_code, 403)
+
+        page = client.get(reverse('chat:room', args=['files']))
+        token = page.cookies['csrftoken'].value
+        response = client.post(url, body, content_type='application/json', headers={'X-CSRFToken': token})
+        self.assertEqual(response.status_code, 201)
+
+    def test_scriptable_types_are_served_as_sandboxed_downloads(self):
+        self.data = b'<svg xmlns="http://www.w3.org/2000/svg"><script>alert(document.cookie)</script></svg>'
+        upload = self.start(file_name='cat.svg', content_type='image/svg+xml')
+        message_id = self.patch(upload, 0, self.data).json()['message']['message_id']
+        self.assertEqual(Message.objects.get(pk=message_id).message_type, 'file')
+
+        response = self.client.get(reverse('chat:download_attachment', args=[message_id]))
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        self.assertTrue(response['Content-Disposition'].startswith('attachment;'))
+        self.assertEqual(response['Content-Security-Policy'], 'sandbox')
+        self.assertEqual(response['X-Content-Type-Options'], 'nosniff')
+
+    def test_raster_images_are_served_inline(self):
+        upload = self.start(file_name='cat.png', content_type='Image/PNG; charset=binary')
+        message_id = self.patch(upload, 0, self.data).json()['message']['message_id']
+        response = self.client.get(reverse('chat:download_attachment', args=[message_id]))
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertTrue(response['Content-Disposition'].startswith('inline;'))
+        self.assertEqual(response['Content-Security-Policy'], 'sandbox')
+
+    @override_settings(CHAT_ATTACHMENT_MAX_SIZE=100)
+    def test_oversized_uploads_are_refused(self):
+        response = self.client.post(
+            reverse('chat:start_upload'),
+            json.dumps({'room_name': 'files', 'file_name': 'big.bin', 'file_size': 101}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 413)
+
+
+@override_settings(CHAT_ARCHIVE_BLOCK_SIZE=8, CHAT_ROOM_PAGE_SIZE=7)
+class MessageArchiveTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = CustomUser.objects.create_user(
+            username='alice', email='alice@example.com', password='secret-pass'
+        )
+        self.room = ChatRoom.objects.create(name='general', room_type='group', created_by=self.alice)
+        self.room.participants.add(self.alice)
+        self.ids = [
+            Message.objects.create(
+                room=self.room, sender=self.alice, encrypted_content=f'message {i}', iv='', is_read=True
+            ).id
+            for i in range(30)
+        ]
+        search.index_messages([search.prepare(Message.objects.get(pk=self.ids[0]), 'hello')])
+
+    def test_messages_beyond_the_newest_move_to_compressed_blocks(self):
+        moved = archive.archive_messages(after_days=None, keep_recent=10)
+        self.assertEqual(moved, 20)
+        self.assertEqual(list(Message.objects.values_list('id', flat=True).order_by('id')), self.ids[20:])
+        self.assertEqual(MessageArchive.objects.count(), 3)
+        self.assertFalse(MessageToken.objects.exists())
+
+        block = MessageArchive.objects.order_by('first_id').first()
+        payloads = archive.decompress(block.data, block.codec)
+        self.assertEqual([p['message_id'] for p in payloads], self.ids[:8])
+        self.assertEqual(payloads[0]['encrypted_content'], 'message 0')
+        self.assertLess(len(block.data), len(json.dumps(payloads)))
+
+    def test_old_messages_are_archived_by_age(self):
+        old = timezone.now() - timedelta(days=100)
+        Message.objects.filter(pk__in=self.ids[:5]).update(timestamp=old)
+        self.assertEqual(archive.archive_messages(after_days=90, keep_recent=None), 5)
+
+    def test_unsettled_messages_stay_hot(self):
+        Message.objects.filter(pk=self.ids[0]).update(is_read=False)
+        Message.objects.filter(pk=self.ids[1]).update(is_deleted=True)
+        Message.objects.filter(pk=self.ids[2]).update(self_destruct=True)
+        # Quoted by a message in a later block
+        Message.objects.filter(pk=self.ids[25]).update(reply_to_id=self.ids[3])
+        version = ChatRoom.objects.get(pk=self.room.pk).version
+
+        archive.archive_messages(after_days=0, keep_recent=None)
+        self.assertEqual(
+            set(Message.objects.values_list('id', flat=True)),
+            {self.ids[0], self.ids[1], self.ids[2], self.ids[3], self.ids[-1]},
+        )
+        # Once its reply is archived too, the quoted message follows on the next run
+        archive.archive_messages(after_days=0, keep_recent=None)
+        self.assertFalse(Message.objects.filter(pk=self.ids[3]).exists())
+        # Moving messages is not a change clients need to hear about
+        self.assertEqual(ChatRoom.objects.get(pk=self.room.pk).version, version)
+
+    def test_pending_notifications_of_archived_messages_are_dropped(self):
+        bob = CustomUser.objects.create_user(username='bob', email='bob@example.com', password='secret-pass')
+        PendingNotification.objects.create(user=bob, room=self.room, message_id=self.ids[0])
+        PendingNotification.objects.create(user=bob, room=self.room, message_id=self.ids[-1])
+
+        self.assertEqual(archive.archive_messages(after_days=None, keep_recent=10), 20)
+        self.assertEqual(list(PendingNotification.objects.values_list('message_id', flat=True)), [self.ids[-1]])
+
+    def test_history_pages_run_across_both_tiers(self):
+        Message.objects.filter(pk=self.ids[25]).update(reply_to_id=self.ids[3])
+        archive.archive_messages(after_days=None, keep_recent=10)
+
+        payloads, has_more = archive.page_before(self.room.id, None, 12)
+        self.assertEqual([p['message_id'] for p in payloads], self.ids[18:])
+        self.assertTrue(has_more)
+        payloads, has_more = archive.page_after(self.room.id, self.ids[1], 5)
+        self.assertEqual([p['message_id'] for p in payloads], self.ids[2:7])
+        self.assertTrue(has_more)
+
+        self.client.force_login(self.alice)
+        url = reverse('chat:message_list', args=[self.room.name])
+        seen, params = [], {}
+        while True:
+            data = self.client.get(url, params).json()
+            seen = [m['id'] for m in data['messages']] + seen
+            if not data['has_more']:
+                break
+            params = {'before': data['before']}
+        self.assertEqual(seen, self.ids)
+
+
+@override_settings(CHAT_BACKUP_SEGMENT_ROWS=4, CHAT_BACKUP_CHUNK_SIZE=3)
+class IncrementalBackupTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.alice = CustomUser.objects.create_user(
+            username='alice', email='alice@example.com', password='secret-pass'
+        )
+        self.bob = CustomUser.objects.create_user(
+            username='bob', email='bob@example.com', password='secret-pass'
+        )
+        self.room = ChatRoom.objects.create(name='general', room_type='group', created_by=self.alice)
+        self.room.participants.add(self.alice, self.bob)
+        self.messages = [
+            Message.objects.create(room=self.room, sender=self.alice, encrypted_content=f'c{i}', iv='', is_read=True)
+            for i in range(10)
+        ]
+
+    def rows(self, manifest, table):
+        return sum(segment['rows'] for segment in manifest['segments'] if segment['table'] == table)
+
+    def wipe(self):
+        ChatRoom.objects.all().delete()
+
+    def test_later_runs_only_read_new_and_edited_rows(self):
+        first = backup.run_backup(self.root)
+        self.assertEqual(self.rows(first, 'chat.message'), 10)
+        self.assertEqual(len([s for s in first['segments'] if s['table'] == 'chat.message']), 3)
+
+        Message.objects.create(room=self.room, sender=self.bob, encrypted_content='new', iv='')
+        Message.objects.filter(pk=self.messages[2].pk).update(encrypted_content='fixed', edited_at=timezone.now())
+        second = backup.run_backup(self.root)
+        self.assertEqual(second['previous'], first['id'])
+        self.assertEqual(self.rows(second, 'chat.message'), 2)
+        self.assertEqual(self.rows(second, 'chat.chatroom'), 1)
+
+        third = backup.run_backup(self.root)
+        self.assertEqual(self.rows(third, 'chat.message'), 0)
+        self.assertEqual(third['segments'], [])
+
+    def test_restore_replays_runs_in_order(self):
+        Message.objects.filter(pk=self.messages[5].pk).update(reply_to=self.messages[1])
+        first = backup.run_backup(self.root)
+        Message.objects.filter(pk=self.messages[2].pk).update(encrypted_content='fixed', edited_at=timezone.now())
+        second = backup.run_backup(self.root)
+        expected = list(Message.objects.order_by('id').values_list('id', 'encrypted_content', 'reply_to_id'))
+
+        self.wipe()
+        self.assertEqual(backup.restore_backup(self.root), sum(segment['rows'] for segment in first['segments']) + 1)
+        self.assertEqual(self.rows(second, 'chat.message'), 1)
+        self.assertEqual(list(Message.objects.order_by('id').values_list('id', 'encrypted_content', 'reply_to_id')), expected)
+        self.assertEqual(set(ChatRoom.objects.get(pk=self.room.pk).participants.all()), {self.alice, self.bob})
+
+    def test_messages_deleted_after_a_run_stay_deleted(self):
+        secret = Message.objects.create(
+            room=self.room, sender=self.alice, encrypted_content='SECRET', iv='iv',
+            self_destruct=True, destroy_after=timezone.now() - timedelta(minutes=1),
+        )
+        backup.run_backup(self.root)
+        cleanup_expired_messages()
+        second = backup.run_backup(self.root)
+        self.assertEqual(self.rows(second, 'chat.message'), 1)
+
+        self.wipe()
+        backup.restore_backup(self.root)
+        self.assertEqual(
+            Message.objects.filter(pk=secret.pk).values_list('encrypted_content', 'is_deleted').get(),
+            ('[deleted]', True),
+        )
+
+    def test_restore_replays_archival(self):
+        backup.run_backup(self.root)
+        archive.archive_messages(after_days=None, keep_recent=4)
+        backup.run_backup(self.root)
+
+        self.wipe()
+        backup.restore_backup(self.root)
+        self.assertEqual(Message.objects.count(), 4)
+        payloads, _ = archive.page_before(self.room.pk, None, 20)
+        self.assertEqual([p['message_id'] for p in payloads], [m.id for m in self.messages])
+
+    def test_replayed_archival_drops_pending_notifications(self):
+        first = backup.run_backup(self.root)
+        archive.archive_messages(after_days=None, keep_recent=4)
+        backup.run_backup(self.root)
+
+        self.wipe()
+        backup.restore_backup(self.root, upto=first['id'])
+        PendingNotification.objects.create(user=self.bob, room=self.room, message=self.messages[0])
+        backup.restore_backup(self.root)
+        self.assertEqual(Message.objects.count(), 4)
+        self.assertFalse(PendingNotification.objects.exists())
+
+    def test_corrupt_segment_stops_restore_before_writing(self):
+        manifest = backup.run_backup(self.root)
+        path = os.path.join(self.root, manifest['id'], manifest['segments'][-1]['file'])
+        with open(path, 'r+b') as f:
+            f.seek(20)
+            f.write(b'\x00\x00')
+
+        self.wipe()
+        with self.assertRaises(backup.BackupError):
+            backup.restore_backup(self.root)
+        self.assertFalse(ChatRoom.objects.exists())
+
+    def test_unfinished_runs_are_ignored(self):
+        first = backup.run_backup(self.root)
+        os.makedirs(os.path.join(self.root, '99999999T000000000000Z'))
+        self.assertEqual([m['id'] for m in backup.run_manifests(self.root)], [first['id']])
+
+
+@override_settings(
+    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+    CHAT_NOTIFICATION_DIGEST_MINUTES=10,
+    CHAT_NOTIFICATION_BATCH_SIZE=2,
+)
+class NotificationDigestTests(TestCase):
+    def setUp(self):
+        self.alice, self.bob, self.carol, self.dave = [
+            CustomUser.objects.create_user(username=name, email=f'{name}@example.com', password='secret-pass')
+            for name in ('alice', 'bob', 'carol', 'dave')
+        ]
+        UserPresence.objects.filter(user=self.dave).update(online_status=True)
+        self.room = ChatRoom.objects.create(name='general', room_type='group', created_by=self.alice)
+        self.room.participants.add(self.alice, self.bob, self.carol, self.dave)
+        self.other = ChatRoom.objects.create(name='other', room_type='group', created_by=self.alice)
+        self.other.participants.add(self.alice, self.bob)
+
+    def send(self, room, sender, count=1):
+        messages = [
+            Message.objects.create(room=room, sender=sender, encrypted_content='secret', iv='')
+            for _ in range(count)
+        ]
+        notifications.queue_notifications(messages)
+        return messages
+
+    def test_queues_offline_participants_except_sender(self):
+        self.send(self.room, self.alice)
+        self.assertEqual(
+            set(PendingNotification.objects.values_list('user__username', flat=True)), {'bob', 'carol'}
+        )
+
+    def test_one_digest_per_user_per_window(self):
+        self.send(self.room, self.alice, count=5)
+        self.send(self.other, self.alice, count=2)
+        self.send(self.room, self.carol)
+
+        self.assertEqual(notifications.send_digests(), 0)
+        later = timezone.now() + timedelta(minutes=11)
+        self.assertEqual(notifications.send_digests(now=later), 3)
+
+        digests = {email.to[0]: email for email in mail.outbox}
+        self.assertEqual(set(digests), {'alice@example.com', 'bob@example.com', 'carol@example.com'})
+        self.assertEqual(digests['bob@example.com'].subject, '8 new messages - CipherTalk')
+        self.assertIn('general: 6 new messages from alice, carol', digests['bob@example.com'].body)
+        self.assertIn('other: 2 new messages from alice', digests['bob@example.com'].body)
+        self.assertNotIn('secret', digests['bob@example.com'].body)
+        self.assertFalse(PendingNotification.objects.exists())
+
+    def test_reuses_one_connection(self):
+        self.send(self.room, self.alice)
+        self.send(self.room, self.bob)
+        with mock.patch.object(notifications, 'get_connection', wraps=notifications.get_connection) as opened:
+            notifications.send_digests(now=timezone.now() + timedelta(minutes=11))
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(opened.call_count, 1)
+
+    def test_users_back_online_are_skipped(self):
+        self.send(self.room, self.alice)
+        UserPresence.objects.filter(user=self.bob).update(online_status=True)
+        notifications.send_digests(now=timezone.now() + timedelta(minutes=11))
+        self.assertEqual([email.to for email in mail.outbox], [['carol@example.com']])
+        self.assertFalse(PendingNotification.objects.exists())
+
+    def test_send_message_view_queues_notifications(self):
+        self.client.force_login(self.alice)
+        self.client.post(
+            reverse('chat:send_message'), json.dumps({'room_name': 'general', 'content': 'hi'}),
+            content_type='application/json',
+        )
+        self.assertEqual(PendingNotification.objects.count(), 2)
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', CHAT_NOTIFICATION_BATCH_SIZE=2)
+class DailyActivitySummaryTests(TestCase):
+    def setUp(self):
+        self.alice, self.bob, self.carol, self.dave = [
+            CustomUser.objects.create_user(username=name, email=f'{name}@example.com', password='secret-pass')
+            for name in ('alice', 'bob', 'carol', 'dave')
+        ]
+        self.general = ChatRoom.objects.create(name='general', room_type='group', created_by=self.alice)
+        self.general.participants.add(self.alice, self.bob, self.carol)
+        self.quiet = ChatRoom.objects.create(name='quiet', room_type='group', created_by=self.dave)
+        self.quiet.participants.add(self.dave, self.alice)
+        self.day = timezone.localdate() - timedelta(days=1)
+        for sender in (self.alice, self.alice, self.bob):
+            self.post(self.general, sender, self.day)
+        # Outside the day
+        self.post(self.quiet, self.dave, self.day - timedelta(days=1))
+
+    def post(self, room, sender, day):
+        message = Message.objects.create(room=room, sender=sender, encrypted_content='c', iv='')
+        Message.objects.filter(pk=message.pk).update(
+            timestamp=summaries.day_bounds(day)[0] + timedelta(hours=12)
+        )
+
+    def test_summaries_count_messages_from_others(self):
+        self.assertEqual(summaries.send_daily_summaries(self.day), 3)
+        bodies = {email.to[0]: email.body for email in mail.outbox}
+        self.assertEqual(set(bodies), {'alice@example.com', 'bob@example.com', 'carol@example.com'})
+        self.assertIn('general: 1 message\n', bodies['alice@example.com'])
+        self.assertIn('general: 2 messages', bodies['bob@example.com'])
+        self.assertIn('general: 3 messages', bodies['carol@example.com'])
+        self.assertNotIn('quiet', bodies['alice@example.com'])
+
+    def test_idle_users_cost_no_queries(self):
+        with CaptureQueriesContext(connection) as before:
+            summaries.send_daily_summaries(self.day)
+        ActivitySummaryRun.objects.all().delete()
+        for i in range(10):
+            user = CustomUser.objects.create_user(username=f'idle{i}', email=f'idle{i}@example.com', password='x')
+            self.quiet.participants.add(user)
+        with CaptureQueriesContext(connection) as after:
+            summaries.send_daily_summaries(self.day)
+        self.assertEqual(len(after), len(before))
+
+    def test_restart_resumes_after_last_batch(self):
+        real_send = []
+
+        def fail_second_batch(messages):
+            if real_send:
+                raise ConnectionError('SMTP went away')
+            real_send.append(messages)
+            mail.outbox.extend(messages)
+            return len(messages)
+
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=fail_second_batch):
+            with self.assertRaises(ConnectionError):
+                summaries.send_daily_summaries(self.day)
+        self.assertEqual([email.to for email in mail.outbox], [['alice@example.com'], ['bob@example.com']])
+
+        self.assertEqual(summaries.send_daily_summaries(self.day), 1)
+        self.assertEqual(mail.outbox[-1].to, ['carol@example.com'])
+        self.assertEqual(summaries.send_daily_summaries(self.day), 0)
+        run = ActivitySummaryRun.objects.get(day=self.day)
+        self.assertEqual(run.sent, 3)
+        self.assertIsNotNone(run.completed_at)
+
+
+class ChatStoreTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user(
+            username='alice', email='alice@example.com', password='secret-pass'
+        )
+        self.outsider = CustomUser.objects.create_user(
+            username='outsider', email='outsider@example.com', password='secret-pass'
+        )
+        self.room = ChatRoom.objects.create(name='general', room_type='group', created_by=self.alice)
+        self.room.participants.add(self.alice)
+        self.message = Message.objects.create(room=self.room, sender=self.alice, encrypted_content='c', iv='')
+
+    def check_store(self, store):
+        async def scenario():
+            room = await store.get_room('general')
+            return (
+                room.pk,
+                await store.get_room('missing'),
+                await store.is_participant(room.pk, self.alice.pk),
+                await store.is_participant(room.pk, self.outsider.pk),
+                await store.latest_message_id(room.pk),
+                await store.mark_read(room.pk, self.message.pk),
+                await store.mark_read(room.pk, 999999),
+            )
+
+        version = ChatRoom.objects.get(pk=self.room.pk).version
+        self.assertEqual(
+            async_to_sync(scenario)(),
+            (self.room.pk, None, True, False, self.message.pk, True, False),
+        )
+        self.assertTrue(Message.objects.get(pk=self.message.pk).is_read)
+        self.assertGreater(ChatRoom.objects.get(pk=self.room.pk).version, version)
+
+        UserPresence.objects.filter(user=self.outsider).delete()
+        async_to_sync(store.set_presence)(self.outsider.pk, True)
+        async_to_sync(store.set_presence)(self.alice.pk, True)
+        self.assertEqual(
+            set(UserPresence.objects.filter(online_status=True).values_list('user_id', flat=True)),
+            {self.alice.pk, self.outsider.pk},
+        )
+
+    def test_threaded_store(self):
+        self.check_store(ThreadedChatStore())
+
+    def test_async_store(self):
+        self.check_store(AsyncChatStore(lanes=2))
+
+    def test_lanes_bound_concurrency_and_pin_threads(self):
+        store = AsyncChatStore(lanes=2)
+        active, peak, threads = [0], [0], set()
+
+        async def work():
+            async with store.lane():
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+                threads.add(await sync_to_async(threading.get_ident)())
+                await asyncio.sleep(0.01)
+                active[0] -= 1
+
+        async def main():
+            await asyncio.gather(*(work() for _ in range(8)))
+
+        # Not async_to_sync: under a sync caller, asgiref runs thread-sensitive code on the caller's thread
+        asyncio.run(main())
+        self.assertEqual(peak[0], 2)
+        self.assertEqual(len(threads), 2)
+
+    def test_lanes_recycle_connections_around_each_block(self):
+        store = AsyncChatStore(lanes=1)
+        calls = []
+
+        async def main():
+            async with store.lane():
+                calls.append(('block', await sync_to_async(threading.get_ident)()))
+
+        with mock.patch('apps.chat.store.close_old_connections', lambda: calls.append(('close', threading.get_ident()))):
+            asyncio.run(main())
+        self.assertEqual([step for step, _ in calls], ['close', 'block', 'close'])
+        self.assertEqual(len({thread for _, thread in calls}), 1)
+
+
+class GroupCommitWriterTests(TransactionTestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='alice', email='alice@example.com', password='secret-pass'
+        )
+        self.room = ChatRoom.objects.create(name='general', room_type='group', created_by=self.user)
+
+    def test_batches_keep_submission_order(self):
+        writer = GroupCommitWriter(window_ms=20, enabled=True)
+        messages = [
+            search.prepare(Message(room=self.room, sender=self.user, encrypted_content=f'c{i}', iv=''), f'word{i}')
+            for i in range(10)
+        ]
+
+        async def run():
+            return await asyncio.gather(*(writer.submit(message) for message in messages))
+
+        saved = async_to_sync(run)()
+        writer.stop()
+
+        ids = [message.id for message in saved]
+        self.assertEqual(ids, sorted(ids))
+        self.assertTrue(all(message.timestamp for message in saved))
+        self.assertEqual(
+            list(Message.objects.filter(room=self.room).order_by('id').values_list('encrypted_content', flat=True)),
+            [f'c{i}' for i in range(10)]
+        )
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_message_id, ids[-1])
+        self.assertEqual(MessageToken.objects.filter(room=self.room).count(), 10)
+
+    def test_failed_message_raises_in_its_sender(self):
+        writer = GroupCommitWriter(window_ms=0, enabled=True)
+        orphan = Message(room_id=self.room.id, sender_id=None, encrypted_content='c', iv='')
+
+        async def run():
+            await writer.submit(orphan)
+
+        with self.assertLogs('apps.chat.batching', 'ERROR'), self.assertRaises(IntegrityError):
+            async_to_sync(run)()
+        writer.stop()
+
+    def test_bad_message_fails_alone(self):
+        writer = GroupCommitWriter(window_ms=50, enabled=True)
+        messages = [Message(room=self.room, sender=self.user, encrypted_content=f'c{i}', iv='') for i in range(3)]
+        messages[1].reply_to_id = 999999
+
+        async def run():
+            return await asyncio.gather(*(writer.submit(message) for message in messages), return_exceptions=True)
+
+        with self.assertLogs('apps.chat.batching', 'WARNING') as logs:
+            results = async_to_sync(run)()
+        writer.stop()
+
+        self.assertIn('retrying one by one', logs.output[0])
+        self.assertIsInstance(results[1], IntegrityError)
+        self.assertIsNone(messages[1].id)
+        self.assertEqual([results[0].id, results[2].id], [messages[0].id, messages[2].id])
+        self.assertEqual(
+            list(Message.objects.filter(room=self.room).order_by('id').values_list('encrypted_content', flat=True)),
+            ['c0', 'c2']
+        )
+
+
+class LoadTestCommandTests(TransactionTestCase):
+    def test_small_run_reports_latency_and_throughput(self):
+        out = StringIO()
+        call_command(
+            'chat_loadtest', clients=3, rooms=1, duration=0.5, rate=10,
+            mix='send=1', stdout=out, stderr=StringIO()
+        )
+        report = json.loads(out.getvalue())
+
+        self.assertEqual(report['connect_failures'], 0)
+        self.assertEqual(report['connect_ms']['count'], 3)
+        self.assertGreater(report['messages_sent'], 0)
+        self.assertIn('p99', report['delivery_ms'])
+        self.assertFalse(CustomUser.objects.exists())
+
+
+class ContactListTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user(
+            username='owner', email='owner@example.com', password='secret-pass'
+        )
+        # bulk_create skips the signals, so presence/profile rows are added below
+        friends = CustomUser.objects.bulk_create(
+            CustomUser(username=f'friend{i}', email=f'friend{i}@example.com') for i in range(1000)
+        )
+        UserPresence.objects.bulk_create(
+            UserPresence(user=friend, online_status=True) for friend in friends[:500]
+        )
+        UserProfile.objects.bulk_create(
+            UserProfile(user=friend, show_online_status=False) for friend in friends[:100]
+        )
+        Contact.objects.bulk_create(Contact(user=self.user, contact_user=friend) for friend in friends)
+        self.friends = friends
+        self.client.force_login(self.user)
+
+    def online_names(self):
+        contacts = self.client.get(reverse('chat:contact_list')).json()['contacts']
+        return {contact['username'] for contact in contacts if contact['online']}
+
+    def test_query_count_does_not_grow_with_contacts(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('chat:contact_list'))
+        self.assertEqual(len(response.json()['contacts']), 1000)
+        # Leaving out session bookkeeping: the user, then every contact with presence and profile
+        statements = [
+            query['sql'] for query in queries.captured_queries
+            if 'django_session' not in query['sql'] and 'SAVEPOINT' not in query['sql']
+        ]
+        self.assertEqual(len(statements), 2)
+
+    def test_hidden_and_missing_presence_show_offline(self):
+        online = self.online_names()
+        self.assertEqual(len(online), 400)
+        self.assertNotIn('friend0', online)
+        self.assertNotIn('friend999', online)
+        self.assertIn('friend100', online)
+
+    @override_settings(CHAT_PRESENCE_CACHE=True)
+    def test_cached_presence_overlays_rows(self):
+        cache_presence(self.friends[100].id, False)
+        cache_presence(self.friends[999].id, True)
+        cache_presence(self.friends[0].id, True)
+        online = self.online_names()
+        self.assertNotIn('friend100', online)
+        self.assertIn('friend999', online)
+        self.assertNotIn('friend0', online)
+
+
+class WebSocketTicketTests(TransactionTestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='alice', email='alice@example.com', password='secret-pass'
+        )
+        self.outsider = CustomUser.objects.create_user(
+            username='mallory', email='mallory@example.com', password='secret-pass'
+        )
+        self.room = ChatRoom.objects.create(name='general', room_type='group', created_by=self.user)
+        self.room.participants.add(self.user)
+        ChatRoom.objects.create(name='private', room_type='group', created_by=self.user).participants.add(self.user)
+        self.app = tickets.TicketAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+    def test_ticket_round_trip_and_rejections(self):
+        ticket, expires_at = tickets.issue_ticket(self.user, 'general', now=1000)
+        claims = tickets.read_ticket(ticket, now=1000)
+        self.assertEqual(claims, {'user_id': self.user.id, 'username': 'alice', 'room': 'general', 'expires_at': expires_at})
+        self.assertIsNone(tickets.read_ticket(ticket, now=expires_at + 1))
+        self.assertIsNone(tickets.read_ticket(ticket[:-2] + 'xx', now=1000))
+        self.assertIsNone(tickets.read_ticket('garbage'))
+
+    def test_view_issues_tickets_to_participants_only(self):
+        url = reverse('chat:room_websocket_ticket', args=['general'])
+        self.client.force_login(self.user)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('no-store', response['Cache-Control'])
+        self.assertEqual(tickets.read_ticket(response.json()['ticket'])['user_id'], self.user.id)
+
+        self.client.force_login(self.outsider)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_middleware_authenticates_without_queries(self):
+        ticket, _ = tickets.issue_ticket(self.user, 'general')
+        scopes = []
+
+        async def inner(scope, receive, send):
+            scopes.append(scope)
+
+        middleware = tickets.TicketAuthMiddleware(inner)
+        scope = {'type': 'websocket', 'headers': [], 'query_string': f'ticket={ticket}'.encode()}
+        with self.assertNumQueries(0):
+            async_to_sync(middleware)(scope, None, None)
+            async_to_sync(middleware)({**scope, 'query_string': b'ticket=forged'}, None, None)
+
+        self.assertEqual((scopes[0]['user'].id, scopes[0]['user'].username), (self.user.id, 'alice'))
+        self.assertTrue(scopes[0]['user'].is_authenticated)
+        self.assertTrue(scopes[1]['user'].is_anonymous)
+
+    def test_ticketed_connect_sends_as_the_ticket_user(self):
+        ticket, _ = tickets.issue_ticket(self.user, 'general')
+
+        async def run():
+            communicator = WebsocketCommunicator(self.app, f'ws/chat/general/?ticket={ticket}')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.receive_json_from()
+            await communicator.send_json_to({'type': 'chat_message', 'message': 'hello'})
+            event = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return event
+
+        event = async_to_sync(run)()
+        self.assertEqual((event['sender_id'], event['sender_username']), (self.user.id, 'alice'))
+        self.assertEqual(Message.objects.get(pk=event['message_id']).sender, self.user)
+
+    def test_ticket_for_another_room_still_checks_membership(self):
+        ticket, _ = tickets.issue_ticket(self.outsider, 'general')
+
+        async def run():
+            communicator = WebsocketCommunicator(self.app, f'ws/chat/private/?ticket={ticket}')
+            connected, code = await communicator.connect()
+            return connected, code
+
+        self.assertEqual(async_to_sync(run)(), (False, 4003))
+
+
+class MultiplexConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='alice', email='alice@example.com', password='secret-pass'
+        )
+        self.rooms = []
+        for name in ('general', 'random'):
+            room = ChatRoom.objects.create(name=name, room_type='group', created_by=self.user)
+            room.participants.add(self.user)
+            self.rooms.append(room)
+        ChatRoom.objects.create(name='private', room_type='group', created_by=self.user)
+
+    async def open_socket(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), 'ws/chat/')
+        communicator.scope['user'] = self.user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def subscribe(self, communicator, room, **extra):
+        await communicator.send_json_to({'type': 'subscribe', 'room': room, **extra})
+        return await communicator.receive_json_from()
+
+    def test_one_socket_carries_framed_events_for_each_room(self):
+        async def run():
+            communicator = await self.open_socket()
+            acks, joined = [], []
+            for name in ('general', 'random'):
+                acks.append(await self.subscribe(communicator, name))
+                joined.append(await communicator.receive_json_from())
+            for name in ('general', 'random'):
+                await communicator.send_json_to({'type': 'chat_message', 'room': name, 'message': f'hi {name}'})
+            received = [await communicator.receive_json_from() for _ in range(2)]
+
+            await communicator.send_json_to({'type': 'unsubscribe', 'room': 'random'})
+            left = [await communicator.receive_json_from() for _ in range(1)]
+            await communicator.send_json_to({'type': 'typing_start', 'room': 'random'})
+            not_subscribed = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return acks, joined, received, left, not_subscribed
+
+        acks, joined, received, left, not_subscribed = async_to_sync(run)()
+        self.assertEqual(acks, [{'type': 'subscribed', 'room': 'general'}, {'type': 'subscribed', 'room': 'random'}])
+        self.assertEqual([(e['type'], e['room']) for e in joined], [('user_joined', 'general'), ('user_joined', 'random')])
+        self.assertEqual([(e['type'], e['room']) for e in received], [('chat_message', 'general'), ('chat_message', 'random')])
+        for event, room in zip(received, self.rooms):
+            self.assertEqual(Message.objects.get(pk=event['message_id']).room, room)
+        # The socket left the group before its own user_left went out
+        self.assertEqual(left, [{'type': 'unsubscribed', 'room': 'random'}])
+        self.assertEqual(not_subscribed['error'], 'Not subscribed')
+
+    def test_events_from_single_room_sockets_reach_multiplexed_ones(self):
+        async def run():
+            communicator = await self.open_socket()
+            await self.subscribe(communicator, 'general')
+            await communicator.receive_json_from()
+
+            single = WebsocketCommunicator(URLRouter(websocket_urlpatterns), 'ws/chat/general/')
+            single.scope['user'] = self.user
+            await single.connect()
+            joined = await communicator.receive_json_from()
+            await single.send_json_to({'type': 'chat_message', 'message': 'hello'})
+            message = await communicator.receive_json_from()
+            await single.disconnect()
+            await communicator.disconnect()
+            return joined, message
+
+        joined, message = async_to_sync(run)()
+        self.assertEqual((joined['type'], joined['room']), ('user_joined', 'general'))
+        self.assertEqual((message['type'], message['room'], message['sender_username']), ('chat_message', 'general', 'alice'))
+        self.assertNotIn('room', message_history.latest(self.rooms[0].id, 1)[0])
+
+    def test_subscribe_replays_and_checks_membership(self):
+        first = Message.objects.create(room=self.rooms[0], sender=self.user, encrypted_content='a', iv='')
+        second = Message.objects.create(room=self.rooms[0], sender=self.user, encrypted_content='b', iv='')
+
+        async def run():
+            communicator = await self.open_socket()
+            await self.subscribe(communicator, 'general', last_message_id=first.id)
+            replayed = await communicator.receive_json_from()
+            complete = await communicator.receive_json_from()
+            await communicator.receive_json_from()
+            denied = await self.subscribe(communicator, 'private')
+            missing = await self.subscribe(communicator, 'nowhere')
+            await communicator.disconnect()
+            return replayed, complete, denied, missing
+
+        replayed, complete, denied, missing = async_to_sync(run)()
+        self.assertEqual((replayed['message_id'], replayed['room'], replayed['replayed']), (second.id, 'general', True))
+        self.assertEqual(complete, {'type': 'resume_complete', 'room': 'general', 'count': 1, 'source': 'database'})
+        self.assertEqual(denied, {'type': 'error', 'room': 'private', 'error': 'Room not found'})
+        self.assertEqual(missing['error'], 'Room not found')
+
+    def test_presence_is_set_once_per_socket(self):
+        async def run():
+            with mock.patch.object(ThreadedChatStore, 'set_presence') as threaded, \
+                    mock.patch.object(AsyncChatStore, 'set_presence') as lanes:
+                communicator = await self.open_socket()
+                for name in ('general', 'random'):
+                    await self.subscribe(communicator, name)
+                    await communicator.receive_json_from()
+                await communicator.disconnect()
+            return [call.args for call in threaded.call_args_list + lanes.call_args_list]
+
+        self.assertEqual(async_to_sync(run)(), [(self.user.id, True), (self.user.id, False)])
+
+
+class FrameEncodingTests(TransactionTestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='alice', email='alice@example.com', password='secret-pass'
+        )
+        self.room = ChatRoom.objects.create(name='general', room_type='group', created_by=self.user)
+        self.room.participants.add(self.user)
+
+    def test_binary_codecs_carry_ciphertext_as_bytes(self):
+        ciphertext = os.urandom(48)
+        frame = {'type': 'chat_message', 'message_id': 7, 'encrypted_content': base64.b64encode(ciphertext).decode()}
+        json_size = len(framing.CODECS['ciphertalk.json'].encode(frame).encode())
+        # CBOR is only offered when cbor2 is installed
+        for codec in [codec for codec in framing.CODECS.values() if codec.binary]:
+            data = codec.encode(frame)
+            self.assertIn(ciphertext, data)
+            self.assertLess(len(data), json_size)
+            self.assertEqual(codec.decode(data), frame)
+            # Text that is not base64 is passed through unchanged
+            self.assertEqual(codec.decode(codec.encode({'encrypted_content': 'plain!'})), {'encrypted_content': 'plain!'})
+            with self.assertRaises(ValueError):
+                codec.decode(b'\xc1')
+
+    def test_negotiation_prefers_the_clients_order(self):
+        self.assertEqual(framing.negotiate(['x-unknown', 'ciphertalk.msgpack', 'ciphertalk.json'])[1], 'ciphertalk.msgpack')
+        self.assertEqual(framing.negotiate(['ciphertalk.json', 'ciphertalk.msgpack'])[1], 'ciphertalk.json')
+        self.assertEqual(framing.negotiate([]), (framing.DEFAULT_CODEC, None))
+
+    def test_consumer_speaks_the_negotiated_encoding(self):
+        codec = framing.CODECS['ciphertalk.msgpack']
+
+        async def run():
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), 'ws/chat/general/', subprotocols=['ciphertalk.msgpack']
+            )
+            communicator.scope['user'] = self.user
+            connected, subprotocol = await communicator.connect()
+            self.assertEqual((connected, subprotocol), (True, 'ciphertalk.msgpack'))
+            joined = codec.decode(await communicator.receive_from())
+            await communicator.send_to(bytes_data=codec.encode({'type': 'chat_message', 'message': 'hello'}))
+            raw = await communicator.receive_from()
+            await communicator.send_to(text_data='{"type": "typing_start"}')
+            error = codec.decode(await communicator.receive_from())
+            await communicator.disconnect()
+            return joined, raw, error
+
+        joined, raw, error = async_to_sync(run)()
+        self.assertEqual(joined['type'], 'user_joined')
+        message = Message.objects.get()
+        self.assertIn(base64.b64decode(message.encrypted_content), raw)
+        self.assertEqual(codec.decode(raw)['encrypted_content'], message.encrypted_content)
+        self.assertEqual(error, {'type': 'error', 'error': 'Invalid MessagePack'})
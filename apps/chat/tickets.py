@@ -0,0 +1,72 @@
+"""
+Signed, short-lived tickets for WebSocket connects.
+
+Session auth on a WebSocket connect loads the session and then the user row,
+so every reconnect costs two reads before the consumer runs. A ticket is
+issued over HTTP to a logged-in participant of a room and carries the user
+id, username, room name and expiry, signed with ``django.core.signing``
+(HMAC-SHA256 keyed on SECRET_KEY). ``TicketAuthMiddleware`` checks it with
+no database access and puts a minimal, unsaved ``CustomUser`` in the scope;
+connects without a valid ticket fall back to the session.
+
+Tickets are not single-use: a client reconnecting within
+``CHAT_WS_TICKET_TTL`` reuses its ticket. Keep the TTL short, since a user
+removed from a room or logged out keeps their ticket until it expires.
+"""
+import time
+import urllib.parse
+
+from channels.auth import AuthMiddlewareStack
+from django.conf import settings
+from django.core import signing
+
+from apps.users.models import CustomUser
+
+SALT = 'apps.chat.tickets'
+
+
+def ticket_ttl():
+    return getattr(settings, 'CHAT_WS_TICKET_TTL', 60)
+
+
+def issue_ticket(user, room_name, now=None):
+    """A ticket letting ``user`` connect to ``room_name``; returns (ticket, expires_at)"""
+    expires_at = int(now or time.time()) + ticket_ttl()
+    ticket = signing.dumps([user.pk, user.username, room_name, expires_at], salt=SALT)
+    return ticket, expires_at
+
+
+def read_ticket(ticket, now=None):
+    """The ticket's claims as a dict, or None if it is forged, malformed or expired"""
+    try:
+        user_id, username, room_name, expires_at = signing.loads(ticket, salt=SALT)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+    if expires_at < (now or time.time()):
+        return None
+    return {'user_id': user_id, 'username': username, 'room': room_name, 'expires_at': expires_at}
+
+
+def ticket_user(claims):
+    """An unsaved user carrying just what the consumer uses: id and username"""
+    user = CustomUser(pk=claims['user_id'], username=claims['username'])
+    user._state.adding = False
+    return user
+
+
+class TicketAuthMiddleware:
+    """
+    Authenticate a WebSocket from the ``ticket`` query parameter, or fall
+    back to session auth. A ticketed scope also gets ``scope['ticket']``.
+    """
+    def __init__(self, inner):
+        self.inner = inner
+        self.session_auth = AuthMiddlewareStack(inner)
+
+    async def __call__(self, scope, receive, send):
+        query = urllib.parse.parse_qs(scope.get('query_string', b'').decode())
+        claims = read_ticket(query['ticket'][0]) if query.get('ticket') else None
+        if claims is None:
+            return await self.session_auth(scope, receive, send)
+        scope = dict(scope, user=ticket_user(claims), ticket=claims)
+        return await self.inner(scope, receive, send)
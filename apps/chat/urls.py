@@ -16,4 +16,16 @@ urlpatterns = [
     path('api/send-message/', views.send_message, name='send_message'),
     path('api/contacts/', views.contact_list, name='contact_list'),
     path('api/add-contact/', views.add_contact, name='add_contact'),
+    path('api/search/', views.search_messages, name='search_messages'),
+    path('api/directory-search/', views.directory_search, name='directory_search'),
+    path('api/uploads/', views.start_upload, name='start_upload'),
+    path('api/uploads/<uuid:upload_id>/', views.upload, name='upload'),
+    path('api/attachments/<int:message_id>/', views.download_attachment, name='download_attachment'),
+    path(
+        'api/attachments/<int:message_id>/thumbnails/<int:size>/<str:digest>/',
+        views.attachment_thumbnail, name='attachment_thumbnail'
+    ),
+    path('api/ws-ticket/', views.websocket_ticket, name='websocket_ticket'),
+    path('api/ws-ticket/<str:room_name>/', views.websocket_ticket, name='room_websocket_ticket'),
+    path('api/history-stats/', views.history_stats, name='history_stats'),
 ]
\ No newline at end of file
@@ -1,37 +1,51 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from django.shortcuts import render, get_object_or_404, redirect
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
-from django.views.decorators.http import require_http_methods
+from django.conf import settings
+from django.db import transaction
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import patch_cache_control
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.http import condition, require_http_methods
 from django.views.decorators.csrf import csrf_exempt
-from django.db.models import Q, Count
+from django.db.models import OuterRef, Subquery
 from django.contrib import messages
+import hashlib
 import json
-from .models import ChatRoom, Message, Contact, UserPresence
+from functools import partial
+from urllib.parse import quote
+from . import attachments, notifications, tickets
+from .models import AttachmentUpload, ChatRoom, Message, Contact
+from .history import message_history, serialize_message
+from . import search
+from .presence import contact_list_rows, contacts_with_presence, with_online_flags
+from .archive import page_before
+from .rooms import recent_first, rooms_for, with_summary
+from .tasks import generate_attachment_thumbnails
 from apps.users.models import CustomUser, UserProfile
+from apps.users.thumbnails import thumbnail_extension
 
 
 @login_required
 def chat_dashboard(request):
     """Main chat dashboard with rooms and contacts"""
-    # Get user's chat rooms
-    chat_rooms = ChatRoom.objects.filter(
-        participants=request.user,
-        is_active=True
-    ).annotate(
-        message_count=Count('messages'),
-        unread_count=Count('messages', filter=Q(messages__is_read=False) & ~Q(messages__sender=request.user))
-    ).order_by('-messages__timestamp')
-    
-    # Get user's contacts
-    contacts = Contact.objects.filter(user=request.user, is_blocked=False).select_related('contact_user')
+    # The first page of rooms and contacts; the search box fetches the rest on demand
+    page_size = getattr(settings, 'CHAT_DASHBOARD_PAGE_SIZE', 50)
+    chat_rooms = recent_first(with_summary(rooms_for(request.user), request.user)).annotate(
+        last_message_content=Subquery(
+            Message.objects.filter(pk=OuterRef('last_message_id')).values('encrypted_content')[:1]
+        )
+    )[:page_size]
     
-    # Get online users
-    online_users = UserPresence.objects.filter(online_status=True).exclude(user=request.user)
+    # Get user's contacts with their online status
+    contacts = with_online_flags(contacts_with_presence(request.user)[:page_size])
     
     context = {
         'chat_rooms': chat_rooms,
         'contacts': contacts,
-        'online_users': online_users,
         'title': 'Chat Dashboard - CipherTalk'
     }
     return render(request, 'chat/dashboard.html', context)
@@ -47,20 +61,26 @@ def chat_room(request, room_name):
         is_active=True
     )
     
-    # Get messages for this room
-    messages = Message.objects.filter(
-        room=room,
-        is_deleted=False
-    ).select_related('sender', 'reply_to').order_by('timestamp')[:100]
+    # Get the newest messages, from the history cache when possible
+    page_size = getattr(settings, 'CHAT_ROOM_PAGE_SIZE', 100)
+    messages = [
+        {**payload, 'timestamp': parse_datetime(payload['timestamp'])}
+        for payload in message_history.latest(room.id, page_size)
+    ]
     
     # Mark messages as read
-    Message.objects.filter(
+    marked = Message.objects.filter(
         room=room,
         is_read=False
     ).exclude(sender=request.user).update(is_read=True)
+    if marked:
+        message_history.mark_read(room.id, exclude_sender=request.user.id)
+        message_history.invalidate(room.id)
+        ChatRoom.bump_version([room.id])
     
     context = {
         'room': room,
+        'participants': room.participants.select_related('profile'),
         'messages': messages,
         'title': f'Chat - {room.name}'
     }
@@ -138,8 +158,44 @@ def private_chat(request, username):
 
 
 # API Views
+def room_list_validators(request):
+    """ETag and Last-Modified of the user's room list, from room versions only"""
+    if not hasattr(request, '_room_list_validators'):
+        rooms = list(
+            ChatRoom.objects.filter(participants=request.user, is_active=True)
+            .order_by('id').values_list('id', 'version', 'modified_at', 'created_at')
+        )
+        digest = hashlib.md5(
+            ','.join(f'{room_id}:{version}' for room_id, version, _, _ in rooms).encode()
+        ).hexdigest()
+        last_modified = max((modified or created for _, _, modified, created in rooms), default=None)
+        request._room_list_validators = (f'rooms-{request.user.id}-{digest}', last_modified)
+    return request._room_list_validators
+
+
+def message_list_validators(request, room_name):
+    """ETag and Last-Modified of a room's messages, from its version and last message id"""
+    if not hasattr(request, '_message_list_validators'):
+        room = ChatRoom.objects.filter(name=room_name, participants=request.user).values(
+            'id', 'version', 'last_message_id', 'modified_at', 'created_at'
+        ).first()
+        if room is None:
+            # Let the view answer with its 404
+            request._message_list_validators = (None, None)
+        else:
+            request._message_list_validators = (
+                f"room-{room['id']}-{room['version']}-{room['last_message_id']}-{request.GET.urlencode()}",
+                room['modified_at'] or room['created_at'],
+            )
+    return request._message_list_validators
+
+
 @login_required
 @require_http_methods(["GET"])
+@condition(
+    etag_func=lambda request: room_list_validators(request)[0],
+    last_modified_func=lambda request: room_list_validators(request)[1],
+)
 def room_list(request):
     """API: Get list of user's chat rooms"""
     rooms = ChatRoom.objects.filter(
@@ -155,33 +211,42 @@ def room_list(request):
 
 @login_required
 @require_http_methods(["GET"])
+@condition(
+    etag_func=lambda request, room_name: message_list_validators(request, room_name)[0],
+    last_modified_func=lambda request, room_name: message_list_validators(request, room_name)[1],
+)
 def message_list(request, room_name):
-    """API: Get messages for a room"""
+    """API: Get a page of a room's messages, newest first by page, archived ones included"""
     room = get_object_or_404(ChatRoom, name=room_name, participants=request.user)
-    
-    messages = Message.objects.filter(
-        room=room,
-        is_deleted=False
-    ).select_related('sender', 'reply_to').order_by('timestamp')
-    
-    message_data = []
-    for msg in messages:
-        message_data.append({
-            'id': msg.id,
-            'sender': msg.sender.username,
-            'sender_id': msg.sender.id,
-            'encrypted_content': msg.encrypted_content,
-            'message_type': msg.message_type,
-            'timestamp': msg.timestamp.isoformat(),
-            'is_read': msg.is_read,
-            'is_edited': msg.is_edited,
-            'self_destruct': msg.self_destruct,
-            'reply_to': msg.reply_to.id if msg.reply_to else None,
-        })
+    page_size = getattr(settings, 'CHAT_ROOM_PAGE_SIZE', 100)
+    try:
+        before = int(request.GET['before']) if 'before' in request.GET else None
+        limit = min(max(int(request.GET.get('limit', page_size)), 1), page_size)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid before or limit'}, status=400)
+
+    payloads, has_more = page_before(room.id, before, limit)
+    message_data = [
+        {
+            'id': payload['message_id'],
+            'sender': payload['sender_username'],
+            'sender_id': payload['sender_id'],
+            'encrypted_content': payload['encrypted_content'],
+            'message_type': payload['message_type'],
+            'timestamp': payload['timestamp'],
+            'is_read': payload['is_read'],
+            'is_edited': payload['is_edited'],
+            'self_destruct': payload['self_destruct'],
+            'reply_to': payload['reply_to'],
+        }
+        for payload in payloads
+    ]
     
     return JsonResponse({
         'messages': message_data,
         'room': room.name,
+        'has_more': has_more,
+        'before': message_data[0]['id'] if has_more else None,
         'status': 'success'
     })
 
@@ -208,6 +273,15 @@ def send_message(request):
             encrypted_content=content,  # This should be encrypted on frontend
             iv=''  # IV from frontend encryption
         )
+        notifications.queue_notifications([message])
+
+        # Deliver to connected clients like a WebSocket message
+        payload = serialize_message(message, sender_username=request.user.username)
+        message_history.record(room.id, payload)
+        async_to_sync(get_channel_layer().group_send)(
+            room.group_name,
+            {'type': 'chat_message', 'room': room.name, **payload}
+        )
         
         return JsonResponse({
             'message_id': message.id,
@@ -218,24 +292,212 @@ def send_message(request):
         return JsonResponse({'error': str(e)}, status=500)
 
 
+@login_required
+@require_http_methods(["POST"])
+def start_upload(request):
+    """API: Open a resumable attachment upload"""
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    room = get_object_or_404(ChatRoom, name=data.get('room_name'), participants=request.user)
+    try:
+        upload = attachments.start_upload(
+            room, request.user, data.get('file_name'), data.get('file_size'), data.get('content_type')
+        )
+    except attachments.UploadError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+
+    return JsonResponse({
+        'upload_id': str(upload.id),
+        'segment_size': upload.segment_size,
+        'offset': upload.received,
+        'url': reverse('chat:upload', args=[upload.id]),
+        'status': 'success'
+    }, status=201)
+
+
+@login_required
+@csrf_exempt
+@require_http_methods(["HEAD", "PATCH"])
+def upload(request, upload_id):
+    """
+    API: HEAD reports how much of an upload is stored, PATCH appends a chunk
+    read from the request stream. The chunk completing the file posts it.
+    """
+    uploads = AttachmentUpload.objects.filter(uploader=request.user)
+    if request.method == 'HEAD':
+        upload = get_object_or_404(uploads, pk=upload_id)
+        response = HttpResponse()
+        response['Upload-Offset'] = upload.received
+        response['Upload-Length'] = upload.file_size
+        return response
+
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+        length = int(request.headers.get('Content-Length', ''))
+    except ValueError:
+        return JsonResponse({'error': 'Upload-Offset and Content-Length are required'}, status=400)
+
+    with transaction.atomic():
+        # Hold the upload while checking the offset and writing, so two chunks
+        # for the same offset cannot both pass. The ASGI handler has already
+        # buffered the body, so this lasts as long as the encryption and write.
+        upload = get_object_or_404(uploads.select_for_update(), pk=upload_id)
+        try:
+            received = attachments.write_chunk(upload, offset, length, request)
+        except attachments.UploadError as e:
+            # Returning commits the whole segments that were written
+            response = JsonResponse({'error': str(e), 'offset': upload.received}, status=e.status)
+            response['Upload-Offset'] = upload.received
+            return response
+
+        if received < upload.file_size:
+            response = HttpResponse(status=204)
+            response['Upload-Offset'] = received
+            return response
+
+        message = attachments.complete_upload(upload)
+    if message.message_type == 'image':
+        transaction.on_commit(partial(generate_attachment_thumbnails.delay, str(upload.id)))
+    payload = serialize_message(message, sender_username=request.user.username)
+    message_history.record(upload.room_id, payload)
+    async_to_sync(get_channel_layer().group_send)(
+        upload.room.group_name,
+        {'type': 'chat_message', 'room': upload.room.name, **payload}
+    )
+    response = JsonResponse({'message': payload, 'status': 'success'}, status=201)
+    response['Upload-Offset'] = received
+    return response
+
+
+@login_required
+@require_http_methods(["GET"])
+def download_attachment(request, message_id):
+    """API: Stream a decrypted attachment, honouring a single byte range"""
+    upload = get_object_or_404(
+        AttachmentUpload.objects.select_related('message'),
+        message_id=message_id,
+        message__is_deleted=False,
+        room__participants=request.user,
+    )
+    try:
+        byte_range = attachments.parse_range(request.headers.get('Range'), upload.file_size)
+    except attachments.UploadError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{upload.file_size}'
+        return response
+
+    start, end = byte_range or (0, upload.file_size - 1)
+    # Re-checked here too, for uploads stored before types were restricted
+    content_type = attachments.safe_content_type(upload.content_type)
+    response = StreamingHttpResponse(
+        attachments.iter_plaintext(upload, start, end),
+        status=206 if byte_range else 200,
+        content_type=content_type,
+    )
+    response['Content-Length'] = end - start + 1
+    response['Accept-Ranges'] = 'bytes'
+    if byte_range:
+        response['Content-Range'] = f'bytes {start}-{end}/{upload.file_size}'
+    disposition = 'inline' if content_type in attachments.INLINE_IMAGE_TYPES else 'attachment'
+    response['Content-Disposition'] = f"{disposition}; filename*=UTF-8''{quote(upload.file_name)}"
+    response['Content-Security-Policy'] = 'sandbox'
+    response['X-Content-Type-Options'] = 'nosniff'
+    response['Cache-Control'] = 'private'
+    return response
+
+
+@login_required
+@require_http_methods(["GET"])
+def attachment_thumbnail(request, message_id, size, digest):
+    """API: An image preview; its URL changes with its content, so it is cached for good"""
+    upload = get_object_or_404(
+        AttachmentUpload,
+        message_id=message_id,
+        message__is_deleted=False,
+        room__participants=request.user,
+    )
+    if upload.thumbnails.get(str(size)) != digest:
+        raise Http404
+    response = HttpResponse(attachments.read_thumbnail(upload, size), content_type=f'image/{thumbnail_extension()}')
+    response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+
+@login_required
+@require_http_methods(["GET"])
+def search_messages(request):
+    """API: Ranked search over messages in the user's rooms; archived ones are not indexed"""
+    query = request.GET.get('q', '').strip()
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid page'}, status=400)
+    if not query:
+        return JsonResponse({'error': 'Query is required'}, status=400)
+
+    results, has_next = search.search_messages(
+        request.user, query, page=page, page_size=getattr(settings, 'CHAT_SEARCH_PAGE_SIZE', 20)
+    )
+    return JsonResponse({
+        'results': results,
+        'page': page,
+        'has_next': has_next,
+        'status': 'success'
+    })
+
+
+@login_required
+@require_http_methods(["GET"])
+def directory_search(request):
+    """API: Rooms and contacts whose names start with the query, for the dashboard"""
+    query = request.GET.get('q', '')
+    default_limit = getattr(settings, 'CHAT_DIRECTORY_SEARCH_LIMIT', 10)
+    try:
+        limit = min(max(int(request.GET.get('limit', default_limit)), 1), 50)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid limit'}, status=400)
+
+    response = JsonResponse({
+        **search.cached_directory_matches(request.user, query, limit),
+        'status': 'success'
+    })
+    # Let the browser reuse answers while the user edits the query
+    patch_cache_control(response, private=True, max_age=getattr(settings, 'CHAT_DIRECTORY_SEARCH_CACHE_TIMEOUT', 30))
+    return response
+
+
+@login_required
+@require_http_methods(["GET"])
+def websocket_ticket(request, room_name=None):
+    """API: Issue a short-lived ticket for connecting to a room's WebSocket (or the multiplexed one)"""
+    if room_name is not None and not ChatRoom.objects.filter(
+        name=room_name, participants=request.user, is_active=True
+    ).exists():
+        return JsonResponse({'error': 'Room not found'}, status=404)
+    ticket, expires_at = tickets.issue_ticket(request.user, room_name)
+    response = JsonResponse({'status': 'success', 'ticket': ticket, 'expires_at': expires_at})
+    patch_cache_control(response, no_store=True)
+    return response
+
+
+@staff_member_required
+@require_http_methods(["GET"])
+def history_stats(request):
+    """API: Hit/miss counters of the recent-message cache"""
+    return JsonResponse({
+        'history': message_history.stats(),
+        'status': 'success'
+    })
+
+
 @login_required
 @require_http_methods(["GET"])
 def contact_list(request):
     """API: Get user's contacts"""
-    contacts = Contact.objects.filter(user=request.user, is_blocked=False).select_related('contact_user')
-    
-    contact_data = []
-    for contact in contacts:
-        contact_data.append({
-            'id': contact.contact_user.id,
-            'username': contact.contact_user.username,
-            'email': contact.contact_user.email,
-            'online': hasattr(contact.contact_user, 'presence') and contact.contact_user.presence.online_status,
-            'nickname': contact.nickname,
-        })
-    
     return JsonResponse({
-        'contacts': contact_data,
+        'contacts': contact_list_rows(request.user),
         'status': 'success'
     })
 
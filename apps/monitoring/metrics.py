@@ -0,0 +1,317 @@
+"""
+In-process Prometheus-style metrics.
+
+Counters, gauges and histograms keep plain numbers behind a per-metric
+lock, so recording on a hot path costs a dict lookup and an uncontended
+lock (about a microsecond). Each process keeps its own registry; scrape
+every worker, or put them behind one that aggregates.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in list(self._metrics):
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Timer:
+    __slots__ = ('observe', 'started')
+
+    def __init__(self, observe):
+        self.observe = observe
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.observe(time.perf_counter() - self.started)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), register=True):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self._children[()] = self._new_child()
+        if register:
+            registry.register(self)
+
+    def labels(self, *values):
+        """Return the child metric for one combination of label values"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f'{self.name} expects labels {self.labelnames}')
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def samples(self):
+        for values, child in sorted(self._children.items()):
+            yield from child.samples(self.name, self.labelnames, values)
+
+
+class _CounterChild:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labelnames, values):
+        yield f'{name}{_format_labels(labelnames, values)} {_format_value(self.value)}'
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down. Gauges built with ``callback`` are
+    computed at scrape time; the callback returns a number, or a dict of
+    label-value tuples to numbers for labelled gauges.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None, register=True):
+        self.callback = callback
+        super().__init__(name, documentation, labelnames, register)
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set(self, value):
+        self._default.set(value)
+
+    def samples(self):
+        if self.callback is None:
+            yield from super().samples()
+            return
+        try:
+            result = self.callback()
+        except Exception:
+            return
+        if not isinstance(result, dict):
+            result = {(): result}
+        for values, value in sorted(result.items()):
+            yield f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(value)}'
+
+
+class CounterFunc(Gauge):
+    """A counter whose running total is read from elsewhere at scrape time"""
+    kind = 'counter'
+
+
+class _HistogramChild:
+    __slots__ = ('upper_bounds', 'counts', 'sum', 'lock')
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.upper_bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the duration of its block"""
+        return _Timer(self.observe)
+
+    def samples(self, name, labelnames, values):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.upper_bounds + (float('inf'),), counts):
+            cumulative += count
+            labels = _format_labels(labelnames, values, ('le', _format_value(float(bound))))
+            yield f'{name}_bucket{labels} {cumulative}'
+        yield f'{name}_sum{_format_labels(labelnames, values)} {_format_value(total)}'
+        yield f'{name}_count{_format_labels(labelnames, values)} {cumulative}'
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, register=True):
+        self.upper_bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, register)
+
+    def _new_child(self):
+        return _HistogramChild(self.upper_bounds)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+
+# WebSocket consumers
+WS_CONNECTS = Counter(
+    'ciphertalk_ws_connects_total', 'WebSocket connection attempts by outcome', ['outcome']
+)
+WS_CONNECTIONS = Gauge('ciphertalk_ws_connections', 'Open chat WebSocket connections')
+WS_EVENT_SECONDS = Histogram(
+    'ciphertalk_ws_event_seconds', 'Time spent handling client WebSocket events', ['event']
+)
+WS_GROUP_SENDS = Counter(
+    'ciphertalk_ws_group_sends_total', 'Events broadcast to room groups', ['event']
+)
+WS_DELIVERIES = Counter(
+    'ciphertalk_ws_deliveries_total',
+    'Group events delivered to individual sockets (deliveries / group sends = fan-out)',
+    ['event']
+)
+MESSAGE_DB_SECONDS = Histogram(
+    'ciphertalk_message_db_seconds', 'Time to store one chat message, including the thread hop'
+)
+
+# Encryption
+ENCRYPTION_SECONDS = Histogram(
+    'ciphertalk_encryption_seconds', 'Time spent in AES encryption calls', ['operation'],
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005, 0.01),
+)
+
+# HTTP views
+HTTP_REQUEST_SECONDS = Histogram(
+    'ciphertalk_http_request_seconds', 'Time to handle HTTP requests', ['view', 'method']
+)
+HTTP_RESPONSES = Counter(
+    'ciphertalk_http_responses_total', 'HTTP responses by view and status code', ['view', 'status']
+)
+
+# Celery tasks
+TASK_SECONDS = Histogram(
+    'ciphertalk_task_seconds', 'Celery task run time', ['task', 'state'],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0),
+)
+
+
+def _channel_layer_depths():
+    from channels.layers import get_channel_layer
+    layer = get_channel_layer()
+    channels = getattr(layer, 'channels', None)
+    if channels is None:
+        # Only the in-memory layer exposes its queues
+        return {}
+    depths = [queue.qsize() for queue in list(channels.values())]
+    return {
+        ('total',): sum(depths),
+        ('max',): max(depths, default=0),
+    }
+
+
+CHANNEL_LAYER_QUEUE_DEPTH = Gauge(
+    'ciphertalk_channel_layer_queue_depth',
+    'Messages waiting in channel layer queues of this process', ['aggregate'],
+    callback=_channel_layer_depths,
+)
+
+
+def _history_stat(name):
+    def read():
+        from apps.chat.history import message_history
+        return message_history.stats()[name]
+    return read
+
+
+HISTORY_ROOMS = Gauge(
+    'ciphertalk_history_rooms_tracked', 'Rooms held in the recent-message buffer',
+    callback=_history_stat('rooms_tracked'),
+)
+HISTORY_HITS = CounterFunc(
+    'ciphertalk_history_buffer_hits_total', 'Recent-message reads served from process memory',
+    callback=_history_stat('hits'),
+)
+HISTORY_CACHE_HITS = CounterFunc(
+    'ciphertalk_history_cache_hits_total', 'Recent-message reads served from the Django cache',
+    callback=_history_stat('cache_hits'),
+)
+HISTORY_MISSES = CounterFunc(
+    'ciphertalk_history_misses_total', 'Recent-message reads that went to the database',
+    callback=_history_stat('misses'),
+)
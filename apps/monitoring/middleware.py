@@ -0,0 +1,23 @@
+import time
+
+from .metrics import HTTP_REQUEST_SECONDS, HTTP_RESPONSES
+
+
+class MetricsMiddleware:
+    """
+    Time every HTTP request and count responses, labelled by the resolved
+    view name so the label set stays bounded.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        view = (match.view_name or match._func_path) if match else 'unresolved'
+        HTTP_REQUEST_SECONDS.labels(view, request.method).observe(elapsed)
+        HTTP_RESPONSES.labels(view, str(response.status_code)).inc()
+        return response
@@ -0,0 +1,166 @@
+"""
+Opt-in per-request and per-event query profiling.
+
+While a ``ProfileScope`` is active, every SQL statement run on its behalf,
+including statements run in ``sync_to_async`` threads (which inherit the
+context), is counted, timed and fingerprinted. Scopes that are slow or
+run too many queries are logged with their most repeated statements, and
+a sampled fraction of requests are also run under cProfile with the stats
+written to ``PROFILING_DUMP_DIR``.
+
+cProfile and CPU time are per thread. A consumer event awaits on the event
+loop thread, which runs every other coroutine meanwhile, and its ORM work
+runs in other threads; so consumer events get query counts and wall time
+only.
+"""
+import cProfile
+import contextvars
+import logging
+import os
+import random
+import re
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('ciphertalk_profile', default=None)
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\bIN\s*\((?:\s*(?:%s|\?)\s*,?)+\)', re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+
+
+def profiling_enabled():
+    return getattr(settings, 'PROFILING_ENABLED', False)
+
+
+def fingerprint(sql):
+    """Reduce a statement to its shape so repeats with other values match"""
+    sql = _STRING_LITERAL.sub('?', sql)
+    sql = _NUMBER_LITERAL.sub('?', sql)
+    sql = sql.replace('%s', '?')
+    sql = _IN_LIST.sub('IN (...)', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper feeding the active profile scope, if any"""
+    profile = _current.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.queries += 1
+        profile.db_time += time.perf_counter() - started
+        profile.fingerprints[fingerprint(sql)] += 1
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    """connection_created receiver adding the recorder to each connection once"""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class ProfileScope:
+    """
+    Collect query and timing statistics for one request or consumer event.
+    ``per_thread`` adds CPU time and cProfile sampling, which are only
+    meaningful when the scope has its thread to itself.
+    """
+    def __init__(self, label, per_thread=True):
+        self.label = label
+        self.per_thread = per_thread
+        self.queries = 0
+        self.db_time = 0.0
+        self.fingerprints = Counter()
+        self.profiler = None
+        self._token = None
+
+    def __enter__(self):
+        if _current.get() is not None:
+            # Already inside a scope; let the outer one account for everything
+            return self
+        self._token = _current.set(self)
+        sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0.0) if self.per_thread else 0
+        if sample_rate and random.random() < sample_rate:
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # Another profiler is already running on this thread
+                self.profiler = None
+        self._wall_started = time.perf_counter()
+        self._cpu_started = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._token is None:
+            return
+        self.wall_time = time.perf_counter() - self._wall_started
+        self.cpu_time = time.thread_time() - self._cpu_started if self.per_thread else None
+        if self.profiler is not None:
+            self.profiler.disable()
+        _current.reset(self._token)
+        self.report()
+
+    def duplicates(self):
+        return [(sql, count) for sql, count in self.fingerprints.most_common() if count > 1]
+
+    def summary(self):
+        summary = {
+            'label': self.label,
+            'queries': self.queries,
+            'db_ms': round(self.db_time * 1000, 2),
+            'wall_ms': round(self.wall_time * 1000, 2),
+            'duplicated': self.duplicates()[:5],
+        }
+        if self.cpu_time is not None:
+            summary['cpu_ms'] = round(self.cpu_time * 1000, 2)
+        return summary
+
+    def report(self):
+        slow_ms = getattr(settings, 'PROFILING_SLOW_MS', 500)
+        slow_queries = getattr(settings, 'PROFILING_SLOW_QUERIES', 50)
+        if self.wall_time * 1000 >= slow_ms or self.queries >= slow_queries:
+            logger.warning("Slow %s: %s", self.label, self.summary())
+        if self.profiler is not None:
+            self.dump()
+
+    def dump(self):
+        directory = getattr(settings, 'PROFILING_DUMP_DIR', None)
+        if not directory:
+            return
+        os.makedirs(directory, exist_ok=True)
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '_', self.label).strip('_')[:80]
+        path = os.path.join(directory, f'{int(time.time() * 1000)}-{int(self.wall_time * 1000)}ms-{name}.prof')
+        self.profiler.dump_stats(path)
+        logger.info("Wrote profile %s", path)
+
+
+class QueryProfilingMiddleware:
+    """Profile each HTTP request when PROFILING_ENABLED is set"""
+    def __init__(self, get_response):
+        if not profiling_enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with ProfileScope(f'{request.method} {request.path}'):
+            return self.get_response(request)
+
+
+class ProfiledConsumerMixin:
+    """Count queries and wall time of each consumer event when PROFILING_ENABLED is set"""
+    async def dispatch(self, message):
+        if not profiling_enabled():
+            return await super().dispatch(message)
+        path = self.scope.get('path', '')
+        with ProfileScope(f"{message['type']} {path}", per_thread=False):
+            return await super().dispatch(message)
@@ -0,0 +1,27 @@
+import time
+
+from celery.signals import task_prerun, task_postrun
+from django.db.backends.signals import connection_created
+
+from .metrics import TASK_SECONDS
+from .profiling import install_query_recorder
+
+_task_started = {}
+
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    """Remember when a Celery task started running"""
+    _task_started[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def record_task_duration(task_id=None, task=None, state=None, **kwargs):
+    """Record a finished Celery task's run time"""
+    started = _task_started.pop(task_id, None)
+    if started is not None and task is not None:
+        TASK_SECONDS.labels(task.name, state or 'UNKNOWN').observe(time.perf_counter() - started)
+
+
+# The recorder is a no-op unless a profile scope is active
+connection_created.connect(install_query_recorder)
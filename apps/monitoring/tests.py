@@ -0,0 +1,126 @@
+import os
+import tempfile
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from apps.chat.models import Contact
+from .metrics import Counter, Gauge, Histogram, Registry, registry
+from .profiling import ProfileScope, fingerprint, install_query_recorder
+
+User = get_user_model()
+
+
+class MetricPrimitiveTests(TestCase):
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('test_seconds', 'Test', ['event'], buckets=(0.1, 1.0), register=False)
+        child = histogram.labels('send')
+        for value in (0.05, 0.5, 5.0):
+            child.observe(value)
+
+        samples = list(histogram.samples())
+        self.assertIn('test_seconds_bucket{event="send",le="0.1"} 1', samples)
+        self.assertIn('test_seconds_bucket{event="send",le="1"} 2', samples)
+        self.assertIn('test_seconds_bucket{event="send",le="+Inf"} 3', samples)
+        self.assertIn('test_seconds_count{event="send"} 3', samples)
+
+    def test_render_includes_help_type_and_escaped_labels(self):
+        local = Registry()
+        counter = local.register(Counter('test_total', 'Things', ['name'], register=False))
+        counter.labels('a"b').inc(2)
+        gauge = local.register(Gauge('test_depth', 'Depth', callback=lambda: 7, register=False))
+
+        text = local.render()
+        self.assertIn('# TYPE test_total counter', text)
+        self.assertIn('test_total{name="a\\"b"} 2', text)
+        self.assertIn('test_depth 7', text)
+        self.assertIsNotNone(gauge)
+
+
+class MetricsEndpointTests(TestCase):
+    REMOTE = {'REMOTE_ADDR': '203.0.113.7'}
+
+    @override_settings(METRICS_TOKEN='s3cret')
+    def test_exposes_registry(self):
+        response = self.client.get(reverse('monitoring:metrics'), HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('ciphertalk_ws_connections', response.content.decode())
+        self.assertIn('ciphertalk_http_request_seconds', registry.render())
+
+    def test_denied_by_default(self):
+        url = reverse('monitoring:metrics')
+        self.assertEqual(self.client.get(url, **self.REMOTE).status_code, 403)
+        # The test client connects from loopback
+        self.assertEqual(self.client.get(url).status_code, 403)
+        with self.settings(DEBUG=True):
+            self.assertEqual(self.client.get(url, **self.REMOTE).status_code, 200)
+
+    @override_settings(METRICS_ALLOW_LOOPBACK=True)
+    def test_loopback_is_opt_in_and_not_forwarded(self):
+        url = reverse('monitoring:metrics')
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.client.get(url, HTTP_X_FORWARDED_FOR='203.0.113.7').status_code, 403)
+        self.assertEqual(self.client.get(url, **self.REMOTE).status_code, 403)
+
+    def test_staff_may_scrape(self):
+        self.client.force_login(User.objects.create_user('ops', 'ops@example.com', 'pass', is_staff=True))
+        self.assertEqual(self.client.get(reverse('monitoring:metrics'), **self.REMOTE).status_code, 200)
+
+    @override_settings(METRICS_TOKEN='s3cret')
+    def test_token_admits_remote_scrapers(self):
+        url = reverse('monitoring:metrics')
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong', **self.REMOTE).status_code, 403)
+        response = self.client.get(url, HTTP_AUTHORIZATION='Bearer s3cret', **self.REMOTE)
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(PROFILING_SAMPLE_RATE=0)
+class QueryProfilingTests(TestCase):
+    def setUp(self):
+        # The test connection was opened before connection_created was hooked up
+        install_query_recorder(None, connection)
+        self.user = User.objects.create_user('profiled', 'profiled@example.com', 'pass')
+        for i in range(3):
+            Contact.objects.create(
+                user=self.user, contact_user=User.objects.create_user(f'friend{i}', f'friend{i}@example.com', 'pass')
+            )
+        self.client.force_login(self.user)
+
+    def test_fingerprint_ignores_literal_values(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM t WHERE id = 12 AND name = 'bob'  AND x IN (%s, %s)"),
+            "SELECT * FROM t WHERE id = ? AND name = ? AND x IN (...)",
+        )
+
+    def test_scope_counts_queries_and_duplicates(self):
+        with ProfileScope('test') as profile:
+            for contact in Contact.objects.filter(user=self.user):
+                contact.contact_user.username
+        self.assertEqual(profile.queries, 4)
+        self.assertEqual(profile.duplicates()[0][1], 3)
+
+    @override_settings(PROFILING_ENABLED=True, PROFILING_SLOW_QUERIES=1)
+    def test_middleware_logs_slow_requests(self):
+        with self.assertLogs('apps.monitoring.profiling', 'WARNING') as logs:
+            self.client.get(reverse('chat:contact_list'))
+        self.assertIn(f"Slow GET {reverse('chat:contact_list')}", logs.output[0])
+
+    def test_sampled_scope_dumps_profile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(PROFILING_SAMPLE_RATE=1, PROFILING_DUMP_DIR=directory):
+                with ProfileScope('GET /sampled/'):
+                    list(Contact.objects.all())
+            dumps = os.listdir(directory)
+        self.assertEqual(len(dumps), 1)
+        self.assertTrue(dumps[0].endswith('GET_sampled.prof'))
+
+    def test_consumer_scopes_skip_per_thread_stats(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(PROFILING_SAMPLE_RATE=1, PROFILING_DUMP_DIR=directory):
+                with ProfileScope('websocket.receive /ws/chat/', per_thread=False) as profile:
+                    list(Contact.objects.all())
+            self.assertEqual(os.listdir(directory), [])
+        self.assertEqual(profile.queries, 1)
+        self.assertNotIn('cpu_ms', profile.summary())
@@ -0,0 +1,34 @@
+import hmac
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.decorators.http import require_http_methods
+
+from .metrics import registry
+
+LOOPBACK_ADDRESSES = ('127.0.0.1', '::1')
+
+
+def scrape_allowed(request):
+    """Debug mode, the metrics token, a staff session or, if allowed, a direct local connection"""
+    if settings.DEBUG or request.user.is_staff:
+        return True
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token:
+        supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if hmac.compare_digest(supplied.encode(), token.encode()):
+            return True
+    # Behind a reverse proxy on this host every request comes from loopback,
+    # so this is opt-in, and forwarded requests never count
+    return (getattr(settings, 'METRICS_ALLOW_LOOPBACK', False)
+            and request.META.get('REMOTE_ADDR') in LOOPBACK_ADDRESSES
+            and 'HTTP_X_FORWARDED_FOR' not in request.META)
+
+
+@require_http_methods(["GET"])
+def metrics(request):
+    """Prometheus scrape endpoint"""
+    if not scrape_allowed(request):
+        return HttpResponseForbidden('Metrics require a token')
+
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
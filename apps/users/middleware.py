@@ -0,0 +1,33 @@
+import time
+
+from django.conf import settings
+
+REFRESHED_AT_KEY = '_refreshed_at'
+
+
+class SlidingSessionMiddleware:
+    """
+    Extend a session's expiry at most once per ``SESSION_REFRESH_INTERVAL``.
+
+    With ``SESSION_SAVE_EVERY_REQUEST`` off, a session is only written when
+    it changes, so an idle-but-active user would be logged out two weeks
+    after login. This marks the session modified once its last refresh is
+    older than the interval, and SessionMiddleware then saves it and resends
+    the cookie with a new expiry: about one write per session per interval
+    instead of one per request. Must come after SessionMiddleware.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        session = getattr(request, 'session', None)
+        if session is None or session.session_key is None or session.is_empty():
+            return response
+
+        now = int(time.time())
+        interval = getattr(settings, 'SESSION_REFRESH_INTERVAL', 24 * 60 * 60)
+        # A session being saved anyway (e.g. at login) restarts the interval for free
+        if session.modified or now - session.get(REFRESHED_AT_KEY, 0) >= interval:
+            session[REFRESHED_AT_KEY] = now
+        return response
@@ -1,5 +1,6 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.db.models.functions import Lower
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
@@ -23,6 +24,10 @@ class CustomUser(AbstractUser):
         db_table = 'users'
         verbose_name = 'User'
         verbose_name_plural = 'Users'
+        indexes = [
+            # Case-insensitive prefix search of contacts
+            models.Index(Lower('username'), name='users_username_lower_idx'),
+        ]
 
 
 class UserProfile(models.Model):
@@ -38,6 +43,8 @@ class UserProfile(models.Model):
         null=True,
         default='avatars/default.png'
     )
+    # {'source': avatar name, 'sizes': {size: file name}}, filled in by a task
+    avatar_thumbnails = models.JSONField(default=dict, blank=True)
     online_status = models.BooleanField(default=False)
     last_seen = models.DateTimeField(auto_now=True)
     date_of_birth = models.DateField(blank=True, null=True)
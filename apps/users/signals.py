@@ -1,6 +1,10 @@
+from functools import partial
+
+from django.db import transaction
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from .models import CustomUser, UserProfile
+from .tasks import generate_avatar_thumbnails
 
 
 @receiver(post_save, sender=CustomUser)
@@ -21,4 +25,16 @@ def save_user_profile(sender, instance, **kwargs):
         instance.profile.save()
     except UserProfile.DoesNotExist:
         # If profile doesn't exist, create it
-        UserProfile.objects.create(user=instance)
\ No newline at end of file
+        UserProfile.objects.create(user=instance)
+
+
+@receiver(post_save, sender=UserProfile)
+def queue_avatar_thumbnails(sender, instance, **kwargs):
+    """
+    Generate thumbnails in the background when the avatar changes
+    """
+    name = instance.avatar.name if instance.avatar else None
+    if name and name != instance.avatar_thumbnails.get('source') and name != getattr(instance, '_thumbnails_queued', None):
+        # The profile is often saved twice on creation; queue one task
+        instance._thumbnails_queued = name
+        transaction.on_commit(partial(generate_avatar_thumbnails.delay, instance.pk))
@@ -1,6 +1,8 @@
 from celery import shared_task
 from django.core.mail import send_mail
 from django.conf import settings
+from .models import UserProfile
+from .thumbnails import make_avatar_thumbnails
 
 
 @shared_task
@@ -66,4 +68,19 @@ def send_otp_email_task(user_email, otp_code, otp_type):
         settings.DEFAULT_FROM_EMAIL,
         [user_email],
         fail_silently=False,
-    )
\ No newline at end of file
+    )
+
+
+@shared_task
+def generate_avatar_thumbnails(profile_id):
+    """
+    Resize a user's avatar to the configured thumbnail sizes
+    """
+    profile = UserProfile.objects.filter(pk=profile_id).first()
+    if profile is None or not profile.avatar:
+        return "No avatar"
+
+    thumbnails = make_avatar_thumbnails(profile.avatar)
+    # Skip the update if the avatar was replaced meanwhile; its own task follows
+    UserProfile.objects.filter(pk=profile_id, avatar=profile.avatar.name).update(avatar_thumbnails=thumbnails)
+    return f"Generated {len(thumbnails['sizes'])} avatar thumbnails"
@@ -0,0 +1,14 @@
+from django import template
+
+from ..thumbnails import profile_avatar_url
+
+register = template.Library()
+
+
+@register.filter
+def avatar_url(profile, size):
+    """
+    URL of the avatar thumbnail of ``profile`` for display at ``size`` px,
+    or '' while none has been generated
+    """
+    return profile_avatar_url(profile, int(size)) or ''
@@ -1,3 +1,119 @@
-from django.test import TestCase
+import shutil
+import tempfile
+import time
+from io import BytesIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from PIL import Image
+
+from .middleware import REFRESHED_AT_KEY
+from .models import CustomUser
+from .thumbnails import render_thumbnails
+
+
+def make_image(size=(1200, 800), fmt='JPEG'):
+    output = BytesIO()
+    Image.new('RGB', size, (200, 40, 90)).save(output, fmt)
+    return output.getvalue()
+
+
+class ThumbnailRenderingTests(TestCase):
+    def test_sizes_fit_longest_side_without_upscaling(self):
+        thumbnails = render_thumbnails(make_image(), (48, 256, 2000))
+        dimensions = {size: Image.open(BytesIO(data)).size for size, data in thumbnails.items()}
+        self.assertEqual(dimensions, {48: (48, 32), 256: (256, 171), 2000: (1200, 800)})
+        self.assertEqual(Image.open(BytesIO(thumbnails[48])).format, 'WEBP')
+
+    def test_unreadable_data_gives_no_thumbnails(self):
+        self.assertEqual(render_thumbnails(b'not an image', (48,)), {})
+
+
+class AvatarThumbnailTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, AVATAR_THUMBNAIL_SIZES=(48, 256))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = CustomUser.objects.create_user(
+            username='alice', email='alice@example.com', password='secret-pass'
+        )
+
+    def set_avatar(self, user, data):
+        profile = user.profile
+        profile.avatar = SimpleUploadedFile('me.jpg', data, content_type='image/jpeg')
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.save()
+        profile.refresh_from_db()
+        return profile
+
+    def test_new_avatar_gets_content_named_thumbnails(self):
+        profile = self.set_avatar(self.user, make_image())
+        self.assertEqual(profile.avatar_thumbnails['source'], profile.avatar.name)
+        self.assertEqual(set(profile.avatar_thumbnails['sizes']), {'48', '256'})
+
+        response = self.client.get(f"/users/avatars/{profile.avatar_thumbnails['sizes']['48']}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(Image.open(BytesIO(b''.join(response.streaming_content))).size, (48, 32))
+
+    def test_identical_avatars_share_thumbnails(self):
+        bob = CustomUser.objects.create_user(username='bob', email='bob@example.com', password='secret-pass')
+        data = make_image()
+        self.assertEqual(
+            self.set_avatar(self.user, data).avatar_thumbnails['sizes'],
+            self.set_avatar(bob, data).avatar_thumbnails['sizes'],
+        )
+
+    def test_pages_request_the_fitting_size(self):
+        profile = self.set_avatar(self.user, make_image())
+        self.client.force_login(self.user)
+        response = self.client.get('/users/profile/')
+        self.assertContains(response, f"/users/avatars/{profile.avatar_thumbnails['sizes']['256']}")
+        self.assertNotContains(response, profile.avatar.url)
+
+    def test_unknown_thumbnail_names_are_not_found(self):
+        self.assertEqual(self.client.get('/users/avatars/../me.jpg').status_code, 404)
+        self.assertEqual(self.client.get('/users/avatars/0123456789abcdef0123-48.webp').status_code, 404)
+
+
+class SlidingSessionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user(
+            username='alice', email='alice@example.com', password='secret-pass'
+        )
+        self.client.force_login(self.user)
+
+    def session_queries(self, requests=1, at=None):
+        """Make ``requests`` GETs (at time ``at``); returns the django_session queries"""
+        with mock.patch('apps.users.middleware.time.time', return_value=at or time.time()):
+            with CaptureQueriesContext(connection) as queries:
+                for _ in range(requests):
+                    response = self.client.get(reverse('api:room_list', args=['v1']))
+                    self.assertEqual(response.status_code, 200)
+        return [query['sql'] for query in queries.captured_queries if 'django_session' in query['sql']]
+
+    def test_repeated_requests_do_not_touch_the_session_table(self):
+        self.session_queries()
+        self.assertEqual(self.session_queries(requests=5), [])
+
+    def test_session_is_refreshed_once_per_interval(self):
+        self.session_queries()
+        stamped = self.client.session[REFRESHED_AT_KEY]
+
+        later = stamped + 25 * 60 * 60
+        writes = self.session_queries(requests=3, at=later)
+        self.assertEqual(len([sql for sql in writes if sql.startswith('UPDATE')]), 1)
+        self.assertEqual(self.client.session[REFRESHED_AT_KEY], later)
+
+    def test_anonymous_requests_create_no_session(self):
+        self.client.logout()
+        self.client.get(reverse('users:login'))
+        self.assertNotIn('sessionid', self.client.cookies)
@@ -0,0 +1,111 @@
+"""
+Thumbnails for avatars and image messages.
+
+Images are decoded once and resized to the configured sizes (longest
+side, never upscaled) in ``THUMBNAIL_FORMAT``, largest first so each size
+is resampled from the previous one instead of the full image. Avatar
+thumbnails are named after a hash of the source image, so identical
+avatars share files and a name never changes content, which lets them be
+served with far-future cache headers.
+"""
+import hashlib
+import logging
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+AVATAR_THUMBNAIL_DIR = 'avatars/thumbs'
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:20]
+
+
+def thumbnail_extension():
+    return getattr(settings, 'THUMBNAIL_FORMAT', 'WEBP').lower()
+
+
+def render_thumbnails(data, sizes):
+    """
+    Map size -> encoded thumbnail of the image in ``data``. Returns an
+    empty dict for data that is not a readable image.
+    """
+    try:
+        image = Image.open(BytesIO(data))
+        # JPEG can decode at a reduced scale, which is much faster
+        image.draft('RGB', (max(sizes), max(sizes)))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        logger.warning("Cannot make thumbnails: %s", e)
+        return {}
+
+    fmt = getattr(settings, 'THUMBNAIL_FORMAT', 'WEBP')
+    quality = getattr(settings, 'THUMBNAIL_QUALITY', 80)
+    thumbnails = {}
+    for size in sorted(sizes, reverse=True):
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+        output = BytesIO()
+        image.save(output, fmt, quality=quality, method=4)
+        thumbnails[size] = output.getvalue()
+    return thumbnails
+
+
+def avatar_thumbnail_name(digest, size):
+    return f'{AVATAR_THUMBNAIL_DIR}/{digest}-{size}.{thumbnail_extension()}'
+
+
+def make_avatar_thumbnails(avatar):
+    """
+    Store thumbnails of an avatar ``FieldFile`` and return the
+    ``avatar_thumbnails`` value describing them.
+    """
+    thumbnails = {'source': avatar.name, 'sizes': {}}
+    max_source = getattr(settings, 'THUMBNAIL_MAX_SOURCE_SIZE', 32 * 1024 * 1024)
+    try:
+        if avatar.size > max_source:
+            return thumbnails
+        with avatar.open('rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return thumbnails
+    except OSError as e:
+        logger.warning("Cannot read avatar %s: %s", avatar.name, e)
+        return thumbnails
+
+    digest = content_hash(data)
+    sizes = getattr(settings, 'AVATAR_THUMBNAIL_SIZES', (48, 96, 256))
+    names = {size: avatar_thumbnail_name(digest, size) for size in sizes}
+    if not all(default_storage.exists(name) for name in names.values()):
+        for size, thumbnail in render_thumbnails(data, sizes).items():
+            if not default_storage.exists(names[size]):
+                default_storage.save(names[size], ContentFile(thumbnail))
+    thumbnails['sizes'] = {
+        str(size): name.rsplit('/', 1)[1] for size, name in names.items() if default_storage.exists(name)
+    }
+    return thumbnails
+
+
+def pick_size(available, size):
+    """The smallest available size covering ``size``, else the largest one"""
+    sizes = sorted(int(s) for s in available)
+    return next((s for s in sizes if s >= size), sizes[-1])
+
+
+def avatar_url(avatar_thumbnails, size):
+    """URL of the avatar thumbnail best suited to display at ``size`` px, or None"""
+    available = (avatar_thumbnails or {}).get('sizes')
+    if not available:
+        return None
+    return reverse('users:avatar_thumbnail', args=[available[str(pick_size(available, size))]])
+
+
+def profile_avatar_url(profile, size):
+    """``avatar_url`` for a possibly missing profile"""
+    return avatar_url(getattr(profile, 'avatar_thumbnails', None), size)
@@ -13,4 +13,5 @@ urlpatterns = [
     path('profile/', views.profile_view, name='profile'),
     path('profile/edit/', views.edit_profile_view, name='edit_profile'),
     path('security/', views.security_settings_view, name='security'),
+    path('avatars/<str:name>', views.avatar_thumbnail_view, name='avatar_thumbnail'),
 ]
\ No newline at end of file
@@ -1,3 +1,7 @@
+import re
+
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404
 from django.shortcuts import render, redirect
 from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.decorators import login_required
@@ -5,6 +9,9 @@ from django.contrib import messages
 from django.urls import reverse
 from .forms import UserRegistrationForm, UserLoginForm, ProfileUpdateForm, UserUpdateForm
 from .models import UserProfile
+from .thumbnails import AVATAR_THUMBNAIL_DIR
+
+THUMBNAIL_NAME = re.compile(r'[0-9a-f]{20}-\d+\.[a-z]+')
 
 
 
@@ -126,4 +133,14 @@ def security_settings_view(request):
     context = {
         'title': 'Security Settings - CipherTalk'
     }
-    return render(request, 'users/security.html', context)
\ No newline at end of file
+    return render(request, 'users/security.html', context)
+
+
+def avatar_thumbnail_view(request, name):
+    """Serve an avatar thumbnail; names are content hashes, so they can be cached forever"""
+    path = f'{AVATAR_THUMBNAIL_DIR}/{name}'
+    if not THUMBNAIL_NAME.fullmatch(name) or not default_storage.exists(path):
+        raise Http404
+    response = FileResponse(default_storage.open(path, 'rb'))
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
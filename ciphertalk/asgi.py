@@ -6,8 +6,8 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ciphertalk.settings')
 django.setup()
 
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 import apps.chat.routing
+from apps.chat.tickets import TicketAuthMiddleware
 
 # DEBUG: This should print when runserver starts
 print("🔄 ASGI APPLICATION LOADING...")
@@ -18,7 +18,8 @@ print("✅ ASGI ready for WebSocket connections")
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
+    # Ticket auth with no DB reads, else the session (AuthMiddlewareStack)
+    "websocket": TicketAuthMiddleware(
         URLRouter(
             apps.chat.routing.websocket_urlpatterns
         )
@@ -1,6 +1,8 @@
 import os
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -32,15 +34,22 @@ INSTALLED_APPS = [
     
 
     'crispy_forms',
+    'rest_framework',
     
     # Local apps
     'apps.users',
     'apps.chat',
+    'apps.monitoring',
+    'apps.api',
+    'apps.analytics',
 ]
 
 MIDDLEWARE = [
+    'apps.monitoring.middleware.MetricsMiddleware',
+    'apps.monitoring.profiling.QueryProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'apps.users.middleware.SlidingSessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -74,13 +83,59 @@ WSGI_APPLICATION = 'ciphertalk.wsgi.application'
 # ASGI for Channels WebSocket support
 ASGI_APPLICATION = 'ciphertalk.asgi.application'
 
-# Database
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# Database, by DATABASE_PROFILE:
+# - 'sqlite' (default): WAL journal so readers never block the writer,
+#   synchronous=NORMAL (durable at checkpoints, not every commit), a busy
+#   timeout instead of immediate 'database is locked', memory-mapped reads,
+#   and BEGIN IMMEDIATE so writers queue up front rather than failing to
+#   upgrade a read lock. SQLITE_TUNING=0 keeps SQLite's defaults.
+# - 'postgres': persistent connections with health checks, or a psycopg
+#   connection pool when POSTGRES_POOL_MAX_SIZE is set (needs psycopg[pool]).
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'sqlite')
+if DATABASE_PROFILE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'ciphertalk'),
+            'USER': os.environ.get('POSTGRES_USER', 'ciphertalk'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            'CONN_HEALTH_CHECKS': True,
+            'CONN_MAX_AGE': int(os.environ.get('POSTGRES_CONN_MAX_AGE', 600)),
+            'OPTIONS': {},
+        }
     }
-}
+    if os.environ.get('POSTGRES_POOL_MAX_SIZE'):
+        # The pool owns connection lifetime; Django requires CONN_MAX_AGE=0 with it
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': int(os.environ.get('POSTGRES_POOL_MIN_SIZE', 2)),
+            'max_size': int(os.environ['POSTGRES_POOL_MAX_SIZE']),
+            'timeout': int(os.environ.get('POSTGRES_POOL_TIMEOUT', 10)),
+        }
+elif DATABASE_PROFILE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+        }
+    }
+    if os.environ.get('SQLITE_TUNING', '1') == '1':
+        DATABASES['default']['OPTIONS'] = {
+            'init_command': (
+                'PRAGMA journal_mode=WAL;'
+                'PRAGMA synchronous=NORMAL;'
+                f"PRAGMA mmap_size={int(os.environ.get('SQLITE_MMAP_SIZE', 128 * 1024 * 1024))};"
+                'PRAGMA cache_size=-20000;'
+                'PRAGMA temp_store=MEMORY;'
+            ),
+            'transaction_mode': 'IMMEDIATE',
+            # Busy timeout: seconds a connection waits for the write lock
+            'timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)) / 1000,
+        }
+else:
+    raise ImproperlyConfigured(f"Unknown DATABASE_PROFILE {DATABASE_PROFILE!r}; use 'sqlite' or 'postgres'")
 
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
@@ -124,6 +179,22 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Crispy Forms
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
+# REST API (/api/v1/): session auth, JSON only, cursor-paginated
+REST_FRAMEWORK = {
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'rest_framework.authentication.SessionAuthentication',
+    ],
+    'DEFAULT_PERMISSION_CLASSES': [
+        'rest_framework.permissions.IsAuthenticated',
+    ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'rest_framework.renderers.JSONRenderer',
+    ],
+    'DEFAULT_VERSIONING_CLASS': 'rest_framework.versioning.URLPathVersioning',
+    'DEFAULT_VERSION': 'v1',
+    'ALLOWED_VERSIONS': ['v1'],
+}
+
 # Channels configuration (for WebSockets)
 CHANNEL_LAYERS = {
     'default': {
@@ -131,6 +202,108 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Cache (shared across processes when REDIS_URL is set)
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Background tasks: without a broker, tasks run inline in the calling process
+CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', '')
+CELERY_TASK_ALWAYS_EAGER = not CELERY_BROKER_URL
+CELERY_TASK_IGNORE_RESULT = True
+
+# Chat history: recent messages kept per room for reconnect replay and page loads
+CHAT_HISTORY_BUFFER_SIZE = 200
+CHAT_HISTORY_CACHE_TIMEOUT = 300
+CHAT_RESUME_MAX_MESSAGES = 500
+CHAT_ROOM_PAGE_SIZE = 100
+# Archive: messages older than this many days, or beyond the newest N of their room,
+# are moved into compressed blocks (None disables a rule; 'zstd' needs zstandard)
+CHAT_ARCHIVE_AFTER_DAYS = 180
+CHAT_ARCHIVE_KEEP_RECENT = 5000
+CHAT_ARCHIVE_BLOCK_SIZE = 500
+CHAT_ARCHIVE_CODEC = 'zlib'
+# Backups: incremental runs of compressed, checksummed segments (see apps/chat/backup.py)
+CHAT_BACKUP_DIR = os.environ.get('CHAT_BACKUP_DIR', BASE_DIR / 'backups')
+CHAT_BACKUP_CHUNK_SIZE = 2000
+CHAT_BACKUP_SEGMENT_ROWS = 50000
+CHAT_BACKUP_RESTORE_WORKERS = 4
+# Offline message email digests: at most one per user per window, sent in batches
+# over one mail connection by the send_notification_digests task
+CHAT_NOTIFICATION_DIGEST_MINUTES = 15
+CHAT_NOTIFICATION_BATCH_SIZE = 100
+# Analytics rollups: message ids folded per transaction, and how long new
+# messages wait so ids of still-open transactions are not skipped
+ANALYTICS_ROLLUP_CHUNK_SIZE = 10000
+ANALYTICS_ROLLUP_LAG_SECONDS = 60
+ANALYTICS_MAX_BUCKETS = 1000
+# HyperLogLog precision for active-user sketches: 2**p bytes each, ~1.04/sqrt(2**p) error
+ANALYTICS_HLL_PRECISION = 12
+# Message search: HMAC key for the blind keyword index (defaults to one derived
+# from SECRET_KEY; changing it makes existing index entries unsearchable)
+CHAT_SEARCH_KEY = os.environ.get('CHAT_SEARCH_KEY', '')
+CHAT_SEARCH_MAX_TOKENS = 64
+CHAT_SEARCH_PAGE_SIZE = 20
+# Dashboard: rooms/contacts rendered up front; the rest are found by prefix search
+CHAT_DASHBOARD_PAGE_SIZE = 50
+CHAT_DIRECTORY_SEARCH_LIMIT = 10
+CHAT_DIRECTORY_SEARCH_CACHE_TIMEOUT = 30
+# Overlay presence changes cached by consumers on contact lists
+CHAT_PRESENCE_CACHE = True
+CHAT_PRESENCE_CACHE_TIMEOUT = 300
+# Attachments: encrypted in fixed-size segments under MEDIA_ROOT/chat_attachments
+# (the master key wrapping per-file keys defaults to one derived from SECRET_KEY)
+CHAT_ATTACHMENT_KEY = os.environ.get('CHAT_ATTACHMENT_KEY', '')
+CHAT_ATTACHMENT_SEGMENT_SIZE = 64 * 1024
+CHAT_ATTACHMENT_MAX_SIZE = 1024 ** 3
+CHAT_ATTACHMENT_UPLOAD_TTL_HOURS = 24
+# Image previews generated in the background (longest side, in pixels)
+CHAT_IMAGE_THUMBNAIL_SIZES = (320, 960)
+
+# Thumbnails: avatars and image messages are resized once, stored under content-hash names
+AVATAR_THUMBNAIL_SIZES = (48, 96, 256)
+THUMBNAIL_FORMAT = 'WEBP'
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_MAX_SOURCE_SIZE = 32 * 1024 * 1024
+
+# Group commit: batch message inserts from all consumers into one transaction
+CHAT_GROUP_COMMIT = os.environ.get('CHAT_GROUP_COMMIT', '') == '1'
+CHAT_GROUP_COMMIT_WINDOW_MS = 5
+CHAT_GROUP_COMMIT_MAX_BATCH = 200
+# Consumer database access: 'async' runs async ORM calls on CHAT_DB_LANES lanes
+# (one thread and connection each; default 8, or 1 on SQLite), 'threaded' uses
+# database_sync_to_async on the single shared thread
+CHAT_DB_ACCESS = os.environ.get('CHAT_DB_ACCESS', 'async')
+CHAT_DB_LANES = int(os.environ.get('CHAT_DB_LANES', 0)) or None
+# WebSocket connect tickets: seconds a signed ticket stays valid (reusable until then)
+CHAT_WS_TICKET_TTL = 60
+# Rooms one multiplexed socket (ws/chat/) may subscribe to at once
+CHAT_MULTIPLEX_MAX_ROOMS = 50
+
+# Metrics: /metrics answers DEBUG, staff and scrapers sending
+# "Authorization: Bearer <token>" when this is set
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Also answer unforwarded loopback connections; only safe when no proxy on
+# this host reaches the app without adding X-Forwarded-For
+METRICS_ALLOW_LOOPBACK = os.environ.get('METRICS_ALLOW_LOOPBACK', '') == '1'
+
+# Query profiling (opt-in): log slow requests/consumer events, dump sampled cProfile stats
+PROFILING_ENABLED = os.environ.get('CIPHERTALK_PROFILING', '') == '1'
+PROFILING_SLOW_MS = 500
+PROFILING_SLOW_QUERIES = 50
+PROFILING_SAMPLE_RATE = 0.01
+PROFILING_DUMP_DIR = BASE_DIR / 'profiles'
+
 # Custom user model
 AUTH_USER_MODEL = 'users.CustomUser'
 
@@ -139,9 +312,24 @@ LOGIN_URL = '/users/login/'
 LOGIN_REDIRECT_URL = '/chat/'
 LOGOUT_REDIRECT_URL = '/users/login/'
 
-# Session settings
+# Session settings, by SESSION_PROFILE:
+# - 'cached_db' (default): reads come from the cache, writes go to both
+# - 'cache': cache only (sessions are lost when the cache is; use with Redis)
+# - 'db': database only
+# Sessions are saved when they change, plus a sliding-expiry refresh at most
+# once per SESSION_REFRESH_INTERVAL (see SlidingSessionMiddleware).
+SESSION_PROFILE = os.environ.get('SESSION_PROFILE', 'cached_db')
+SESSION_ENGINES = {
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'cache': 'django.contrib.sessions.backends.cache',
+    'db': 'django.contrib.sessions.backends.db',
+}
+if SESSION_PROFILE not in SESSION_ENGINES:
+    raise ImproperlyConfigured(f"Unknown SESSION_PROFILE {SESSION_PROFILE!r}; use one of {', '.join(SESSION_ENGINES)}")
+SESSION_ENGINE = SESSION_ENGINES[SESSION_PROFILE]
 SESSION_COOKIE_AGE = 1209600  # 2 weeks in seconds
-SESSION_SAVE_EVERY_REQUEST = True
+SESSION_SAVE_EVERY_REQUEST = False
+SESSION_REFRESH_INTERVAL = 24 * 60 * 60
 SESSION_EXPIRE_AT_BROWSER_CLOSE = False
 
 # Authentication backends
@@ -7,8 +7,9 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('users/', include('apps.users.urls')),
     path('chat/', include('apps.chat.urls')),
-    # path('analytics/', include('apps.analytics.urls')),
-    # path('api/', include('apps.api.urls')),
+    path('', include('apps.monitoring.urls')),
+    path('analytics/', include('apps.analytics.urls')),
+    path('api/', include('apps.api.urls')),
 ]
 
 if settings.DEBUG:
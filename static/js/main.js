@@ -12,9 +12,11 @@ class CipherTalkChat {
         this.participants = window.participants || [];
 
         this.socket = null;
+        this.ticket = null;
         this.typingTimer = null;
         this.typing = false;
         this.onlineUsers = new Set();
+        this.lastMessageId = this.findLastRenderedMessageId();
 
         // Initialize features
         this.initializeSocket();
@@ -26,13 +28,42 @@ class CipherTalkChat {
     // -----------------------------
     // 1. WebSocket Connection Setup - FIXED URL
     // -----------------------------
-    initializeSocket() {
+    async fetchTicket() {
+        // Signed connect ticket, reused until shortly before it expires;
+        // without one the server falls back to the session cookie
+        const now = Date.now() / 1000;
+        if (this.ticket && this.ticket.expires_at - 5 > now) {
+            return this.ticket.ticket;
+        }
+        try {
+            const response = await fetch(`/chat/api/ws-ticket/${encodeURIComponent(this.roomName)}/`);
+            this.ticket = response.ok ? await response.json() : null;
+        } catch (error) {
+            this.ticket = null;
+        }
+        return this.ticket ? this.ticket.ticket : null;
+    }
+
+    async initializeSocket() {
         // ✅ FIXED: Use encoded room name in URL
         const encodedRoomName = encodeURIComponent(this.roomName);
         const protocol = window.location.protocol === "https:" ? "wss:" : "ws:";
-        const wsUrl = `${protocol}//${window.location.host}/ws/chat/${encodedRoomName}/`;
+        let wsUrl = `${protocol}//${window.location.host}/ws/chat/${encodedRoomName}/`;
+        const params = new URLSearchParams();
+
+        // Ask the server to replay anything sent while we were away
+        if (this.lastMessageId) {
+            params.set("last_message_id", this.lastMessageId);
+        }
+        const ticket = await this.fetchTicket();
+        if (ticket) {
+            params.set("ticket", ticket);
+        }
+        if (params.toString()) {
+            wsUrl += `?${params}`;
+        }
 
-        console.log("🔗 Connecting to WebSocket:", wsUrl);
+        console.log("🔗 Connecting to WebSocket:", wsUrl.split("?")[0]);
     
         this.socket = new WebSocket(wsUrl);
 
@@ -98,6 +129,18 @@ class CipherTalkChat {
 
         // Send button click
         sendButton.addEventListener("click", () => this.sendMessage());
+
+        // Attachments
+        const attachButton = document.getElementById("attachButton");
+        const attachmentInput = document.getElementById("attachmentInput");
+        if (attachButton && attachmentInput) {
+            attachButton.addEventListener("click", () => attachmentInput.click());
+            attachmentInput.addEventListener("change", () => {
+                const file = attachmentInput.files[0];
+                attachmentInput.value = "";
+                if (file) this.uploadAttachment(file);
+            });
+        }
     }
 
     updateSendButton() {
@@ -166,6 +209,53 @@ class CipherTalkChat {
         this.stopTyping();
     }
 
+    // Upload in chunks of whole segments; after a failed chunk ask the
+    // server how much it stored and carry on from there.
+    async uploadAttachment(file) {
+        const attachButton = document.getElementById("attachButton");
+        if (attachButton) attachButton.disabled = true;
+        try {
+            const start = await fetch(window.uploadUrl, {
+                method: "POST",
+                headers: { "Content-Type": "application/json", "X-CSRFToken": window.csrfToken },
+                body: JSON.stringify({
+                    room_name: this.roomName,
+                    file_name: file.name,
+                    file_size: file.size,
+                    content_type: file.type
+                })
+            });
+            const upload = await start.json();
+            if (!start.ok) throw new Error(upload.error || "Upload failed");
+
+            const chunkSize = upload.segment_size * 16;
+            let offset = upload.offset;
+            let retries = 0;
+            while (offset < file.size) {
+                try {
+                    const response = await fetch(upload.url, {
+                        method: "PATCH",
+                        headers: { "Upload-Offset": String(offset) },
+                        body: file.slice(offset, offset + chunkSize)
+                    });
+                    if (!response.ok && response.status !== 409) throw new Error(`HTTP ${response.status}`);
+                    offset = Number(response.headers.get("Upload-Offset"));
+                    retries = 0;
+                } catch (error) {
+                    if (++retries > 5) throw error;
+                    await new Promise(resolve => setTimeout(resolve, 1000 * retries));
+                    const head = await fetch(upload.url, { method: "HEAD" });
+                    offset = Number(head.headers.get("Upload-Offset"));
+                }
+            }
+        } catch (error) {
+            console.error("Attachment upload failed:", error);
+            this.showSystemMessage(`Could not upload ${file.name}`, true);
+        } finally {
+            if (attachButton) attachButton.disabled = false;
+        }
+    }
+
     // -----------------------------
     // 5. Handling Incoming Events
     // -----------------------------
@@ -189,9 +279,21 @@ class CipherTalkChat {
             case "message_read":
                 this.handleMessageRead(data);
                 break;
+            case "message_deleted":
+                this.handleMessageDeleted(data);
+                break;
             case "online_users":
                 this.handleOnlineUsers(data);
                 break;
+            case "resume_complete":
+                if (data.count > 0) {
+                    this.showSystemMessage(`Caught up on ${data.count} missed message(s)`);
+                }
+                break;
+            case "resync_required":
+                // Too far behind for a replay - reload the latest history
+                window.location.reload();
+                break;
             case "error":
                 this.showSystemMessage(`Error: ${data.error}`, true);
                 break;
@@ -204,6 +306,12 @@ class CipherTalkChat {
     displayMessage(data) {
         const messagesContainer = document.getElementById("messagesContainer");
         if (!messagesContainer) return;
+
+        // Replayed messages may overlap with ones already on screen
+        if (data.message_id) {
+            if (document.querySelector(`[data-message-id="${data.message_id}"]`)) return;
+            this.lastMessageId = Math.max(this.lastMessageId, data.message_id);
+        }
         
         const isSent = data.sender_id === this.userId;
 
@@ -229,7 +337,26 @@ class CipherTalkChat {
         contentDiv.className = "message-content";
         
         // Display the actual message content, not encrypted data
-        if (data.message) {
+        if (data.attachment) {
+            const link = document.createElement("a");
+            link.className = "message-attachment";
+            link.href = data.attachment.url;
+            link.target = "_blank";
+            if (data.attachment.preview) {
+                link.className = "message-image";
+                const img = document.createElement("img");
+                img.src = data.attachment.preview;
+                img.alt = data.attachment.name;
+                img.loading = "lazy";
+                link.appendChild(img);
+            } else {
+                const icon = document.createElement("i");
+                icon.className = "fas fa-paperclip";
+                link.appendChild(icon);
+                link.appendChild(document.createTextNode(data.attachment.name));
+            }
+            contentDiv.appendChild(link);
+        } else if (data.message) {
             contentDiv.textContent = data.message;
         } else if (data.encrypted_content) {
             // If only encrypted content is available, show a placeholder
@@ -335,6 +462,13 @@ class CipherTalkChat {
         }
     }
 
+    handleMessageDeleted(data) {
+        const messageElement = document.querySelector(`[data-message-id="${data.message_id}"]`);
+        if (messageElement) {
+            messageElement.remove();
+        }
+    }
+
     // -----------------------------
     // 10. Presence & Online Status
     // -----------------------------
@@ -418,6 +552,14 @@ class CipherTalkChat {
         }
     }
 
+    findLastRenderedMessageId() {
+        let lastId = 0;
+        document.querySelectorAll("[data-message-id]").forEach((element) => {
+            lastId = Math.max(lastId, parseInt(element.dataset.messageId, 10) || 0);
+        });
+        return lastId;
+    }
+
     scrollToBottom() {
         const messagesContainer = document.getElementById("messagesContainer");
         if (messagesContainer) {